@@ -1,224 +1,3268 @@
 import threading
 import socket
 import atexit
-from rich import print
-from rich.console import Console
 import random
 import json
 from datetime import datetime
 import logging
+import logging.handlers
 import time
-from prompt_toolkit.application import Application
-from prompt_toolkit.buffer import Buffer # Re-adding Buffer for explicit type hinting if needed, though not strictly used in current logic
-from prompt_toolkit.layout import Layout, HSplit
-from prompt_toolkit.widgets import Frame, TextArea
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.styles import Style
+import argparse
 import asyncio
+import bisect
+import collections
+import concurrent.futures
+import heapq
+import hmac
+import ipaddress
+import http.server
+import itertools
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import signal
+import struct
+import subprocess
 import sys # Import sys for sys.exit()
-from pyngrok import ngrok
+import tempfile
+import zlib
 
+# rich, prompt_toolkit and pyngrok are imported where they are first needed:
+# together they are most of the startup time, and --daemon and --bench use
+# none of them.
 
-# Configure logging
-logging.basicConfig(filename="starchat-debug.log", level=logging.DEBUG,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+def rprint(*args, **kwargs):
+    # rich's print (markup, colours), imported on first use.
+    from rich import print as rich_print
+    rich_print(*args, **kwargs)
+
+def report_error(msg):
+    # Startup failures: shown on the terminal, or written to stderr in
+    # headless runs (--daemon, --bench), which never load rich.
+    if message_sink:
+        sys.stderr.write(msg + "\n")
+        sys.stderr.flush()
+    else:
+        rprint(msg)
+
+
+# --- Logging ---
+#
+# Call sites only create a record and put it on a queue; a QueueListener
+# thread formats it as one JSON object per line and does the file and
+# console I/O. Messages take %-style arguments, so nothing is formatted
+# unless the record is actually emitted.
 
 DEBUG_MODE = False
+LOG_FILE = "starchat-debug.log"
+LOG_LEVEL = logging.INFO  # Used when DEBUG_MODE is off
+LOG_QUEUE_SIZE = 10000  # Records waiting for the writer thread; newer records are dropped past this
+LOG_SAMPLE_EVERY = 100  # debug_sampled() logs one in this many occurrences of an event
+
+logger = logging.getLogger("starchat")
+_log_listener = None
+_sample_counters = collections.defaultdict(itertools.count)
+
+def debug(msg, *args, **fields):
+    # Extra keyword arguments become fields of the JSON log line.
+    if DEBUG_MODE:
+        logger.debug(msg, *args, extra={"fields": fields})
+
+def debug_sampled(event, msg, *args, **fields):
+    # For high-rate events (e.g. every broadcast): log one in LOG_SAMPLE_EVERY.
+    if DEBUG_MODE and next(_sample_counters[event]) % LOG_SAMPLE_EVERY == 0:
+        logger.debug(msg, *args, extra={"fields": dict(fields, event=event, sample_rate=LOG_SAMPLE_EVERY)})
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class ConsoleEchoHandler(logging.Handler):
+    # Mirrors debug records to the terminal, as debug() always did in DEBUG_MODE.
+    def emit(self, record):
+        rprint(f"[cyan][DEBUG {datetime.fromtimestamp(record.created).strftime('%H:%M:%S')}][/cyan] {record.getMessage()}")
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never formats or waits on the calling thread.
+
+    The stock prepare() formats the message before enqueueing; here the
+    record goes on the queue as is and the listener formats it. If the
+    writer falls behind, records are dropped (and counted) instead of
+    blocking the chat path.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("log_records_dropped")
+
+def setup_logging(log_file=None):
+    global _log_listener
+    if _log_listener:
+        return
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    file_handler = logging.FileHandler(log_file or LOG_FILE, encoding="utf-8", delay=True)
+    file_handler.setFormatter(JsonLinesFormatter())
+    handlers = [file_handler]
+    if DEBUG_MODE:
+        echo = ConsoleEchoHandler(logging.DEBUG)
+        echo.addFilter(lambda record: record.levelno == logging.DEBUG)
+        handlers.append(echo)
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    logger.addHandler(NonBlockingQueueHandler(log_queue))
+    logger.setLevel(logging.DEBUG if DEBUG_MODE else LOG_LEVEL)
+    logger.propagate = False
+    atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    # Flush whatever is still queued and stop the writer thread.
+    global _log_listener
+    if _log_listener:
+        _log_listener.stop()
+        _log_listener = None
+
+port = 7001
+screenName = None
+auth = None
+version = "1.0.0-Launchpad"
+clients = {}  # client_id -> ClientSession
+clients_lock = threading.Lock()
+
+# Rooms: every client is in exactly one room (DEFAULT_ROOM after joining) and
+# only gets that room's messages, so fan-out cost follows the room's size.
+# The indexes below are guarded by clients_lock.
+DEFAULT_ROOM = "lobby"
+ROOM_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")  # Also used as a directory name for the room's history
+rooms = {}  # room name -> {client_id: ClientSession}
+names = {}  # screen name -> {client_id: ClientSession}, for direct messages
+host_room = DEFAULT_ROOM  # Room the host's own messages go to
+
+# Each client gets a bounded outbound queue drained by its own writer.
+# OUTBOUND_POLICY decides what happens when a client falls behind:
+#   "drop_oldest" - discard its oldest queued message to make room
+#   "disconnect"  - drop the client
+#   "block"       - make the sender wait up to OUTBOUND_BLOCK_TIMEOUT seconds, then disconnect
+OUTBOUND_QUEUE_SIZE = 512  # frames
+OUTBOUND_POLICY = "drop_oldest"
+OUTBOUND_BLOCK_TIMEOUT = 2.0
+
+# How writers turn queued frames into socket writes:
+#   "latency"    - TCP_NODELAY is set and whatever is queued is written at once;
+#                  best for typing in small rooms
+#   "throughput" - Nagle stays on and, after the first frame, the writer waits
+#                  SEND_COALESCE_WINDOW seconds so everything queued meanwhile
+#                  goes out in one write (fewer, fuller packets for large rooms
+#                  and bursts of join/system messages)
+# Writers never wait once SEND_COALESCE_BYTES are queued.
+SEND_MODE = "latency"
+SEND_COALESCE_WINDOW = 0.005
+SEND_COALESCE_BYTES = 64 * 1024
+
+# Session resume ("resume1"): the host remembers the last frames sent to each
+# client, and a client whose connection drops is held for RESUME_TTL seconds
+# so it can reconnect and pick up where it left off.
+RESUME_TTL = 60.0
+RESUME_WINDOW_FRAMES = 1024  # sends kept per client
+RESUME_WINDOW_BYTES = 1024 * 1024  # Counted at full size, though broadcast frames are shared
+resumable = {}  # resume token -> ClientSession (guarded by clients_lock)
+
+# Client side: reconnect with exponential backoff when the connection drops.
+RECONNECT_INITIAL_DELAY = 0.5
+RECONNECT_MAX_DELAY = 8.0
+RECONNECT_GIVE_UP = RESUME_TTL  # seconds of retrying before giving up
+
+# Dead connections: a peer whose network vanished without a FIN never makes
+# recv() return. Connections that negotiated "ping1" are pinged after
+# HEARTBEAT_INTERVAL of silence and closed after HEARTBEAT_TIMEOUT; others get
+# TCP keepalive with the same timings. A connection that hasn't sent its auth
+# packet within HANDSHAKE_TIMEOUT is closed.
+HEARTBEAT_INTERVAL = 5.0
+HEARTBEAT_TIMEOUT = 15.0
+HANDSHAKE_TIMEOUT = 10.0
+
+# Connection floods: new connections are screened right after accept(). At
+# most HANDSHAKE_CONCURRENCY may be mid-handshake at once, and each source
+# address gets a token bucket of HANDSHAKE_BURST attempts refilled at
+# HANDSHAKE_RATE per second (None turns the per-address limit off). A wrong
+# auth code costs HANDSHAKE_FAILURE_COST more tokens. Behind ngrok every
+# client arrives from 127.0.0.1, so loopback peers skip the per-address limit
+# on connecting; instead they share one bucket that only wrong codes drain.
+HANDSHAKE_CONCURRENCY = 256
+HANDSHAKE_RATE = 10.0
+HANDSHAKE_BURST = 50
+HANDSHAKE_FAILURE_COST = 5
+HANDSHAKE_TRACKED_ADDRESSES = 10000  # Buckets kept; the least recently seen address is forgotten first
+TIMER_TICK = 0.25  # Resolution of the timer wheel, seconds
+TIMER_SLOTS = 1024  # One turn of the wheel covers TIMER_TICK * TIMER_SLOTS seconds
+
+# Message history: every broadcast is appended to an on-disk log so joining
+# clients (and the host after a restart) can catch up on what they missed.
+HISTORY_ENABLED = True
+HISTORY_DIR = "starchat-history"
+HISTORY_SEGMENT_BYTES = 8 * 1024 * 1024  # roll to a new segment file past this size
+HISTORY_REPLAY_COUNT = 50  # messages replayed to a joining client unless it asks otherwise
+HISTORY_REPLAY_LIMIT = 5000  # upper bound on any single replay
+HISTORY_REPLAY_BYTES = 1024 * 1024  # and on the bytes it queues for one client, newest kept
+HISTORY_REPLAY_CHUNK = 64 * 1024  # bytes per queued replay write
+message_log = None  # MessageLog while hosting (history of DEFAULT_ROOM)
+ROOM_LOGS_OPEN = 64  # room histories kept open at once; idle ones past this are closed, least recently used first
+room_logs = collections.OrderedDict()  # room name -> MessageLog for the other rooms, opened on first use
+room_joins = collections.Counter()  # room name -> clients replaying its history, which keeps the log open
+
+# Metrics export (host only). Both are off by default; /stats always works.
+METRICS_SNAPSHOT_PATH = None  # e.g. "starchat-metrics.json", rewritten every METRICS_SNAPSHOT_INTERVAL seconds
+METRICS_SNAPSHOT_INTERVAL = 10.0
+METRICS_HTTP_PORT = None  # e.g. 9108 to serve Prometheus text at http://127.0.0.1:9108/metrics
+
+# Server engine: "threaded" runs one thread per client, "async" serves every
+# connection from a single asyncio event loop (cheaper with many idle clients),
+# "sharded" runs SHARD_WORKERS processes that share the port (SO_REUSEPORT)
+# and exchange broadcasts over a local bus owned by the host process.
+SERVER_ENGINE = "threaded"
+SERVER_ENGINES = ("threaded", "async", "sharded")
+ASYNC_BACKLOG = 1024  # listen() backlog for the async engine
+server_loop = None  # Event loop of the async engine while it runs
+SHARD_WORKERS = os.cpu_count() or 2
+SHARD_WORKER_ENGINE = "async"  # engine each shard worker runs
+SHARD_ID_STRIDE = 1 << 24  # client ids of worker n start at n * SHARD_ID_STRIDE + 1
+SHARD_BUS_QUEUE_SIZE = 65536  # frames queued per bus link; bus links never drop
+SHARD_START_TIMEOUT = 15.0  # seconds to wait for all workers to report ready
+# Host settings copied into each worker process (spawned workers start from the defaults).
+SHARD_INHERITED_SETTINGS = (
+    "auth", "screenName", "DEBUG_MODE", "LOG_LEVEL", "OUTBOUND_QUEUE_SIZE", "OUTBOUND_POLICY",
+    "OUTBOUND_BLOCK_TIMEOUT", "ASYNC_BACKLOG", "WIRE_CAPS", "ZLIB_LEVEL",
+    "TRANSFER_DIR", "TRANSFER_RATE_LIMIT", "TRANSFER_MAX_BYTES", "HEARTBEAT_INTERVAL", "HEARTBEAT_TIMEOUT",
+    "SEND_MODE", "SEND_COALESCE_WINDOW", "SEND_COALESCE_BYTES", "SEARCH_ENABLED", "SEARCH_MAX_BYTES",
+    "HANDSHAKE_TIMEOUT", "HANDSHAKE_CONCURRENCY", "HANDSHAKE_RATE", "HANDSHAKE_BURST", "HANDSHAKE_FAILURE_COST",
+)
+shard_bus = None  # ShardBus in the host process, ShardBusClient in a worker
+shard_processes = []  # Worker processes while hosting with the sharded engine
+
+# Federation: hosts configured with the same FEDERATION_SECRET can link with
+# /link <host:port> <auth> and share one room. Off while the secret is None.
+# Not available with the sharded engine.
+FEDERATION_SECRET = None
+FEDERATION_PEERS = ()  # "host:port:auth" entries to link to at startup
+FEDERATION_QUEUE_SIZE = 65536  # frames queued per trunk before it is dropped
+federation = None  # Federation while hosting with a secret set
+
+app = None  # prompt_toolkit Application instance
+chat_output = None  # TextArea for chat output
+input_field = None  # TextArea for user input
+conn_socket = None  # For client socket
+client_deflater = None  # FrameDeflater once the server accepts "zlib"
+client_inflater = None  # FrameInflater for frames from the server
+member_names = {}  # Sender id -> screen name, learned from MSG_MEMBER frames
+server_address = None  # (host, port) the client connected to
+resume_token = None  # From the welcome when the server accepted "resume1"
+client_last_seq = 0  # Latest MSG_SEQ from the server
+client_closing = threading.Event()  # Set when the user quits, so a dropped connection isn't retried
+client_send_lock = threading.Lock()  # The UI, transfer and heartbeat threads all send, and share the zlib stream
+client_last_seen = 0.0  # time.monotonic() of the last data from the server
+is_server = False
+message_sink = None  # When set, add_message() hands messages here instead of the UI (headless runs)
+
+# Chat pane: keeps about the last SCROLLBACK_LINES lines, dropping whole messages
+# from the top, and redraws at most once per UI_FRAME_INTERVAL, however many
+# messages arrive in between.
+SCROLLBACK_LINES = 2000
+UI_FRAME_INTERVAL = 1 / 30  # seconds
+UI_START_TIMEOUT = 5.0  # Longest start_ui() waits for the UI loop to come up
+_scrollback = collections.deque()  # (length plus its newline, line count) per message in the pane, oldest first
+_scrollback_lines = 0  # Lines in the pane, the sum of the counts in _scrollback
+_scrollback_text = ""  # The pane's text, kept so a flush only appends to it
+_pending_messages = []  # Messages waiting for the next UI flush
+_pending_lock = threading.Lock()
+_flush_scheduled = False
+
+# --- Runtime metrics ---
+
+class Histogram:
+    """Fixed-bucket histogram of durations in seconds."""
+
+    BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+               0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float("inf"))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * len(self.BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.BUCKETS, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.total += value
+            self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation (an estimate).
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        rank, seen = q * count, 0
+        for bound, n in zip(self.BUCKETS, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.BUCKETS[-1]
+
+    def snapshot(self):
+        with self._lock:
+            return {"count": self.count, "sum": self.total,
+                    "buckets": dict(zip(map(str, self.BUCKETS), self.counts))}
+
+class Metrics:
+    """Counters and histograms updated on the hot paths.
+
+    Counters are kept per thread, so recording is an unlocked integer add
+    on the caller's own dict; nothing is summed or formatted until something
+    reads a snapshot (/stats, the JSON snapshot file or the Prometheus
+    endpoint). Gauges such as queue depth are computed at read time from the
+    live sessions.
+    """
+
+    COUNTERS = ("connections_accepted", "connections_rejected", "messages_in", "messages_out",
+                "bytes_in", "bytes_out", "broadcasts", "frames_dropped", "slow_client_disconnects",
+                "ui_messages", "log_records_dropped", "federation_in", "federation_out",
+                "sessions_resumed", "sessions_expired", "transfers_completed", "transfer_bytes_in",
+                "transfer_bytes_out", "heartbeat_timeouts", "handshake_timeouts", "handshakes_throttled",
+                "handshakes_shed", "socket_writes")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []  # (thread, its counters) for every thread that has counted
+        self._retired = dict.fromkeys(self.COUNTERS, 0)  # Folded in from threads that exited
+        self.broadcast_fanout = Histogram()
+        self.clients_lock_wait = Histogram()
+        self.started = time.time()
+
+    def inc(self, name, n=1):
+        try:
+            self._local.counters[name] += n
+        except AttributeError:
+            counters = self._local.counters = dict.fromkeys(self.COUNTERS, 0)
+            with self._lock:
+                self._threads.append((threading.current_thread(), counters))
+            counters[name] += n
+
+    @property
+    def counters(self):
+        # Sums every thread's counts; a thread still counting may be a bump behind.
+        with self._lock:
+            live = []
+            for thread, counts in self._threads:
+                if thread.is_alive():
+                    live.append((thread, counts))
+                else:
+                    for name, value in counts.items():
+                        self._retired[name] += value
+            self._threads = live
+            totals = dict(self._retired)
+            for _, counts in live:
+                for name, value in counts.items():
+                    totals[name] += value
+        return totals
+
+    def snapshot(self, per_client=True):
+        counters = self.counters
+        with clients_lock:
+            sessions = list(clients.values())
+            room_count = len(rooms)
+        depths = [len(session.outbound) for session in sessions]
+        snap = {
+            "timestamp": time.time(),
+            "uptime_s": round(time.time() - self.started, 1),
+            "counters": counters,
+            "gauges": {
+                "clients": len(sessions),
+                "rooms": room_count,
+                "outbound_queue_depth_total": sum(depths),
+                "outbound_queue_depth_max": max(depths, default=0),
+                "ui_backlog": len(_pending_messages),
+                "handshakes_in_progress": handshake_gate.in_progress,
+            },
+            "histograms": {
+                "broadcast_fanout_seconds": self.broadcast_fanout.snapshot(),
+                "clients_lock_wait_seconds": self.clients_lock_wait.snapshot(),
+            },
+        }
+        if per_client:
+            snap["clients"] = [{
+                "name": session.name, "addr": str(session.addr),
+                "messages_in": session.messages_in, "bytes_in": session.bytes_in,
+                "messages_out": session.messages_out, "bytes_out": session.bytes_out,
+                "queue_depth": len(session.outbound), "dropped": session.outbound.dropped,
+            } for session in sessions]
+        return snap
+
+    def prometheus_text(self):
+        snap = self.snapshot()
+        lines = []
+        for name, value in snap["counters"].items():
+            lines += [f"# TYPE starchat_{name}_total counter", f"starchat_{name}_total {value}"]
+        for name, value in snap["gauges"].items():
+            lines += [f"# TYPE starchat_{name} gauge", f"starchat_{name} {value}"]
+        for name, hist in snap["histograms"].items():
+            lines.append(f"# TYPE starchat_{name} histogram")
+            cumulative = 0
+            for bound, n in hist["buckets"].items():
+                cumulative += n
+                le = "+Inf" if bound == "inf" else bound
+                lines.append(f'starchat_{name}_bucket{{le="{le}"}} {cumulative}')
+            lines += [f"starchat_{name}_sum {hist['sum']}", f"starchat_{name}_count {hist['count']}"]
+        for field in ("messages_in", "bytes_in", "messages_out", "bytes_out", "queue_depth"):
+            lines.append(f"# TYPE starchat_client_{field} gauge")
+            for client in snap["clients"]:
+                name = client["name"].replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f'starchat_client_{field}{{client="{name}"}} {client[field]}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def format_stats():
+    # Human-readable lines for the /stats command.
+    snap = metrics.snapshot()
+    c, g = snap["counters"], snap["gauges"]
+    ms = lambda v: "-" if v is None else ("inf" if v == float("inf") else f"{v * 1000:g}ms")
+    lines = [
+        f"[Stats] uptime {snap['uptime_s']}s | clients {g['clients']} in {g['rooms']} rooms | accepted {c['connections_accepted']} "
+        f"| rejected {c['connections_rejected']} | slow-client drops {c['slow_client_disconnects']}",
+        f"[Stats] in {c['messages_in']} msgs / {c['bytes_in']} B | out {c['messages_out']} frames / {c['bytes_out']} B "
+        f"in {c['socket_writes']} socket writes",
+        f"[Stats] broadcasts {c['broadcasts']} | fan-out p50 <= {ms(metrics.broadcast_fanout.quantile(0.5))} "
+        f"p99 <= {ms(metrics.broadcast_fanout.quantile(0.99))} | clients_lock wait p99 <= "
+        f"{ms(metrics.clients_lock_wait.quantile(0.99))}",
+        f"[Stats] outbound queues total {g['outbound_queue_depth_total']} max {g['outbound_queue_depth_max']} "
+        f"| frames dropped {c['frames_dropped']} | UI backlog {g['ui_backlog']}",
+        f"[Stats] handshakes in progress {g['handshakes_in_progress']} | throttled {c['handshakes_throttled']} "
+        f"| shed {c['handshakes_shed']} | timed out {c['handshake_timeouts']}",
+    ]
+    for client in snap["clients"]:
+        lines.append(f"[Stats]   {client['name']}: in {client['messages_in']}/{client['bytes_in']} B, "
+                     f"out {client['messages_out']}/{client['bytes_out']} B, queue {client['queue_depth']}, "
+                     f"dropped {client['dropped']}")
+    return lines
+
+def format_client_stats():
+    # /stats on a client: its own connection and traffic, not the host's state.
+    snap = metrics.snapshot()
+    c = snap["counters"]
+    where = "%s:%s" % server_address if server_address else "nothing"
+    heard = f"{time.monotonic() - client_last_seen:.1f}s ago" if conn_socket and client_last_seen else "-"
+    return [
+        f"[Stats] uptime {snap['uptime_s']}s | connected to {where} | last heard from the server {heard} "
+        f"| heartbeat timeouts {c['heartbeat_timeouts']}",
+        f"[Stats] in {c['messages_in']} msgs / {c['bytes_in']} B | out {c['messages_out']} msgs / {c['bytes_out']} B",
+    ]
+
+def _metrics_snapshot_loop(path, interval):
+    while not server_shutdown_event.wait(interval):
+        try:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(metrics.snapshot(), f)
+            os.replace(tmp_path, path)  # Readers never see a half-written file
+        except OSError as e:
+            debug("Failed to write metrics snapshot: %s", e)
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        debug("Metrics endpoint: " + format, *args)
+
+def start_metrics_exporters():
+    if METRICS_SNAPSHOT_PATH:
+        threading.Thread(target=_metrics_snapshot_loop, args=(METRICS_SNAPSHOT_PATH, METRICS_SNAPSHOT_INTERVAL),
+                         daemon=True).start()
+    if METRICS_HTTP_PORT:
+        try:
+            httpd = http.server.ThreadingHTTPServer(("127.0.0.1", METRICS_HTTP_PORT), MetricsRequestHandler)
+        except OSError as e:
+            add_message(f"[Error] Could not start metrics endpoint on port {METRICS_HTTP_PORT}: {e}")
+            return
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        add_message(f"[System] Metrics available at http://127.0.0.1:{METRICS_HTTP_PORT}/metrics")
+
+# --- prompt_toolkit UI setup ---
+
+def setup_ui():
+    global chat_output, input_field, app, header
+    from prompt_toolkit.application import Application
+    from prompt_toolkit.key_binding import KeyBindings
+    from prompt_toolkit.layout import Layout, HSplit
+    from prompt_toolkit.styles import Style
+    from prompt_toolkit.widgets import Frame, TextArea
+
+    chat_output = TextArea(style="class:output-field", scrollbar=True, wrap_lines=True, focusable=False)
+    input_field = TextArea(height=1, prompt='> ', style="class:input-field")
+
+    # Top bar with auth and screen name
+    header = TextArea(
+        "Connected Using Client 😊",
+        style="class:header",
+        height=1,
+        focusable=False
+    )
+
+    kb = KeyBindings()
+
+    @kb.add('enter')
+    def _(event):
+        user_text = input_field.text.strip()
+        if not user_text:
+            return
+
+        # Clear the input field immediately
+        input_field.text = ''
+
+        # --- Handle Exit Command ---
+        if user_text.lower() == '/exit':
+            add_message("[System] Initiating shutdown...")
+            if is_server:
+                shutdown_server()
+            else:
+                shutdown_client()
+            return # Prevent further processing of the "exit" command
+        # --- End Exit Command Handling ---
+
+        if user_text.lower() == '/stats':
+            for line in (format_stats() if is_server else format_client_stats()):
+                add_message(line)
+            return
+
+        if is_server and user_text.lower().startswith('/link'):
+            link_command(user_text)
+            return
+
+        if is_server and user_text.startswith('/') and host_command(user_text):
+            return
+
+        if user_text.split(" ", 1)[0].lower() in TRANSFER_COMMANDS:
+            transfer_command(user_text)
+            return
+
+        timestamp = time.time()
+        full_msg = format_chat_line(screenName, timestamp, user_text)
+
+        if is_server:
+            add_message(full_msg)
+            # Server broadcasts its own message
+            broadcast(full_msg, sender_conn=None, msg_type=MSG_CHAT,
+                      compact=(HOST_CLIENT_ID, screenName, timestamp, user_text), room=host_room)
+        else:
+            if user_text.split(" ", 1)[0].lower() not in ROOM_COMMANDS:
+                add_message(full_msg) # Client adds its own message to its display
+            try:
+                if conn_socket:
+                    client_send(encode_frame(MSG_CHAT, user_text))
+                else:
+                    add_message("[Error] Not connected to a server.")
+            except Exception as e:
+                add_message(f"[Error] Failed to send message: {e}")
+                debug("Client send error: %s", e)
+
+
+    root_container = HSplit([
+        header,
+        Frame(chat_output, title='StarChat'),
+        Frame(input_field, title='ChatBox'),
+    ])
+
+    layout = Layout(root_container, focused_element=input_field)
+
+    style = Style.from_dict({
+        'output-field': 'bg:#657d6e #ffffff',
+        'input-field': 'bg:#000000 #ffffff',
+        'frame.label': 'bg:#03A062 #ffffff',
+        'header': 'fg:#000000 bg:#444444 bold'
+    })
+
+    app = Application(layout=layout, key_bindings=kb, style=style, full_screen=True)
+
+def start_ui():
+    # Run the app on its own thread and return once its event loop is up, so
+    # add_message() can draw into the pane from the first message on.
+    ready = threading.Event()
+    threading.Thread(target=app.run, kwargs={"pre_run": ready.set}, daemon=True).start()
+    if not ready.wait(UI_START_TIMEOUT):
+        debug("UI loop not running after %ss; messages go to the terminal until it is", UI_START_TIMEOUT)
+
+def add_message(msg: str):
+    # Thread-safe addition of message to output pane. Messages are queued and
+    # drawn in batches, at most once per UI_FRAME_INTERVAL.
+    global _flush_scheduled
+    if message_sink:
+        message_sink(msg)
+    elif app and chat_output and app.loop: # Ensure app.loop is available
+        with _pending_lock:
+            _pending_messages.append(msg)
+            if _flush_scheduled:
+                return
+            _flush_scheduled = True
+        app.loop.call_soon_threadsafe(app.loop.call_later, UI_FRAME_INTERVAL, _flush_messages)
+    else:
+        # Fallback for messages before UI is fully set up (e.g., initial system messages)
+        rprint(msg)
+
+def _flush_messages():
+    # Runs on the UI loop: apply every pending message as one document update.
+    global _flush_scheduled, _scrollback_text, _scrollback_lines
+    from prompt_toolkit.document import Document  # Already loaded by setup_ui()
+    with _pending_lock:
+        batch = list(_pending_messages)
+        _pending_messages.clear()
+        _flush_scheduled = False
+    metrics.inc("ui_messages", len(batch))
+    added = "\n".join(batch)
+    text = _scrollback_text + "\n" + added if _scrollback_text else added
+    for msg in batch:
+        lines = msg.count("\n") + 1
+        _scrollback.append((len(msg) + 1, lines))
+        _scrollback_lines += lines
+    cut = 0
+    # Drop the oldest messages until the lines fit, always keeping the newest one.
+    while _scrollback_lines > SCROLLBACK_LINES and len(_scrollback) > 1:
+        chars, lines = _scrollback.popleft()
+        cut += chars
+        _scrollback_lines -= lines
+    if cut:
+        text = text[cut:]  # Cut them off the front in one slice
+    _scrollback_text = text
+    # Placing the cursor at the end scrolls to the bottom without walking the lines.
+    chat_output.buffer.set_document(Document(text, cursor_position=len(text)), bypass_readonly=True)
+    app.invalidate()
+
+# --- Wire protocol ---
+#
+# Every message on the socket is a frame:
+#   [version: 1 byte][type: 1 byte][payload length: 4 bytes, big endian][payload]
+# Payloads are UTF-8 text (JSON for the auth/welcome packets). Frames are
+# self-delimiting, so several can share one send/recv and a frame can be
+# split across reads without corrupting it.
+
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct("!BBI")
+MAX_FRAME_SIZE = 1 << 20  # 1 MiB; anything larger is treated as a protocol error
+RECV_SIZE = 65536  # bytes per recv(); one read may carry many frames
+
+MSG_HELLO = 1       # server greeting, payload "Mayday"
+MSG_AUTH = 2        # client auth packet, JSON [auth, screenName, {options}]
+MSG_WELCOME = 3     # server welcome, JSON object
+MSG_CHAT = 4        # chat line
+MSG_SYSTEM = 5      # system notice
+MSG_DISCONNECT = 6  # orderly disconnect, empty payload
+MSG_ERROR = 7       # handshake rejected, payload is the reason
+MSG_CHAT_BIN = 8    # compact chat line: CHAT_BIN_HEADER (sender id, unix time) + UTF-8 body
+MSG_MEMBER = 9      # sender id -> screen name: MEMBER_HEADER (sender id) + UTF-8 name
+MSG_COMPRESSED = 10 # chunk of the sender's zlib stream; inflates to more frames
+MSG_SEQ = 12        # "resume1": SEQ_HEADER (sequence number of everything sent before it)
+MSG_PING = 14       # "ping1": are you there? empty payload, answered with MSG_PONG
+MSG_PONG = 15       # "ping1": reply to MSG_PING
+
+# Optional features negotiated in the handshake. A client lists the ones it
+# supports in its auth options ({"caps": [...]}) and the welcome packet says
+# which the server accepted. Peers that don't negotiate get plain text frames.
+#   "bin1" - chat lines as MSG_CHAT_BIN, names sent once per sender via MSG_MEMBER
+#   "zlib" - traffic wrapped in MSG_COMPRESSED frames from one zlib stream per direction
+#   "resume1" - sends are followed by MSG_SEQ; after a dropped connection the
+#               client reconnects with its token and last sequence number and
+#               gets only what it missed
+#   "ping1" - both ends send MSG_PING when the connection has been quiet and
+#             drop it when nothing at all arrives for HEARTBEAT_TIMEOUT
+WIRE_CAPS = ("bin1", "zlib", "resume1", "ping1")
+CHAT_BIN_HEADER = struct.Struct("!II")
+MEMBER_HEADER = struct.Struct("!I")
+SEQ_HEADER = struct.Struct("!I")
+HOST_CLIENT_ID = 0  # Sender id of the host's own messages
+ZLIB_LEVEL = 6
+COMPRESS_SLICE = 256 * 1024  # Uncompressed bytes per MSG_COMPRESSED frame
+MAX_INFLATED_SIZE = 4 * MAX_FRAME_SIZE  # Refuse compressed frames that expand beyond this
+
+class ProtocolError(Exception):
+    pass
+
+def encode_frame(msg_type, payload=b""):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return FRAME_HEADER.pack(PROTOCOL_VERSION, msg_type, len(payload)) + payload
+
+def encode_frames(frames):
+    # Batch several (msg_type, payload) frames into one buffer for a single sendall().
+    return b"".join(encode_frame(msg_type, payload) for msg_type, payload in frames)
+
+class FrameDecoder:
+    """Incremental frame parser.
+
+    Bytes from any number of reads are fed in; every complete frame is
+    returned as a (msg_type, payload) tuple and partial data stays in the
+    internal buffer until the rest arrives. The buffer is reused and
+    compacted once per feed(), not once per frame.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        buf = self._buf
+        buf += data
+        frames = []
+        pos = 0
+        end_of_data = len(buf)
+        header_size = FRAME_HEADER.size
+        while end_of_data - pos >= header_size:
+            frame_version, msg_type, length = FRAME_HEADER.unpack_from(buf, pos)
+            if frame_version != PROTOCOL_VERSION:
+                raise ProtocolError(f"unsupported protocol version {frame_version}")
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"frame of {length} bytes exceeds limit")
+            frame_end = pos + header_size + length
+            if frame_end > end_of_data:
+                break
+            frames.append((msg_type, bytes(buf[pos + header_size:frame_end])))
+            pos = frame_end
+        if pos:
+            del buf[:pos]
+        return frames
+
+def recv_frames(conn, decoder):
+    # Block until at least one complete frame arrives. Returns [] on EOF.
+    while True:
+        data = conn.recv(RECV_SIZE)
+        if not data:
+            return []
+        frames = decoder.feed(data)
+        if frames:
+            return frames
+
+async def recv_frames_async(reader, decoder):
+    while True:
+        data = await reader.read(RECV_SIZE)
+        if not data:
+            return []
+        frames = decoder.feed(data)
+        if frames:
+            return frames
+
+def _decode_text(payload):
+    return payload.decode("utf-8", errors="replace")
+
+def format_chat_line(name, timestamp, body):
+    return f"[{datetime.fromtimestamp(timestamp).strftime('%H:%M:%S %Y-%m-%d')}] [{name}]: {body}"
+
+def encode_chat_bin(sender_id, timestamp, body):
+    return encode_frame(MSG_CHAT_BIN, CHAT_BIN_HEADER.pack(sender_id, int(timestamp)) + body.encode())
+
+def decode_chat_bin(payload):
+    sender_id, timestamp = CHAT_BIN_HEADER.unpack_from(payload)
+    return sender_id, timestamp, _decode_text(payload[CHAT_BIN_HEADER.size:])
+
+def encode_member(sender_id, name):
+    return encode_frame(MSG_MEMBER, MEMBER_HEADER.pack(sender_id) + name.encode())
+
+class FrameDeflater:
+    """Sending half of the "zlib" capability.
+
+    Each write is compressed with the connection's single zlib stream and
+    flushed with Z_SYNC_FLUSH, so compression carries across messages while
+    every MSG_COMPRESSED frame can be inflated as soon as it arrives.
+    """
+
+    def __init__(self):
+        self._zlib = zlib.compressobj(ZLIB_LEVEL)
+
+    def wrap(self, data):
+        frames = []
+        for start in range(0, len(data), COMPRESS_SLICE):
+            chunk = self._zlib.compress(data[start:start + COMPRESS_SLICE]) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+            frames.append(encode_frame(MSG_COMPRESSED, chunk))
+        return b"".join(frames)
+
+class FrameInflater:
+    """Receiving half of the "zlib" capability: replaces MSG_COMPRESSED frames
+    with the frames they carry, keeping their order."""
+
+    def __init__(self):
+        self._zlib = None
+        self._decoder = FrameDecoder()
+
+    def expand(self, frames):
+        if not any(msg_type == MSG_COMPRESSED for msg_type, _ in frames):
+            return frames
+        if self._zlib is None:
+            self._zlib = zlib.decompressobj()
+        expanded = []
+        for msg_type, payload in frames:
+            if msg_type != MSG_COMPRESSED:
+                expanded.append((msg_type, payload))
+                continue
+            data = self._zlib.decompress(payload, MAX_INFLATED_SIZE)
+            if self._zlib.unconsumed_tail:
+                raise ProtocolError("compressed frame expands beyond limit")
+            expanded.extend(self._decoder.feed(data))
+        return expanded
+
+# --- Persistent message log ---
+
+INDEX_ENTRY = struct.Struct("!QdQ")  # sequence number, unix timestamp, byte offset in the segment
+
+class LogSegment:
+    """One segment of the message log: a data file and its index.
+
+    The data file (<first seq>.log) holds frames back to back, exactly as
+    they were sent. The index file (<first seq>.idx) holds one fixed-size
+    INDEX_ENTRY per frame and is read through a memory map. Sequence numbers
+    inside a segment are contiguous, so entry i is seq base_seq + i.
+    """
+
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        stem = os.path.join(directory, f"{base_seq:020d}")
+        self.log_path = stem + ".log"
+        self.idx_path = stem + ".idx"
+        self._log = open(self.log_path, "ab", buffering=0)
+        self._idx = open(self.idx_path, "a+b", buffering=0)  # Readable too, for mmap
+        self._map = None
+        self._mapped_count = 0
+        self.count = os.path.getsize(self.idx_path) // INDEX_ENTRY.size
+        self.size = self._recover()
+
+    def _recover(self):
+        # Drop a torn tail left by a crash between the data and index writes.
+        log_size = os.path.getsize(self.log_path)
+        end = 0
+        with open(self.log_path, "rb") as f:
+            while self.count:
+                last_offset = self.entry(self.count - 1)[2]
+                f.seek(last_offset)
+                header = f.read(FRAME_HEADER.size)
+                if len(header) == FRAME_HEADER.size:
+                    end = last_offset + FRAME_HEADER.size + FRAME_HEADER.unpack(header)[2]
+                    if end <= log_size:
+                        break
+                self.count -= 1
+                end = 0
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._idx.truncate(self.count * INDEX_ENTRY.size)
+        if log_size != end:
+            debug("Truncating message log segment %s to %s bytes", self.log_path, end)
+            self._log.truncate(end)
+        return end
+
+    @property
+    def last_seq(self):
+        return self.base_seq + self.count - 1
+
+    def append(self, seq, timestamp, frame):
+        self._log.write(frame)
+        self._idx.write(INDEX_ENTRY.pack(seq, timestamp, self.size))
+        self.size += len(frame)
+        self.count += 1
+
+    def entry(self, i):
+        if self._map is None or i >= self._mapped_count:
+            # Remap to cover entries appended since the last lookup.
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._idx.fileno(), self.count * INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+            self._mapped_count = self.count
+        return INDEX_ENTRY.unpack_from(self._map, i * INDEX_ENTRY.size)
+
+    def offset_of(self, i):
+        return self.entry(i)[2] if i < self.count else self.size
+
+    def first_index_since(self, timestamp):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[1] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._log.close()
+        self._idx.close()
+
+class MessageLog:
+    """Append-only on-disk history of broadcast frames.
+
+    Because segments store wire-ready frames, replaying a range is a
+    contiguous read that is queued to the client as a few large writes,
+    never one send per message.
+    """
+
+    def __init__(self, directory=None, segment_bytes=None):
+        self.directory = directory or HISTORY_DIR
+        self.segment_bytes = segment_bytes or HISTORY_SEGMENT_BYTES
+        self._lock = threading.Lock()
+        self.closed = False
+        os.makedirs(self.directory, exist_ok=True)
+        base_seqs = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                           if name.endswith(".log") and name[:-4].isdigit())
+        self.segments = [LogSegment(self.directory, base) for base in base_seqs]
+        if not self.segments:
+            self.segments.append(LogSegment(self.directory, 1))
+        self._bases = [seg.base_seq for seg in self.segments]
+        self.last_seq = self.segments[-1].last_seq
+        debug("Message log opened at %s, last seq %s", self.directory, self.last_seq)
+
+    def append(self, frame, timestamp=None):
+        # Returns the new sequence number, or None once the log is closed.
+        with self._lock:
+            if self.closed:
+                return None
+            seq = self.last_seq + 1
+            active = self.segments[-1]
+            if active.count and active.size + len(frame) > self.segment_bytes:
+                active = LogSegment(self.directory, seq)
+                self.segments.append(active)
+                self._bases.append(seq)
+            active.append(seq, time.time() if timestamp is None else timestamp, frame)
+            self.last_seq = seq
+            return seq
+
+    def first_seq_since(self, timestamp):
+        with self._lock:
+            for seg in self.segments:
+                i = seg.first_index_since(timestamp)
+                if i < seg.count:
+                    return seg.base_seq + i
+            return self.last_seq + 1
+
+    def read_range(self, first_seq, last_seq, chunk_size=None):
+        # Return the frames first_seq..last_seq as a list of byte chunks that
+        # each end on a frame boundary and hold roughly chunk_size bytes.
+        chunk_size = chunk_size or HISTORY_REPLAY_CHUNK
+        first_seq = max(first_seq, self._bases[0])
+        spans = []
+        with self._lock:
+            last_seq = min(last_seq, self.last_seq)
+            pos = bisect.bisect_right(self._bases, first_seq) - 1
+            seq = first_seq
+            while seq <= last_seq and pos < len(self.segments):
+                seg = self.segments[pos]
+                stop = min(last_seq, seg.last_seq)
+                start_offset = seg.offset_of(seq - seg.base_seq)
+                for i in range(seq - seg.base_seq + 1, stop - seg.base_seq + 2):
+                    offset = seg.offset_of(i)
+                    if offset - start_offset >= chunk_size or i == stop - seg.base_seq + 1:
+                        spans.append((seg.log_path, start_offset, offset))
+                        start_offset = offset
+                seq = stop + 1
+                pos += 1
+
+        # File reads happen outside the lock; logged bytes never change.
+        chunks = []
+        handles = {}
+        try:
+            for path, start, end in spans:
+                if end <= start:
+                    continue
+                f = handles.get(path) or handles.setdefault(path, open(path, "rb"))
+                f.seek(start)
+                chunks.append(f.read(end - start))
+        finally:
+            for f in handles.values():
+                f.close()
+        return chunks
+
+    def replay_chunks(self, options, upto):
+        # Pick the replay range requested in a client's auth options: {"history": N}
+        # for the last N messages or {"since": unix_time} for everything after a time.
+        options = options or {}
+        if "since" in options:
+            first = self.first_seq_since(float(options["since"]))
+        else:
+            first = upto - int(options.get("history", HISTORY_REPLAY_COUNT)) + 1
+        first = max(first, upto - HISTORY_REPLAY_LIMIT + 1, self.first_seq_within(upto, HISTORY_REPLAY_BYTES))
+        if first > upto:
+            return []
+        return self.read_range(first, upto)
+
+    def first_seq_within(self, upto, max_bytes):
+        # The oldest sequence number whose frames up to upto fit in max_bytes.
+        with self._lock:
+            for seg in reversed(self.segments):
+                if seg.base_seq > upto:
+                    continue
+                stop = min(upto, seg.last_seq) - seg.base_seq + 1
+                end = seg.offset_of(stop)
+                lo, hi = 0, stop
+                while lo < hi:  # First index whose frames up to stop fit
+                    mid = (lo + hi) // 2
+                    if end - seg.offset_of(mid) <= max_bytes:
+                        hi = mid
+                    else:
+                        lo = mid + 1
+                if lo:
+                    return seg.base_seq + lo
+                max_bytes -= end
+            return self._bases[0]
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            for seg in self.segments:
+                seg.close()
+
+# --- Per-client outbound queues ---
+
+class OutboundQueue:
+    """Bounded FIFO of encoded frames waiting to be written to one client.
+
+    put() never touches the socket, so broadcasting to a slow client costs
+    the same as broadcasting to a fast one. When the queue is full the
+    OUTBOUND_POLICY decides what happens (see the settings at the top).
+    """
+
+    def __init__(self, maxsize=None, policy=None, on_put=None):
+        self.maxsize = maxsize or OUTBOUND_QUEUE_SIZE
+        self.policy = policy or OUTBOUND_POLICY
+        self.on_put = on_put  # Optional wake-up hook for writers that can't wait on the condition
+        self.closed = False
+        self.dropped = 0
+        self._items = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, data, can_block=True):
+        # Returns False if the client should be disconnected instead.
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._items) >= self.maxsize:
+                if self.policy == "drop_oldest":
+                    self._items.popleft()
+                    self.dropped += 1
+                    metrics.inc("frames_dropped")
+                elif self.policy == "block" and can_block:
+                    if not self._cond.wait_for(lambda: self.closed or len(self._items) < self.maxsize,
+                                               timeout=OUTBOUND_BLOCK_TIMEOUT) or self.closed:
+                        return False
+                else:
+                    return False
+            self._items.append(data)
+            self._cond.notify_all()
+        if self.on_put:
+            self.on_put()
+        return True
+
+    def get_batch(self):
+        # Block until frames are queued and take all of them. Returns [] once closed and drained.
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self.closed)
+            return self._take_locked()
+
+    def take_batch(self):
+        with self._cond:
+            return self._take_locked()
+
+    def _take_locked(self):
+        batch = list(self._items)
+        self._items.clear()
+        if batch:
+            self._cond.notify_all()  # Wake senders waiting under the "block" policy
+        return batch
+
+    def close(self, discard=False):
+        with self._cond:
+            self.closed = True
+            if discard:
+                self._items.clear()
+            self._cond.notify_all()
+        if self.on_put:
+            self.on_put()
+
+_client_ids = itertools.count(HOST_CLIENT_ID + 1)
+
+class ResumeWindow:
+    """The last frames sent to a resumable client, by sequence number.
+
+    Entries reference the encoded frames as queued, so a broadcast is stored
+    once however many windows hold it. MSG_SEQ markers are added on the way out.
+    """
+
+    def __init__(self):
+        self.token = os.urandom(16).hex()
+        self.seq = 0
+        self.frames = collections.deque()  # (seq, data)
+        self.bytes = 0
+        self.lock = threading.Lock()  # Held from stamping a send until it is queued, to keep order
+
+    def stamp(self, data):
+        # Number a send and return it with its MSG_SEQ marker.
+        self.seq += 1
+        self.frames.append((self.seq, data))
+        self.bytes += len(data)
+        while len(self.frames) > RESUME_WINDOW_FRAMES or self.bytes > RESUME_WINDOW_BYTES:
+            self.bytes -= len(self.frames.popleft()[1])
+        return data + encode_frame(MSG_SEQ, SEQ_HEADER.pack(self.seq))
+
+    def since(self, seq):
+        # Everything sent after seq as one write, or None if part of it is gone.
+        if seq == self.seq:
+            return b""
+        if seq > self.seq or not self.frames or self.frames[0][0] > seq + 1:
+            return None
+        start = seq + 1 - self.frames[0][0]
+        return b"".join(data + encode_frame(MSG_SEQ, SEQ_HEADER.pack(n))
+                        for n, data in itertools.islice(self.frames, start, None))
+
+class ClientSession:
+    """A connected client: socket, screen name and outbound queue.
+
+    A dedicated writer thread drains the queue and writes everything that
+    piled up since its last write with a single sendall().
+    """
+
+    def __init__(self, conn, name, addr):
+        self.conn = conn
+        self.name = name
+        self.addr = addr
+        self.outbound = OutboundQueue()
+        self.client_id = next(_client_ids)
+        self.room = None  # Set once the client has joined a room
+        self.window = None  # Negotiated "resume1": ResumeWindow of recent sends
+        self.detached = False  # Connection lost, waiting for the client to resume
+        self.successor = None  # Session that resumed this one on a new connection
+        self.closing = False  # Client said goodbye (MSG_DISCONNECT)
+        self.compact = False  # Negotiated "bin1": gets MSG_CHAT_BIN instead of formatted text
+        self.known_senders = set()  # Sender ids whose names this compact client already has
+        self.deflater = None  # Negotiated "zlib": FrameDeflater for outgoing writes
+        self.inflater = FrameInflater()
+        self.heartbeat = False  # Negotiated "ping1"
+        self.last_seen = time.monotonic()  # Last time anything arrived from the client
+        # Per-client traffic; each is only written by this client's reader or writer.
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+
+    def _count_written(self, batch, data):
+        self.messages_out += len(batch)
+        self.bytes_out += len(data)
+        metrics.inc("messages_out", len(batch))
+        metrics.inc("bytes_out", len(data))
+        metrics.inc("socket_writes")
+
+    def _should_coalesce(self, batch):
+        return SEND_MODE == "throughput" and sum(map(len, batch)) < SEND_COALESCE_BYTES
+
+    def start(self):
+        threading.Thread(target=self._writer_loop, daemon=True).start()
+
+    def send(self, data):
+        # Queue an encoded frame. Returns False if the client can't keep up or is gone.
+        return self._enqueue(data, True)
+
+    def _enqueue(self, data, can_block):
+        if self.window is None:
+            return self.outbound.put(data, can_block)
+        with self.window.lock:
+            if self.successor is None:
+                data = self.window.stamp(data)
+                if self.detached:
+                    return True  # Kept in the window until the client resumes
+                return self.outbound.put(data, can_block)
+        return self.successor.send(data)  # Sent to the old connection after a resume
+
+    def close(self):
+        # Flush what is already queued, then close the connection.
+        self.outbound.close()
+
+    def abort(self):
+        # Drop queued data and break the connection now (also unblocks a stuck sendall/recv).
+        self.outbound.close(discard=True)
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def socket(self):
+        return self.conn
+
+    def _writer_loop(self):
+        try:
+            while True:
+                batch = self.outbound.get_batch()
+                if not batch:
+                    break
+                if self._should_coalesce(batch):
+                    time.sleep(SEND_COALESCE_WINDOW)
+                    batch += self.outbound.take_batch()
+                data = b"".join(batch)
+                if self.deflater:
+                    data = self.deflater.wrap(data)
+                self.conn.sendall(data)
+                self._count_written(batch, data)
+        except OSError as e:
+            debug("Writer for %s (%s) stopped: %s", self.name, self.addr, e)
+        finally:
+            self.outbound.close(discard=True)
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)  # Wakes the reader blocked in recv()
+            except OSError:
+                pass
+            self.conn.close()
+
+# --- Timers & heartbeats ---
+
+class _Timer:
+    __slots__ = ("callback", "args", "rounds", "cancelled")
+
+    def __init__(self, callback, args, rounds):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.cancelled = False
+
+class TimerWheel:
+    """Hashed timing wheel: every timer of the process on one thread.
+
+    A timer is put in the slot its deadline falls in, together with the
+    number of full turns it still has to wait; each tick visits only the
+    current slot. Scheduling and cancelling are O(1) and there is no thread
+    per timer, however many connections are being watched. Deadlines are
+    rounded up to the next tick, and callbacks must not block.
+    """
+
+    def __init__(self, tick=TIMER_TICK, slots=TIMER_SLOTS):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, delay, callback, *args):
+        ticks = max(1, int(-(-delay // self.tick)))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="timer-wheel", daemon=True)
+                self._thread.start()
+            timer = _Timer(callback, args, (ticks - 1) // len(self._slots))
+            self._slots[(self._cursor + ticks) % len(self._slots)].append(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer:
+            timer.cancelled = True  # Dropped when its slot comes round
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(slot) for slot in self._slots)
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)  # Behind schedule: catch up without sleeping
+            with self._lock:
+                self._cursor = (self._cursor + 1) % len(self._slots)
+                due, waiting = [], []
+                for timer in self._slots[self._cursor]:
+                    if timer.cancelled:
+                        continue
+                    if timer.rounds:
+                        timer.rounds -= 1
+                        waiting.append(timer)
+                    else:
+                        due.append(timer)
+                self._slots[self._cursor] = waiting
+            for timer in due:
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    debug("Timer callback %s failed: %s", timer.callback.__name__, e)
+
+timer_wheel = TimerWheel()
+PING_FRAME = encode_frame(MSG_PING)
+PONG_FRAME = encode_frame(MSG_PONG)
+
+def _enable_keepalive(sock):
+    # For peers without "ping1": let TCP notice a vanished peer with the heartbeat timings.
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(HEARTBEAT_INTERVAL))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, int(HEARTBEAT_INTERVAL))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+                            max(1, int((HEARTBEAT_TIMEOUT - HEARTBEAT_INTERVAL) // HEARTBEAT_INTERVAL)))
+    except OSError as e:
+        debug("Could not enable TCP keepalive: %s", e)
+
+def _heartbeat(session):
+    # Runs every HEARTBEAT_INTERVAL on the timer wheel while the session's connection is open.
+    if session.outbound.closed:
+        return
+    idle = time.monotonic() - session.last_seen
+    if idle > HEARTBEAT_TIMEOUT:
+        metrics.inc("heartbeat_timeouts")
+        debug("No data from %s (%s) for %.0fs, closing the connection", session.name, session.addr, idle)
+        session.abort()  # The reader wakes up and drops (or holds) the session as usual
+        return
+    if idle >= HEARTBEAT_INTERVAL:
+        session.outbound.put(PING_FRAME, False)  # Not stamped: pings aren't replayed on resume
+    timer_wheel.schedule(HEARTBEAT_INTERVAL, _heartbeat, session)
+
+def _handshake_expired(abort, addr):
+    metrics.inc("handshake_timeouts")
+    debug("No handshake from %s within %ss, closing", addr, HANDSHAKE_TIMEOUT)
+    abort()
+
+def _shutdown_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+# --- Connection admission ---
+
+class HandshakeGate:
+    """Decides right after accept() whether a new connection gets served.
+
+    Turned-away connections are reset and closed before any thread, task or
+    session exists for them, so a flood costs little more than the accept()
+    itself. Admitted connections count against HANDSHAKE_CONCURRENCY until
+    handshake_done() is called for them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()  # address -> [tokens, time.monotonic() of last refill]
+        self._loopback = [HANDSHAKE_BURST, time.monotonic()]  # Shared by loopback peers, drained by wrong codes only
+        self.in_progress = 0
+
+    @staticmethod
+    def _refill(bucket, now):
+        bucket[0] = min(HANDSHAKE_BURST, bucket[0] + (now - bucket[1]) * HANDSHAKE_RATE)
+        bucket[1] = now
+        return bucket
+
+    def _bucket(self, address, now):
+        # Call with the lock held. Refills the bucket and marks the address recently seen.
+        bucket = self._refill(self._buckets.pop(address, None) or [HANDSHAKE_BURST, now], now)
+        self._buckets[address] = bucket
+        if len(self._buckets) > HANDSHAKE_TRACKED_ADDRESSES:
+            self._buckets.popitem(last=False)
+        return bucket
+
+    @staticmethod
+    def _is_loopback(address):
+        # Behind the ngrok tunnel every client arrives from loopback.
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return ip.is_loopback or bool(ip.version == 6 and ip.ipv4_mapped and ip.ipv4_mapped.is_loopback)
+
+    def admit(self, conn, addr):
+        # Returns False after closing conn if it must be turned away.
+        with self._lock:
+            if self.in_progress >= HANDSHAKE_CONCURRENCY:
+                refused = "handshakes_shed"
+            else:
+                refused = None
+                if HANDSHAKE_RATE and not self._is_loopback(addr[0]):
+                    bucket = self._bucket(addr[0], time.monotonic())
+                    if bucket[0] < 1:
+                        refused = "handshakes_throttled"
+                    else:
+                        bucket[0] -= 1
+                if not refused:
+                    self.in_progress += 1
+                    return True
+        metrics.inc(refused)
+        debug_sampled(refused, "Turned away connection from %s (%s)", addr, refused)
+        try:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))  # RST, no TIME_WAIT
+        except OSError:
+            pass
+        conn.close()
+        return False
+
+    def done(self):
+        with self._lock:
+            self.in_progress -= 1
+
+    def check_auth(self, addr, auth_ok):
+        # Why an auth packet is refused, or None to accept it. A wrong code
+        # takes HANDSHAKE_FAILURE_COST more tokens from the address's bucket
+        # (down to -HANDSHAKE_BURST). Loopback peers can't be told apart, so
+        # they share one bucket that only wrong codes drain, by 1 +
+        # HANDSHAKE_FAILURE_COST; while it is empty no code from loopback is
+        # checked at all, so guessing through the tunnel stays slow.
+        if not HANDSHAKE_RATE:
+            return None if auth_ok else "[X] Auth Failed."
+        with self._lock:
+            now = time.monotonic()
+            if not self._is_loopback(addr[0]):
+                if not auth_ok:
+                    bucket = self._bucket(addr[0], now)
+                    bucket[0] = max(-HANDSHAKE_BURST, bucket[0] - HANDSHAKE_FAILURE_COST)
+            elif self._refill(self._loopback, now)[0] < 1:
+                auth_ok = None
+            elif not auth_ok:
+                self._loopback[0] -= 1 + HANDSHAKE_FAILURE_COST
+        if auth_ok is None:
+            metrics.inc("handshakes_throttled")
+            debug_sampled("handshakes_throttled", "Not checking auth from %s: too many wrong codes", addr)
+            return "[X] Too many failed attempts, try again shortly."
+        return None if auth_ok else "[X] Auth Failed."
+
+handshake_gate = HandshakeGate()
+
+def handshake_done(deadline):
+    # The connection has sent its auth packet (or died trying): stop its
+    # handshake deadline and free its place in the gate. Returns None, for
+    # `deadline = handshake_done(deadline)`; calling it again is a no-op.
+    if deadline:
+        timer_wheel.cancel(deadline)
+        handshake_gate.done()
+    return None
+
+# --- Network & Chat logic ---
+
+def broadcast(message, sender_conn, msg_type=MSG_CHAT, compact=None, federate=True, room=DEFAULT_ROOM, to=None):
+    # compact: (sender_id, sender_name, unix_time, body) of a chat line, used to
+    # build the MSG_CHAT_BIN form for clients that negotiated "bin1".
+    # federate=False for messages that came in over a trunk.
+    # to: a screen name; the message then goes only to clients by that name.
+    sender_id = sender_conn.client_id if sender_conn else None
+    if federate and federation:
+        federation.publish(message, msg_type, compact, room, to)
+    if shard_bus:
+        # Sharded host: the bus orders the message and hands it back to every
+        # worker (this one included), which then delivers it locally.
+        shard_bus.publish(message, sender_id, msg_type, compact, room, to)
+        return
+    deliver_local(message, sender_id, msg_type, compact, room, to)
+
+def deliver_local(message, sender_id, msg_type=MSG_CHAT, compact=None, room=DEFAULT_ROOM, to=None):
+    # Send a message to the members of a room connected to this process (or,
+    # with to=, the clients by that name), except sender_id.
+    started = time.perf_counter()
+    data = encode_frame(msg_type, message)  # Encode once for every recipient
+    compact_data = member_data = None
+    with clients_lock:
+        metrics.clients_lock_wait.observe(time.perf_counter() - started)
+        if to is not None:
+            members = names.get(to, {})  # Direct messages are not logged
+        else:
+            members = rooms.get(room, {})
+            # Logged under the roster lock so a joining client either gets this
+            # message from history replay or live, never both or neither.
+            log = _room_log(room)
+            if log:
+                log.append(data)
+        recipients = [client for client in members.values() if client.client_id != sender_id]  # Snapshot of the roster
+    if compact and to is None and SEARCH_ENABLED:
+        search_index.add(room, compact[1], compact[2], compact[3])
+    debug_sampled("broadcast", "Broadcasting to %s clients: %s", len(recipients), message)
+
+    for client in recipients:
+        payload = data
+        if compact and client.compact:
+            if compact_data is None:  # Also encoded once, on first use
+                compact_data = encode_chat_bin(compact[0], compact[2], compact[3])
+                member_data = encode_member(compact[0], compact[1])
+            payload = compact_data
+            if compact[0] not in client.known_senders:
+                client.known_senders.add(compact[0])
+                payload = member_data + compact_data
+        if not client.send(payload):
+            # Fell too far behind (or already gone); its reader cleans up and announces the leave.
+            debug("Outbound queue rejected message for %s, disconnecting.", client.name)
+            metrics.inc("slow_client_disconnects")
+            client.abort()
+    metrics.inc("broadcasts")
+    metrics.broadcast_fanout.observe(time.perf_counter() - started)
+
+# --- Rooms & direct messages ---
+
+ROOM_COMMANDS = ("/join", "/leave", "/rooms", "/msg", "/search")  # Handled by the host, never shown as chat
+
+def _room_log(room):
+    # History of a room, opened on first use; None without history.
+    if room == DEFAULT_ROOM or not message_log:
+        return message_log
+    log = room_logs.get(room)
+    if log is None:
+        try:
+            log = room_logs[room] = MessageLog(os.path.join(message_log.directory, "rooms", room))
+        except OSError as e:
+            debug("Failed to open history for room %s: %s", room, e)
+            return None
+        _trim_room_logs()
+    else:
+        room_logs.move_to_end(room)
+    return log
+
+def _close_room_log(room):
+    log = room_logs.pop(room, None)
+    if log:
+        log.close()
+
+def _trim_room_logs():
+    # Each open log holds two file descriptors, so only ROOM_LOGS_OPEN stay
+    # open. Rooms with members here, or clients mid-join, keep theirs.
+    excess = len(room_logs) - ROOM_LOGS_OPEN
+    for room in list(room_logs):
+        if excess <= 0:
+            break
+        if room not in rooms and not room_joins[room]:
+            _close_room_log(room)
+            excess -= 1
+
+def _room_tag(room):
+    # Prefix for the host's pane when a message belongs to another room.
+    return "" if room == host_room else f"#{room} "
+
+def _join_room(session, room, options=None):
+    # History catch-up: the bulk is read and queued without holding the lock;
+    # only what was logged meanwhile is read under it, right before going live.
+    if shard_bus:
+        session.room = room  # A shard worker: the host has the log (see ShardBus._replay)
+        shard_bus.replay(session, room, options or {})
+        return
+    with clients_lock:
+        log = _room_log(room)
+        room_joins[room] += 1  # Keeps the log open until this client is in the room
+    replayed_upto = log.last_seq if log else 0
+    if log and server_loop:
+        # Async engine: read the bulk on a worker thread, not the event loop,
+        # and go live from the loop once it's in.
+        session.room = room
+        reading = server_loop.run_in_executor(None, log.replay_chunks, options or {}, replayed_upto)
+        reading.add_done_callback(lambda done: _finish_join(session, room, log, replayed_upto, done, deferred=True))
+        return
+    _finish_join(session, room, log, replayed_upto, log.replay_chunks(options or {}, replayed_upto) if log else [])
+
+def _finish_join(session, room, log, replayed_upto, chunks, deferred=False):
+    # Queue the replay, then whatever was logged meanwhile, and enter the room.
+    # Deferred joins skip clients that left or moved on while the replay was read.
+    try:
+        if deferred:
+            try:
+                chunks = chunks.result()
+            except Exception as e:
+                debug("History replay for %s failed: %s", session.name, e)
+                session.abort()
+                return
+        with clients_lock:
+            if deferred and (clients.get(session.client_id) is not session or session.room != room):
+                return
+        for chunk in chunks:
+            session.send(chunk)
+        with clients_lock:
+            if log and log.last_seq > replayed_upto:
+                for chunk in log.read_range(replayed_upto + 1, log.last_seq):
+                    session.send(chunk)
+            rooms.setdefault(room, {})[session.client_id] = session
+            session.room = room
+    finally:
+        with clients_lock:
+            room_joins[room] -= 1
+            if not room_joins[room]:
+                del room_joins[room]
+                if room not in rooms and room != DEFAULT_ROOM:
+                    _close_room_log(room)  # The join failed and nobody else is there
+
+def _leave_room(session):
+    # Call with clients_lock held.
+    members = rooms.get(session.room)
+    if members is not None:
+        members.pop(session.client_id, None)
+        if not members and session.room != DEFAULT_ROOM:
+            del rooms[session.room]
+            if not room_joins[session.room]:
+                _close_room_log(session.room)  # Reopened from disk if anyone joins again
+
+def _move_to_room(session, room):
+    old = session.room
+    if room == old:
+        session.send(encode_frame(MSG_SYSTEM, f"[System] You are already in #{room}."))
+        return
+    # Announced before leaving, so the log of a room this empties stays closed.
+    broadcast(f"[System] {session.name} has left #{old}.", sender_conn=session, msg_type=MSG_SYSTEM, room=old)
+    with clients_lock:
+        _leave_room(session)
+    session.send(encode_frame(MSG_SYSTEM, f"[System] You joined #{room}."))
+    _join_room(session, room)
+    broadcast(f"[System] {session.name} has joined #{room}.", sender_conn=session, msg_type=MSG_SYSTEM, room=room)
+    add_message(f"[System] {session.name} moved from #{old} to #{room}.")
+
+def room_list():
+    with clients_lock:
+        listing = ", ".join(f"#{room} ({len(members)})" for room, members in sorted(rooms.items()))
+    return f"[System] Rooms: {listing or 'none'}"
+
+def send_direct(sender_conn, sender_name, target, body):
+    # Returns the formatted message, or None if nobody by that name is known.
+    with clients_lock:
+        known = target in names
+    if not (known or target == screenName or shard_bus or (federation and federation.knows(target))):
+        return None
+    full_msg = format_chat_line(f"{sender_name} -> {target}", time.time(), body)
+    if target == screenName:
+        add_message(full_msg)
+    broadcast(full_msg, sender_conn, MSG_CHAT, to=target)
+    return full_msg
+
+def _client_command(session, text):
+    # Room and direct-message commands sent by a client. Returns False for
+    # anything else, which is then relayed as chat.
+    command, _, arg = text.partition(" ")
+    command, arg = command.lower(), arg.strip()
+    if command not in ROOM_COMMANDS:
+        return False
+    reply = None
+    if command == "/join":
+        if ROOM_NAME.fullmatch(arg):
+            _move_to_room(session, arg)
+        else:
+            reply = "[System] Usage: /join <room> (letters, digits, - and _, up to 32)"
+    elif command == "/leave":
+        _move_to_room(session, DEFAULT_ROOM)
+    elif command == "/rooms":
+        reply = room_list()
+    elif command == "/search":
+        session.send(encode_frames((MSG_SYSTEM, line) for line in search_command(arg, [session.room])))
+    else:
+        target, _, body = arg.partition(" ")
+        if not target or not body.strip():
+            reply = "[System] Usage: /msg <name> <text>"
+        else:
+            full_msg = send_direct(session, session.name, target, body)
+            if full_msg is None:
+                reply = f"[System] No user named {target}."
+            else:
+                session.send(encode_frame(MSG_CHAT, full_msg))  # The sender's copy
+    if reply:
+        session.send(encode_frame(MSG_SYSTEM, reply))
+    return True
+
+def host_command(text):
+    # The host's own /join, /leave, /rooms, /msg and /search. Returns False for anything else.
+    global host_room
+    command, _, arg = text.partition(" ")
+    command, arg = command.lower(), arg.strip()
+    if command not in ROOM_COMMANDS:
+        return False
+    if command == "/join":
+        if ROOM_NAME.fullmatch(arg):
+            host_room = arg
+            add_message(f"[System] Your messages now go to #{arg}; other rooms are shown with their #name.")
+        else:
+            add_message("[System] Usage: /join <room> (letters, digits, - and _, up to 32)")
+    elif command == "/leave":
+        host_room = DEFAULT_ROOM
+        add_message(f"[System] Back in #{DEFAULT_ROOM}.")
+    elif command == "/rooms":
+        add_message(room_list())
+    elif command == "/search":
+        for line in search_command(arg, None):  # The host sees every room, so it searches them all
+            add_message(line)
+    else:
+        target, _, body = arg.partition(" ")
+        if not target or not body.strip():
+            add_message("[System] Usage: /msg <name> <text>")
+        else:
+            full_msg = send_direct(None, screenName, target, body)
+            add_message(full_msg or f"[System] No user named {target}.")
+    return True
+
+# --- Search ---
+#
+# The host keeps an inverted index over recent chat lines: each token maps
+# to the ids of the messages containing it, oldest first, and the sender is
+# indexed as one more token. New messages are added as they are delivered.
+# Once the index passes SEARCH_MAX_BYTES (an estimate of what it holds), the
+# oldest messages are evicted; they are always at the head of their posting
+# lists, so eviction is a popleft() per token. Sharded workers each index
+# every message they deliver, so /search is answered by whichever worker the
+# client is on. Direct messages and system notices are not indexed.
+#
+#   /search <words> [from:<name>] [since:<30m|2h|1d|2024-05-01>] [until:<...>]
+
+SEARCH_ENABLED = True
+SEARCH_MAX_BYTES = 16 * 1024 * 1024
+SEARCH_RESULTS = 10  # Matches returned per /search
+SEARCH_SCAN_LIMIT = 20000  # Candidates examined per query, newest first
+SEARCH_TOKEN = re.compile(r"\w{2,40}")
+SEARCH_FILTER = re.compile(r"(from|since|until):(\S+)", re.IGNORECASE)
+SEARCH_AGE = re.compile(r"(\d+)([smhd])")
+_SENDER_PREFIX = "\0from:"  # Can't collide with a word token
+
+def _search_tokens(text):
+    return SEARCH_TOKEN.findall(text.lower())
+
+class SearchIndex:
+    """Inverted index over the most recent chat lines, bounded by max_bytes."""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes  # None: SEARCH_MAX_BYTES
+        self._lock = threading.Lock()
+        self._docs = collections.OrderedDict()  # id -> (room, sender, timestamp, text, {token: count}, cost)
+        self._postings = {}  # token -> deque of ids, oldest first
+        self._next_id = 1
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, room, sender, timestamp, text):
+        counts = collections.Counter(_search_tokens(text))
+        counts[_SENDER_PREFIX + sender.lower()] = 1
+        cost = 200 + len(text) + 80 * len(counts)  # Rough bytes held for this message
+        with self._lock:
+            doc_id = self._next_id
+            self._next_id += 1
+            self._docs[doc_id] = (room, sender, timestamp, text, counts, cost)
+            for token in counts:
+                posting = self._postings.get(token)
+                if posting is None:
+                    posting = self._postings[token] = collections.deque()
+                posting.append(doc_id)
+            self.bytes += cost
+            while self.bytes > (self.max_bytes or SEARCH_MAX_BYTES) and len(self._docs) > 1:
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        doc_id, (_, _, _, _, counts, cost) = self._docs.popitem(last=False)
+        for token in counts:
+            posting = self._postings[token]
+            posting.popleft()  # The oldest message heads every list it is in
+            if not posting:
+                del self._postings[token]
+        self.bytes -= cost
+
+    def search(self, words, sender=None, since=None, until=None, rooms=None, limit=SEARCH_RESULTS):
+        # Messages containing every word, from sender, between since and until
+        # (unix times) and in one of rooms (None: any). Returns
+        # [(room, sender, timestamp, text)], best first: words weighted by
+        # rarity (idf) times occurrences, then newest first.
+        terms = list(dict.fromkeys(token for word in words for token in _search_tokens(word)))
+        if words and not terms:
+            return []  # Only words too short to be indexed, e.g. "/search a"
+        if sender:
+            terms.append(_SENDER_PREFIX + sender.lower())
+        with self._lock:
+            postings = [self._postings.get(term) for term in terms]
+            if any(posting is None for posting in postings):
+                return []
+            total = len(self._docs)
+            weights = {term: math.log(1 + total / len(posting)) for term, posting in zip(terms, postings)}
+            # Walk the rarest list (or everything, if only filters were given) from the newest end.
+            candidates = reversed(min(postings, key=len)) if postings else reversed(self._docs)
+            best = []
+            for doc_id in itertools.islice(candidates, SEARCH_SCAN_LIMIT):
+                room, name, timestamp, text, counts, _ = self._docs[doc_id]
+                if since is not None and timestamp < since:
+                    break  # Only older messages from here on
+                if (until is not None and timestamp > until) or (rooms is not None and room not in rooms):
+                    continue
+                if not all(term in counts for term in terms):
+                    continue
+                score = sum(weight * counts[term] for term, weight in weights.items())
+                entry = (score, doc_id, (room, name, timestamp, text))
+                if len(best) < limit:
+                    heapq.heappush(best, entry)
+                elif entry > best[0]:
+                    heapq.heapreplace(best, entry)
+        return [result for _, _, result in sorted(best, reverse=True)]
+
+search_index = SearchIndex()
+
+def _parse_search_time(value):
+    # "30m", "2h", "1d" (ago) or an ISO date/time, as a unix time.
+    match = SEARCH_AGE.fullmatch(value.lower())
+    if match:
+        return time.time() - int(match.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+    return datetime.fromisoformat(value).timestamp()
+
+def search_command(arg, rooms):
+    # /search for the host (rooms=None) or a client (its room). Returns the lines to show.
+    if not SEARCH_ENABLED:
+        return ["[System] Search is turned off on this host."]
+    filters = {key.lower(): value for key, value in SEARCH_FILTER.findall(arg)}
+    words = SEARCH_FILTER.sub(" ", arg).split()
+    try:
+        since = _parse_search_time(filters["since"]) if "since" in filters else None
+        until = _parse_search_time(filters["until"]) if "until" in filters else None
+    except ValueError:
+        return ["[System] since:/until: take an age like 30m, 2h or 1d, or a date like 2024-05-01."]
+    if not words and not filters:
+        return ["[System] Usage: /search <words> [from:<name>] [since:<30m|2h|1d|date>] [until:<...>]"]
+    started = time.perf_counter()
+    results = search_index.search(words, filters.get("from"), since, until, rooms)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if not results:
+        return [f"[System] No matches for {arg!r} ({elapsed_ms:.1f} ms)."]
+    lines = [f"[System] {len(results)} best match{'es' if len(results) > 1 else ''} for {arg!r} ({elapsed_ms:.1f} ms):"]
+    for room, name, timestamp, text in results:
+        lines.append(("" if rooms else _room_tag(room)) + format_chat_line(name, timestamp, text))
+    return lines
+
+# --- File transfer ---
+#
+# /send <path> shares a file with the sender's room and /get <id> downloads
+# one. File data never goes over the chat connection: every transfer opens a
+# connection of its own whose auth packet carries a "transfer" option, and
+# after one MSG_TRANSFER reply that connection is a raw byte stream. The
+# sending side streams with socket.sendfile (os.sendfile where available, so
+# the bytes are never copied into Python), paced to TRANSFER_RATE_LIMIT.
+# Unfinished files are kept as .part files on both sides, so repeating the
+# same /send or /get carries on from where it stopped.
+#
+#   put: {"op": "put", "id": id or null, "name", "size"} -> {"id", "offset"},
+#        bytes offset..size -> {"id", "done": true}
+#   get: {"op": "get", "id", "offset"} -> {"id", "name", "size", "offset"}, bytes offset..size
+#
+# A finished upload is announced by sending MSG_TRANSFER {"id"} on the chat
+# connection, so the host posts it in the room the uploader is in.
+
+MSG_TRANSFER = 13  # Transfer reply on a data connection; upload announcement on a chat connection
+TRANSFER_COMMANDS = ("/send", "/get")  # Handled where they are typed, never shown as chat
+TRANSFER_DIR = "starchat-files"  # Host: shared files, as TRANSFER_DIR/<id>/<name>
+DOWNLOAD_DIR = "starchat-downloads"  # Client: where /get saves files
+TRANSFER_RATE_LIMIT = 2 * 1024 * 1024  # bytes/s per transfer in each direction; 0 for no cap
+TRANSFER_MAX_BYTES = 2 * 1024 ** 3
+TRANSFER_CHUNK = 256 * 1024  # bytes per sendfile() call; the pacing granularity
+TRANSFER_IDLE_TIMEOUT = 60.0  # seconds without progress before a transfer is dropped
+TRANSFER_ID = re.compile(r"[0-9a-f]{8}")
+client_uploads = {}  # (path, size) -> id the host gave the upload, so a repeated /send resumes it
+
+def _format_size(n):
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+def _safe_file_name(name):
+    # The base name of a shared file, or None if it can't be stored as one.
+    name = os.path.basename(str(name or "").replace("\\", "/")).strip()
+    if not name or name.startswith(".") or name.endswith(".part") or len(name) > 200:
+        return None
+    return name
+
+def _send_file(sock, f, offset, count, rate):
+    # Stream count bytes of f from offset, in TRANSFER_CHUNK pieces paced to rate bytes/s.
+    started = time.monotonic()
+    sent = 0
+    while sent < count:
+        n = sock.sendfile(f, offset + sent, min(TRANSFER_CHUNK, count - sent))
+        if not n:
+            raise ConnectionError("peer stopped reading")
+        sent += n
+        if rate:
+            ahead = sent / rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    return sent
+
+def _recv_file(sock, f, count):
+    # Append up to count bytes from sock to f; returns how many arrived before EOF.
+    buf = memoryview(bytearray(TRANSFER_CHUNK))
+    received = 0
+    while received < count:
+        n = sock.recv_into(buf, min(len(buf), count - received))
+        if not n:
+            break
+        f.write(buf[:n])
+        received += n
+    return received
+
+def _recv_exact(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+def _recv_one_frame(sock):
+    # Reads exactly one frame, leaving any raw bytes behind it in the socket.
+    frame_version, msg_type, length = FRAME_HEADER.unpack(_recv_exact(sock, FRAME_HEADER.size))
+    if frame_version != PROTOCOL_VERSION or length > MAX_FRAME_SIZE:
+        raise ProtocolError("malformed transfer reply")
+    return msg_type, _recv_exact(sock, length)
+
+def _shared_file(transfer_id):
+    # (path, name, size) of a finished shared file, or None.
+    if not TRANSFER_ID.fullmatch(str(transfer_id)):
+        return None
+    folder = os.path.join(TRANSFER_DIR, transfer_id)
+    try:
+        done = [entry for entry in os.listdir(folder) if not entry.endswith(".part")]
+        if len(done) != 1:
+            return None
+        path = os.path.join(folder, done[0])
+        return path, done[0], os.path.getsize(path)
+    except OSError:
+        return None
+
+def _announce_file(sender_name, room, transfer_id, shared):
+    _, file_name, size = shared
+    msg = f"[System] {sender_name} shared {file_name} ({_format_size(size)}). Type /get {transfer_id} to download it."
+    add_message(_room_tag(room) + msg)
+    # Not federated: the file can only be fetched from this host.
+    broadcast(msg, sender_conn=None, msg_type=MSG_SYSTEM, federate=False, room=room)
+
+def _announce_upload(session, payload):
+    # MSG_TRANSFER on a chat connection: the client finished an upload.
+    try:
+        transfer_id = str(json.loads(payload)["id"])
+    except (ValueError, KeyError, TypeError):
+        return
+    shared = _shared_file(transfer_id)
+    if shared:
+        _announce_file(session.name, session.room, transfer_id, shared)
+
+def serve_transfer(conn, addr, sender, request):
+    # Runs one data connection to the end (blocking); the caller closes conn.
+    conn.settimeout(TRANSFER_IDLE_TIMEOUT)
+    try:
+        if request.get("op") == "put":
+            _receive_upload(conn, addr, sender, request)
+        elif request.get("op") == "get":
+            _send_download(conn, addr, sender, request)
+        else:
+            conn.sendall(encode_frame(MSG_ERROR, "[X] Unknown transfer."))
+    except (OSError, ValueError, TypeError) as e:
+        debug("Transfer with %s (%s) ended early: %s", sender, addr, e)
+
+def _receive_upload(conn, addr, sender, request):
+    file_name = _safe_file_name(request.get("name"))
+    size = request.get("size")
+    if not file_name or not isinstance(size, int) or not 0 <= size <= TRANSFER_MAX_BYTES:
+        conn.sendall(encode_frame(MSG_ERROR, f"[X] Files need a plain name and at most {_format_size(TRANSFER_MAX_BYTES)}."))
+        return
+    transfer_id = str(request.get("id"))
+    part = os.path.join(TRANSFER_DIR, transfer_id, file_name + ".part")
+    if not (TRANSFER_ID.fullmatch(transfer_id) and os.path.isfile(part)):
+        transfer_id = os.urandom(4).hex()
+        os.makedirs(os.path.join(TRANSFER_DIR, transfer_id))
+        part = os.path.join(TRANSFER_DIR, transfer_id, file_name + ".part")
+    with open(part, "ab") as f:
+        offset = f.tell()
+        if offset > size:  # Not the same file after all
+            f.truncate(0)
+            offset = 0
+        conn.sendall(encode_frame(MSG_TRANSFER, json.dumps({"id": transfer_id, "offset": offset})))
+        received = _recv_file(conn, f, size - offset)
+    metrics.inc("transfer_bytes_in", received)
+    if offset + received < size:
+        debug("Upload %s from %s stopped at %s of %s bytes", transfer_id, sender, offset + received, size)
+        return
+    os.replace(part, os.path.join(TRANSFER_DIR, transfer_id, file_name))
+    metrics.inc("transfers_completed")
+    conn.sendall(encode_frame(MSG_TRANSFER, json.dumps({"id": transfer_id, "done": True})))
+    add_message(f"[System] Received {file_name} ({_format_size(size)}) from {sender}.")
+
+def _send_download(conn, addr, sender, request):
+    transfer_id = str(request.get("id"))
+    shared = _shared_file(transfer_id)
+    if not shared:
+        conn.sendall(encode_frame(MSG_ERROR, f"[X] No shared file with id {transfer_id}."))
+        return
+    path, file_name, size = shared
+    offset = request.get("offset")
+    offset = offset if isinstance(offset, int) and 0 <= offset <= size else 0
+    with open(path, "rb") as f:
+        conn.sendall(encode_frame(MSG_TRANSFER, json.dumps(
+            {"id": transfer_id, "name": file_name, "size": size, "offset": offset})))
+        sent = _send_file(conn, f, offset, size - offset, TRANSFER_RATE_LIMIT)
+    metrics.inc("transfer_bytes_out", sent)
+    metrics.inc("transfers_completed")
+    debug("Sent %s to %s (%s), %s bytes from offset %s", file_name, sender, addr, sent, offset)
+
+def share_host_file(path):
+    # The host's /send: the file is linked into TRANSFER_DIR, not copied.
+    path = os.path.abspath(os.path.expanduser(path))
+    file_name = _safe_file_name(path)
+    if not os.path.isfile(path) or not file_name:
+        add_message(f"[Error] Can't share {path}: not a file with a plain name.")
+        return
+    transfer_id = os.urandom(4).hex()
+    target = os.path.join(TRANSFER_DIR, transfer_id, file_name)
+    try:
+        os.makedirs(os.path.dirname(target))
+        try:
+            os.symlink(path, target)
+        except OSError:
+            shutil.copyfile(path, target)  # e.g. Windows without symlink rights
+    except OSError as e:
+        add_message(f"[Error] Can't share {path}: {e}")
+        return
+    _announce_file(screenName, host_room, transfer_id, (target, file_name, os.path.getsize(path)))
+
+def _open_transfer(request):
+    # Client: open a data connection for request. Returns (socket, reply).
+    sock = socket.create_connection(server_address, timeout=TRANSFER_IDLE_TIMEOUT)
+    try:
+        if _recv_one_frame(sock) != (MSG_HELLO, b"Mayday"):
+            raise ConnectionError("Server did not send expected greeting.")
+        sock.sendall(encode_frame(MSG_AUTH, json.dumps([auth, screenName, {"transfer": request}])))
+        msg_type, payload = _recv_one_frame(sock)
+        if msg_type == MSG_ERROR:
+            raise ConnectionError(_decode_text(payload).removeprefix("[X] ").rstrip("."))
+        if msg_type != MSG_TRANSFER:
+            raise ProtocolError(f"expected transfer reply, got type {msg_type}")
+        return sock, json.loads(payload)
+    except BaseException:
+        sock.close()
+        raise
+
+def _client_upload(path):
+    path = os.path.abspath(os.path.expanduser(path))
+    file_name = _safe_file_name(path)
+    key = None
+    try:
+        size = os.path.getsize(path)
+        if not file_name:
+            raise ValueError("files need a plain name")
+        key = (path, size)
+        with open(path, "rb") as f:
+            sock, reply = _open_transfer({"op": "put", "id": client_uploads.get(key), "name": file_name, "size": size})
+            with sock:
+                client_uploads[key] = reply["id"]
+                offset = reply["offset"]
+                add_message(f"[System] Sending {file_name} ({_format_size(size)})"
+                            + (f", resuming at {_format_size(offset)}..." if offset else "..."))
+                metrics.inc("transfer_bytes_out", _send_file(sock, f, offset, size - offset, TRANSFER_RATE_LIMIT))
+                msg_type, payload = _recv_one_frame(sock)
+        if msg_type != MSG_TRANSFER or not json.loads(payload).get("done"):
+            raise ProtocolError("upload was not confirmed")
+    except (OSError, ConnectionError, ProtocolError, ValueError) as e:
+        resume_hint = " Run the same /send to resume." if client_uploads.get(key) else ""
+        add_message(f"[Error] Sending {file_name or path} failed: {e}.{resume_hint}")
+        debug("Upload of %s failed: %s", path, e)
+        return
+    client_uploads.pop(key, None)
+    metrics.inc("transfers_completed")
+    client_send(encode_frame(MSG_TRANSFER, json.dumps({"id": reply["id"]})))
+
+def _client_download(transfer_id):
+    part = os.path.join(DOWNLOAD_DIR, f"{transfer_id}.part")
+    try:
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        with open(part, "ab") as f:
+            sock, reply = _open_transfer({"op": "get", "id": transfer_id, "offset": f.tell()})
+            with sock:
+                size, offset = reply["size"], reply["offset"]
+                file_name = _safe_file_name(reply["name"]) or transfer_id
+                if offset != f.tell():
+                    f.truncate(offset)
+                add_message(f"[System] Downloading {file_name} ({_format_size(size)})"
+                            + (f", resuming at {_format_size(offset)}..." if offset else "..."))
+                received = _recv_file(sock, f, size - offset)
+        metrics.inc("transfer_bytes_in", received)
+        if offset + received < size:
+            raise ConnectionError(f"connection closed at {_format_size(offset + received)}")
+        target = os.path.join(DOWNLOAD_DIR, file_name)
+        if os.path.exists(target):
+            target = os.path.join(DOWNLOAD_DIR, f"{transfer_id}-{file_name}")
+        os.replace(part, target)
+    except (OSError, ConnectionError, ProtocolError, ValueError, KeyError) as e:
+        partial = os.path.exists(part) and os.path.getsize(part) > 0
+        if os.path.exists(part) and not partial:
+            os.remove(part)  # Nothing to resume from
+        resume_hint = " Run the same /get to resume." if partial else ""
+        add_message(f"[Error] Download of {transfer_id} failed: {e}.{resume_hint}")
+        debug("Download of %s failed: %s", transfer_id, e)
+        return
+    metrics.inc("transfers_completed")
+    add_message(f"[System] Saved {file_name} to {target}")
+
+def transfer_command(text):
+    # /send <path> and /get <id>, typed by the host or a client.
+    command, _, arg = text.partition(" ")
+    command, arg = command.lower(), arg.strip()
+    if not arg:
+        add_message("[System] Usage: /send <path> or /get <id>")
+    elif is_server and command == "/send":
+        share_host_file(arg)
+    elif is_server:
+        shared = _shared_file(arg)
+        add_message(f"[System] {shared[1]} is at {os.path.realpath(shared[0])}" if shared
+                    else f"[System] No shared file with id {arg}.")
+    elif not server_address:
+        add_message("[Error] Not connected to a server.")
+    else:
+        # Transfers run on their own threads and connections; chat carries on meanwhile.
+        worker = _client_upload if command == "/send" else _client_download
+        threading.Thread(target=worker, args=(arg,), daemon=True).start()
+
+def _check_handshake(frames):
+    # Parse the client's auth packet, JSON [auth, screenName, {options}] (options optional).
+    # Returns (auth_ok, clientScreenName, options).
+    if not frames:
+        raise ConnectionError("client closed the connection during handshake")
+    msg_type, payload = frames[0]
+    if msg_type != MSG_AUTH:
+        raise ProtocolError(f"expected auth frame, got type {msg_type}")
+    infoPack = json.loads(payload)
+    tempauth = int(infoPack[0])
+    options = infoPack[2] if len(infoPack) > 2 and isinstance(infoPack[2], dict) else {}
+    for key in ("history", "since"):
+        # History replay reads these while the client is being registered.
+        value = options.get(key)
+        if key in options and not (isinstance(value, (int, float)) and not isinstance(value, bool)
+                                   and math.isfinite(value)):
+            debug("Ignoring bad %s option: %r", key, value)
+            del options[key]
+    return tempauth == auth, infoPack[1], options
+
+def _negotiate_caps(session, options):
+    requested = options.get("caps") or []
+    caps = [cap for cap in WIRE_CAPS if cap in requested]
+    session.compact = "bin1" in caps
+    if "zlib" in caps:
+        session.deflater = FrameDeflater()
+    if "resume1" in caps:
+        session.window = ResumeWindow()
+    if "ping1" in caps:
+        session.heartbeat = True
+        timer_wheel.schedule(HEARTBEAT_INTERVAL, _heartbeat, session)
+    else:
+        _enable_keepalive(session.socket())
+    return caps
+
+def _welcome_info(session, caps, message, resumed=False):
+    return json.dumps({
+        "message": message,
+        "hostScreenName": screenName,
+        "clientScreenName": session.name,
+        "clientId": session.client_id,
+        "room": session.room or DEFAULT_ROOM,
+        "caps": caps,
+        "resume": session.window.token if session.window else None,
+        "resumed": resumed,
+    })
+
+def set_nodelay(sock, enabled):
+    # On, small frames leave at once instead of waiting for ACKs (Nagle). Set
+    # both ways: asyncio turns it on for every connection it makes.
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+    except OSError as e:
+        debug("Could not set TCP_NODELAY: %s", e)
+
+def _register_client(session, options=None):
+    options = options or {}
+    set_nodelay(session.socket(), SEND_MODE == "latency")
+    caps = _negotiate_caps(session, options)
+    if session.window and isinstance(options.get("resume"), dict) and _resume_client(session, options["resume"], caps):
+        return
+    metrics.inc("connections_accepted")
+    welcome_info = _welcome_info(session, caps, f"[System] Welcome to {screenName}'s Server, {session.name}!")
+    session.start()
+    session.send(encode_frame(MSG_WELCOME, welcome_info))  # Queued ahead of any broadcast
+
+    with clients_lock:
+        clients[session.client_id] = session
+        names.setdefault(session.name, {})[session.client_id] = session
+        if session.window:
+            resumable[session.window.token] = session
+        debug("Client %s (%s) connected. Current clients: %s", session.name, session.addr, len(clients))
+    _join_room(session, DEFAULT_ROOM, options)
+
+    add_message(f"[System] {session.name} connected from {session.addr}")
+    if federation:
+        federation.member_changed(session.name, True)
+    broadcast(f"[System] {session.name} has joined the chat.", sender_conn=session, msg_type=MSG_SYSTEM)
+
+def _handle_client_frames(session, frames):
+    # Process frames from a registered client. Returns False once it disconnects.
+    size = sum(FRAME_HEADER.size + len(payload) for _, payload in frames)  # As received, before inflating
+    session.messages_in += len(frames)
+    session.bytes_in += size
+    metrics.inc("messages_in", len(frames))
+    metrics.inc("bytes_in", size)
+    session.last_seen = time.monotonic()
+    for msg_type, payload in session.inflater.expand(frames):
+        if msg_type == MSG_DISCONNECT:
+            session.closing = True
+            return False
+        if msg_type == MSG_PING:
+            session.outbound.put(PONG_FRAME, False)
+        elif msg_type == MSG_PONG:
+            pass  # Arriving at all was the point
+        elif msg_type == MSG_CHAT:
+            _relay_client_message(session, _decode_text(payload))
+        elif msg_type == MSG_TRANSFER:
+            _announce_upload(session, payload)
+        else:
+            debug("Ignoring frame type %s from %s", msg_type, session.name)
+    return True
+
+def _relay_client_message(session, msg):
+    if msg.startswith("/") and _client_command(session, msg):
+        return
+    timestamp = time.time()
+    full_msg = format_chat_line(session.name, timestamp, msg)
+    add_message(_room_tag(session.room) + full_msg)
+    broadcast(full_msg, sender_conn=session, compact=(session.client_id, session.name, timestamp, msg),
+              room=session.room)
+
+def _resume_client(session, resume, caps):
+    # Move a session whose connection dropped onto this new connection and send
+    # what it missed. Returns False if that's not possible; the client then
+    # joins afresh.
+    with clients_lock:
+        old = resumable.get(resume.get("token"))
+        if old is None:
+            return False
+        with old.window.lock:
+            missed = old.window.since(int(resume.get("seq", 0)))
+            if missed is not None:
+                for attr in ("client_id", "name", "room", "compact", "known_senders", "window",
+                             "messages_in", "bytes_in", "messages_out", "bytes_out"):
+                    setattr(session, attr, getattr(old, attr))
+                welcome_info = _welcome_info(session, caps, f"[System] Welcome back, {session.name}!", resumed=True)
+                session.start()
+                session.outbound.put(encode_frame(MSG_WELCOME, welcome_info) + missed)
+                old.successor = session  # From here on, sends to the old session go to this one
+                clients[session.client_id] = session
+                rooms.get(session.room, {})[session.client_id] = session
+                names.get(session.name, {})[session.client_id] = session
+                resumable[session.window.token] = session
+        was_detached = old.detached
+    if missed is None:
+        # Too far behind for the window: end the old session for good.
+        if was_detached:
+            _unregister_client(old)
+        else:
+            old.closing = True
+            old.abort()
+        return False
+    if not was_detached:
+        old.abort()  # The old connection hadn't noticed it was dead yet
+    metrics.inc("sessions_resumed")
+    add_message(f"[System] {session.name} resumed from {session.addr}.")
+    debug("Session of %s resumed, %s bytes replayed", session.name, len(missed))
+    return True
+
+def _drop_client(session):
+    # A client's connection ended. One that can resume and didn't say goodbye
+    # is held for RESUME_TTL seconds instead of leaving right away.
+    if session.successor:
+        return
+    if session.window and not session.closing and not server_shutdown_event.is_set():
+        with session.window.lock:
+            session.detached = session.successor is None
+        if session.detached:
+            session.close()
+            add_message(f"[System] {session.name} lost connection; holding the session for {RESUME_TTL:g}s.")
+            timer_wheel.schedule(RESUME_TTL, _expire_session, session)
+        return
+    _unregister_client(session)
+
+def _expire_session(session):
+    with clients_lock:
+        expired = resumable.get(session.window.token) is session
+    if expired:
+        metrics.inc("sessions_expired")
+        _unregister_client(session)
+
+def _unregister_client(session):
+    # Only broadcast if it's not during a server shutdown (to avoid race conditions)
+    # This part assumes normal client disconnect, not server initiated shutdown
+    if session.room is not None:  # None: registration failed before the client joined a room
+        # Sent before leaving, like _move_to_room(), so an emptied room's log stays closed.
+        broadcast(f"[System] {session.name} has left the chat.", sender_conn=session, msg_type=MSG_SYSTEM,
+                  room=session.room)
+    with clients_lock:
+        if session.window and resumable.get(session.window.token) is session:
+            del resumable[session.window.token]
+        clients.pop(session.client_id, None)
+        _leave_room(session)
+        same_name = names.get(session.name)
+        if same_name is not None:
+            same_name.pop(session.client_id, None)
+            if not same_name:
+                del names[session.name]
+        debug("Client %s (%s) removed. Remaining clients: %s", session.name, session.addr, len(clients))
+
+    session.close()
+    add_message(f"[System] {session.name} disconnected.")
+    if federation:
+        federation.member_changed(session.name, False)
+
+def handle_client(conn, addr):
+    clientScreenName = "Unknown" # Initialize for finally block
+    session = trunk = None
+    decoder = FrameDecoder()
+    deadline = timer_wheel.schedule(HANDSHAKE_TIMEOUT, _handshake_expired, lambda: _shutdown_socket(conn), addr)
+    try:
+        conn.sendall(encode_frame(MSG_HELLO, b"Mayday"))
+        frames = recv_frames(conn, decoder)
+        deadline = handshake_done(deadline)
+        auth_ok, clientScreenName, options = _check_handshake(frames)
+        refusal = handshake_gate.check_auth(addr, auth_ok)
+
+        if refusal:
+            metrics.inc("connections_rejected")
+            conn.sendall(encode_frame(MSG_ERROR, refusal))
+            add_message(f"[System] Connection rejected from {addr}: {refusal[4:]}")
+            debug("Auth failed for %s. Expected: %s, Received: %s", addr, auth, frames[0][1])
+            return
+
+        if "trunk" in options:
+            refusal = federation.refusal(options["trunk"]) if federation else "Federation is not enabled on this host."
+            if refusal:
+                metrics.inc("connections_rejected")
+                conn.sendall(encode_frame(MSG_ERROR, f"[X] {refusal}"))
+                add_message(f"[System] Federation link from {addr} refused: {refusal}")
+                return
+            challenge, expected = federation.challenge(options["trunk"])
+            conn.sendall(challenge)
+            conn.settimeout(HANDSHAKE_TIMEOUT)
+            frames = frames[1:] or recv_frames(conn, decoder)
+            conn.settimeout(None)
+            refusal = federation.proof_refusal(frames, expected)
+            if refusal:
+                metrics.inc("connections_rejected")
+                conn.sendall(encode_frame(MSG_ERROR, f"[X] {refusal}"))
+                add_message(f"[System] Federation link from {addr} refused: {refusal}")
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            trunk = ClientSession(conn, clientScreenName, addr)
+            federation.attach(trunk, options["trunk"]["origin"], clientScreenName, welcome=True)
+            frames = frames[1:]
+            while federation.receive(trunk, frames):
+                frames = recv_frames(conn, decoder)
+                if not frames:
+                    break
+            return
+
+        if isinstance(options.get("transfer"), dict):
+            serve_transfer(conn, addr, clientScreenName, options["transfer"])
+            return
+
+        session = ClientSession(conn, clientScreenName, addr)
+        _register_client(session, options)
+
+        # Anything the client pipelined behind its auth packet is handled first.
+        frames = frames[1:]
+        while _handle_client_frames(session, frames):
+            frames = recv_frames(conn, decoder)
+            if not frames:
+                break
+    except Exception as e:
+        if not session:
+            metrics.inc("connections_rejected")  # Broken or bogus handshake
+        add_message(f"[Error] Connection with client {clientScreenName} ({addr}) lost: {e}")
+        debug("Error in handle_client for %s (%s): %s", clientScreenName, addr, e)
+    finally:
+        handshake_done(deadline)
+        if session:
+            _drop_client(session)  # The writer closes the socket after flushing
+        elif trunk:
+            federation.detach(trunk)
+        else:
+            conn.close()
+
+# --- Async server engine ---
+
+class AsyncClientSession(ClientSession):
+    """ClientSession whose writer is a task on the asyncio server loop.
+
+    Frames may be queued from any thread (e.g. the UI); the writer task is
+    woken through call_soon_threadsafe. Under the "block" policy only
+    threads other than the loop wait for room - the loop itself can't wait
+    for its own writer, so a full queue there disconnects the client.
+    """
+
+    def __init__(self, writer, name, addr, loop, loop_thread_id):
+        super().__init__(writer, name, addr)
+        self.loop = loop
+        self.loop_thread_id = loop_thread_id
+        self._wakeup = asyncio.Event()
+        self.outbound.on_put = self._wake_writer
+
+    def _on_loop(self):
+        return threading.get_ident() == self.loop_thread_id
+
+    def _wake_writer(self):
+        if self._on_loop():
+            self._wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    def start(self):
+        self.loop.create_task(self._writer_task())
+
+    def send(self, data):
+        return self._enqueue(data, not self._on_loop())
+
+    def abort(self):
+        self.outbound.close(discard=True)
+        if self._on_loop():
+            self.conn.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.conn.transport.abort)
+
+    def socket(self):
+        return self.conn.get_extra_info("socket")
+
+    async def _writer_task(self):
+        writer = self.conn
+        try:
+            while True:
+                batch = self.outbound.take_batch()
+                if batch:
+                    if self._should_coalesce(batch):
+                        await asyncio.sleep(SEND_COALESCE_WINDOW)
+                        batch += self.outbound.take_batch()
+                    data = b"".join(batch)
+                    if self.deflater:
+                        data = self.deflater.wrap(data)
+                    writer.write(data)
+                    self._count_written(batch, data)
+                    await writer.drain()
+                    continue
+                if self.outbound.closed:
+                    break
+                self._wakeup.clear()
+                if len(self.outbound) or self.outbound.closed:
+                    continue  # Frames arrived between take_batch() and clear()
+                await self._wakeup.wait()
+        except (OSError, ConnectionError) as e:
+            debug("Writer for %s (%s) stopped: %s", self.name, self.addr, e)
+        finally:
+            self.outbound.close(discard=True)
+            writer.close()
+
+async def handle_client_async(reader, writer, loop_thread_id):
+    addr = writer.get_extra_info("peername")
+    clientScreenName = "Unknown" # Initialize for finally block
+    session = trunk = None
+    decoder = FrameDecoder()
+    loop = asyncio.get_running_loop()
+    deadline = timer_wheel.schedule(HANDSHAKE_TIMEOUT, _handshake_expired,
+                                    lambda: loop.call_soon_threadsafe(writer.transport.abort), addr)
+    try:
+        writer.write(encode_frame(MSG_HELLO, b"Mayday"))
+        frames = await recv_frames_async(reader, decoder)
+        deadline = handshake_done(deadline)
+        auth_ok, clientScreenName, options = _check_handshake(frames)
+        refusal = handshake_gate.check_auth(addr, auth_ok)
+
+        if refusal:
+            metrics.inc("connections_rejected")
+            writer.write(encode_frame(MSG_ERROR, refusal))
+            await writer.drain()
+            add_message(f"[System] Connection rejected from {addr}: {refusal[4:]}")
+            debug("Auth failed for %s. Expected: %s, Received: %s", addr, auth, frames[0][1])
+            return
+
+        if "trunk" in options:
+            refusal = federation.refusal(options["trunk"]) if federation else "Federation is not enabled on this host."
+            if refusal:
+                metrics.inc("connections_rejected")
+                writer.write(encode_frame(MSG_ERROR, f"[X] {refusal}"))
+                await writer.drain()
+                add_message(f"[System] Federation link from {addr} refused: {refusal}")
+                return
+            challenge, expected = federation.challenge(options["trunk"])
+            writer.write(challenge)
+            frames = frames[1:] or await asyncio.wait_for(recv_frames_async(reader, decoder), HANDSHAKE_TIMEOUT)
+            refusal = federation.proof_refusal(frames, expected)
+            if refusal:
+                metrics.inc("connections_rejected")
+                writer.write(encode_frame(MSG_ERROR, f"[X] {refusal}"))
+                await writer.drain()
+                add_message(f"[System] Federation link from {addr} refused: {refusal}")
+                return
+            writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            trunk = AsyncClientSession(writer, clientScreenName, addr, asyncio.get_running_loop(), loop_thread_id)
+            federation.attach(trunk, options["trunk"]["origin"], clientScreenName, welcome=True)
+            frames = frames[1:]
+            while federation.receive(trunk, frames):
+                frames = await recv_frames_async(reader, decoder)
+                if not frames:
+                    break
+            return
+
+        if isinstance(options.get("transfer"), dict):
+            # sendfile() wants a blocking socket, so the connection moves to a thread of its own.
+            conn = writer.get_extra_info("socket").dup()
+            writer.transport.abort()
+            conn.setblocking(True)
+            threading.Thread(target=_serve_detached_transfer, args=(conn, addr, clientScreenName, options["transfer"]),
+                             daemon=True).start()
+            return
+
+        session = AsyncClientSession(writer, clientScreenName, addr, asyncio.get_running_loop(), loop_thread_id)
+        _register_client(session, options)
+
+        frames = frames[1:]
+        while _handle_client_frames(session, frames):
+            frames = await recv_frames_async(reader, decoder)
+            if not frames:
+                break
+    except Exception as e:
+        if not session:
+            metrics.inc("connections_rejected")  # Broken or bogus handshake
+        add_message(f"[Error] Connection with client {clientScreenName} ({addr}) lost: {e}")
+        debug("Error in handle_client_async for %s (%s): %s", clientScreenName, addr, e)
+    finally:
+        handshake_done(deadline)
+        if session:
+            _drop_client(session)
+        elif trunk:
+            federation.detach(trunk)
+        else:
+            writer.close()
+
+def _serve_detached_transfer(conn, addr, sender, request):
+    with conn:
+        serve_transfer(conn, addr, sender, request)
+
+async def _serve_async(server_socket, host, port):
+    global server_loop
+    loop = server_loop = asyncio.get_running_loop()
+    loop_thread_id = threading.get_ident()
+    server_socket.listen(ASYNC_BACKLOG)
+    server_socket.setblocking(False)
+    accepting = loop.create_task(_accept_async(server_socket, loop_thread_id))
+    add_message(f"[System] Server successfully started and listening on {host}:{port} (async engine)")
+    # Bridge the threading shutdown flag into the loop. A daemon thread is used
+    # (not the default executor) so it never holds up interpreter exit.
+    stop = asyncio.Event()
+    threading.Thread(target=lambda: (server_shutdown_event.wait(), loop.call_soon_threadsafe(stop.set)),
+                     daemon=True).start()
+    await stop.wait()
+    debug("Async server loop exiting due to shutdown.")
+    accepting.cancel()
+    # Give writers a moment to flush farewells so handlers end on EOF rather
+    # than being cancelled by asyncio.run().
+    pending = asyncio.all_tasks() - {asyncio.current_task()}
+    if pending:
+        await asyncio.wait(pending, timeout=1.0)
+
+async def _accept_async(server_socket, loop_thread_id):
+    # Our own accept loop rather than asyncio.start_server(), so the handshake
+    # gate sees each connection before a transport or task is made for it.
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            conn, addr = await loop.sock_accept(server_socket)
+        except OSError as e:
+            debug("Async accept error: %s", e)  # e.g. EMFILE; back off instead of spinning
+            await asyncio.sleep(0.1)
+            continue
+        if handshake_gate.admit(conn, addr):
+            loop.create_task(_serve_accepted(conn, loop_thread_id))
+
+async def _serve_accepted(conn, loop_thread_id):
+    try:
+        reader, writer = await asyncio.open_connection(sock=conn)
+    except OSError as e:
+        handshake_gate.done()
+        conn.close()
+        debug("Could not set up accepted connection: %s", e)
+        return
+    await handle_client_async(reader, writer, loop_thread_id)
+
+def run_async_server(server_socket, host, port):
+    try:
+        asyncio.run(_serve_async(server_socket, host, port))
+    except Exception as e:
+        debug("Unexpected error in async server loop: %s", e)
+    finally:
+        debug("Async server loop finished.")
+        server_socket.close()
+
+# --- Sharded server engine ---
+#
+# The host process accepts no chat clients itself. It spawns SHARD_WORKERS
+# worker processes that all listen on the chat port with SO_REUSEPORT (the
+# kernel spreads new connections across them) and runs the bus: a Unix
+# socket speaking the chat framing. Workers publish every broadcast to the
+# bus; the bus gives it a place in one global order, logs it and relays it
+# to all workers, each of which delivers it to its own clients. Workers
+# also forward their add_message() lines so the host UI shows all of them.
+# Only the host has the message log, so a worker asks it for a joining
+# client's history; the reply travels the same link as the relayed events
+# and is queued in bus order, so the client gets every message exactly once.
+# Resume windows stay per worker: a client that reconnects to a different
+# worker starts a fresh session.
+
+# Frame types used only on the bus, never on the chat port.
+MSG_BUS_HELLO = 64  # worker -> bus: JSON {"worker": n}, sent once its listener is up
+MSG_BUS_EVENT = 65  # both ways: JSON {"t": type, "m": text, "s": sender id, "c": compact, "r": room, "d": to}
+MSG_BUS_UI = 66  # worker -> bus: a line for the host's chat pane
+MSG_BUS_REPLAY = 67  # worker -> bus: JSON {"id", "r": room, "o": options}; bus -> worker: JSON {"id", "chunks": n}
+MSG_BUS_HISTORY = 68  # bus -> worker: one of the n chunks of history that follow a MSG_BUS_REPLAY reply
+
+class BusLink(ClientSession):
+    """One end of a bus connection. Queues block rather than drop, and its
+    traffic is kept out of the chat metrics."""
+
+    def __init__(self, conn, name, addr):
+        super().__init__(conn, name, addr)
+        self.outbound = OutboundQueue(SHARD_BUS_QUEUE_SIZE, "block")
+
+    def _count_written(self, batch, data):
+        pass
+
+def _bus_event(message, sender_id, msg_type, compact, room, to):
+    return encode_frame(MSG_BUS_EVENT, json.dumps(
+        {"t": msg_type, "m": message, "s": sender_id, "c": compact, "r": room, "d": to}))
+
+class ShardBus:
+    """Host side of the bus: orders, logs and relays worker broadcasts."""
+
+    def __init__(self, path):
+        self.path = path
+        self.links = {}  # worker index -> BusLink
+        self._lock = threading.Lock()  # Held while relaying, so every link sees one order
+        self._ready = threading.Condition(self._lock)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def wait_for_workers(self, count, timeout):
+        with self._ready:
+            self._ready.wait_for(lambda: len(self.links) >= count, timeout)
+            return len(self.links)
+
+    def publish(self, message, sender_id, msg_type=MSG_CHAT, compact=None, room=DEFAULT_ROOM, to=None):
+        # Broadcasts typed by the host enter the bus here.
+        self._relay(_bus_event(message, sender_id, msg_type, compact, room, to), message, msg_type, room, to,
+                    compact)
+
+    def _relay(self, frame, message, msg_type, room, to, compact):
+        with self._lock:
+            log = _room_log(room) if to is None else None
+            if log:
+                log.append(encode_frame(msg_type, message))
+            for link in self.links.values():
+                link.send(frame)
+        if compact and to is None and SEARCH_ENABLED:  # The host's own index; workers index what they deliver
+            search_index.add(room, compact[1], compact[2], compact[3])
+        metrics.inc("broadcasts")
+
+    def _replay(self, link, request):
+        # History for a client joining a room on a worker. As in _join_room(),
+        # the bulk is read without the lock and only the tail under it; the
+        # reply is queued under it too, so it lands between the events the
+        # replay covers and the ones it doesn't.
+        room = request["r"]
+        with self._lock:
+            log = _room_log(room)
+            room_joins[room] += 1  # Keeps the log open while it is read
+        try:
+            chunks = []
+            replayed_upto = 0
+            if log:
+                replayed_upto = log.last_seq
+                chunks = log.replay_chunks(request["o"], replayed_upto)
+            with self._lock:
+                if log and log.last_seq > replayed_upto:
+                    chunks += log.read_range(replayed_upto + 1, log.last_seq)
+                chunks = [chunk for chunk in chunks if len(chunk) <= MAX_FRAME_SIZE]  # Only a near-limit frame is bigger
+                link.send(encode_frame(MSG_BUS_REPLAY, json.dumps({"id": request["id"], "chunks": len(chunks)})))
+                for chunk in chunks:
+                    link.send(encode_frame(MSG_BUS_HISTORY, chunk))
+        finally:
+            with self._lock:
+                room_joins[room] -= 1
+                if not room_joins[room]:
+                    del room_joins[room]
 
-def debug(msg):
-    if DEBUG_MODE:
-        logging.debug(f"[DEBUG] {msg}")
-        print(f"[cyan][DEBUG {datetime.now().strftime('%H:%M:%S')}][/cyan] {msg}")
+    def _accept_loop(self):
+        while not server_shutdown_event.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except OSError as e:
+                debug("Shard bus accept loop exiting: %s", e)
+                break
+            threading.Thread(target=self._link_loop, args=(conn,), daemon=True).start()
 
-port = 7001
-screenName = None
-auth = None
-console = Console()
-version = "1.0.0-Launchpad"
-clients = []  # list of tuples (conn, screenName)
-clients_lock = threading.Lock()
+    def _link_loop(self, conn):
+        link = BusLink(conn, "shard", self.path)
+        link.start()
+        worker = None
+        decoder = FrameDecoder()
+        try:
+            while True:
+                frames = recv_frames(conn, decoder)
+                if not frames:
+                    break
+                for msg_type, payload in frames:
+                    if msg_type == MSG_BUS_EVENT:
+                        event = json.loads(payload)
+                        self._relay(encode_frame(MSG_BUS_EVENT, payload), event["m"], event["t"], event["r"], event["d"],
+                                    event["c"])
+                    elif msg_type == MSG_BUS_UI:
+                        add_message(_decode_text(payload))
+                    elif msg_type == MSG_BUS_REPLAY:
+                        self._replay(link, json.loads(payload))
+                    elif msg_type == MSG_BUS_HELLO:
+                        worker = json.loads(payload)["worker"]
+                        link.name = f"shard-{worker}"
+                        with self._ready:
+                            self.links[worker] = link
+                            self._ready.notify_all()
+        except Exception as e:
+            debug("Shard bus link %s failed: %s", link.name, e)
+        finally:
+            with self._lock:
+                if self.links.get(worker) is link:
+                    del self.links[worker]
+            link.close()
+            if worker is not None and not server_shutdown_event.is_set():
+                add_message(f"[Error] Shard worker {worker} disconnected.")
 
-app = None  # prompt_toolkit Application instance
-chat_output = None  # TextArea for chat output
-input_field = None  # TextArea for user input
-conn_socket = None  # For client socket
-is_server = False
+    def stop(self):
+        # Tell every worker to say goodbye to its clients and exit.
+        with self._lock:
+            links = list(self.links.values())
+        for link in links:
+            link.send(encode_frame(MSG_DISCONNECT, b""))
+            link.close()
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
 
-# --- prompt_toolkit UI setup ---
+class ShardBusClient:
+    """Worker side of the bus."""
 
-def setup_ui():
-    global chat_output, input_field, app, header
+    def __init__(self, path, worker):
+        self.worker = worker
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.link = BusLink(self.sock, "bus", path)
+        self.link.start()
+        self._joins = {}  # replay request id -> (session, room) waiting for history
+        self._join_ids = itertools.count(1)
 
-    chat_output = TextArea(style="class:output-field", scrollbar=True, wrap_lines=True, focusable=False)
-    input_field = TextArea(height=1, prompt='> ', style="class:input-field")
+    def ready(self):
+        self.link.send(encode_frame(MSG_BUS_HELLO, json.dumps({"worker": self.worker})))
 
-    # Top bar with auth and screen name
-    header = TextArea(
-        "Connected Using Client 😊",
-        style="class:header",
-        height=1,
-        focusable=False
-    )
+    def publish(self, message, sender_id, msg_type=MSG_CHAT, compact=None, room=DEFAULT_ROOM, to=None):
+        self.link.send(_bus_event(message, sender_id, msg_type, compact, room, to))
 
-    kb = KeyBindings()
+    def show(self, message):
+        # message_sink of a worker: lines for the host's chat pane.
+        self.link.send(encode_frame(MSG_BUS_UI, message))
 
-    @kb.add('enter')
-    def _(event):
-        user_text = input_field.text.strip()
-        if not user_text:
+    def replay(self, session, room, options):
+        # Ask the host for a joining client's history; the client enters the
+        # room once it arrives (see _finish_bus_join).
+        request_id = next(self._join_ids)
+        self._joins[request_id] = (session, room)
+        self.link.send(encode_frame(MSG_BUS_REPLAY, json.dumps({"id": request_id, "r": room, "o": options})))
+
+    def run(self):
+        # Deliver relayed broadcasts until the host says stop or goes away.
+        decoder = FrameDecoder()
+        reply = None  # [request id, chunks still to come, chunks] of the history being received
+        try:
+            while True:
+                frames = recv_frames(self.sock, decoder)
+                if not frames:
+                    return
+                events = []  # Relayed events and completed joins, in bus order
+                for msg_type, payload in frames:
+                    if msg_type == MSG_BUS_EVENT:
+                        events.append(json.loads(payload))
+                    elif msg_type == MSG_BUS_REPLAY:
+                        header = json.loads(payload)
+                        reply = [header["id"], header["chunks"], []]
+                    elif msg_type == MSG_BUS_HISTORY:
+                        reply[2].append(payload)
+                    if reply and len(reply[2]) == reply[1]:
+                        session, room = self._joins.pop(reply[0])
+                        events.append((session, room, reply[2]))
+                        reply = None
+                if events:
+                    if server_loop:
+                        # One hop onto the async engine's loop per read, so the
+                        # client queues are filled from their own thread.
+                        server_loop.call_soon_threadsafe(_deliver_bus_events, events)
+                    else:
+                        _deliver_bus_events(events)
+                if any(msg_type == MSG_DISCONNECT for msg_type, _ in frames):
+                    return
+        except OSError as e:
+            debug("Shard bus connection lost: %s", e)
+
+def _deliver_bus_events(events):
+    for event in events:
+        if isinstance(event, tuple):
+            _finish_bus_join(*event)
+            continue
+        compact = tuple(event["c"]) if event["c"] else None
+        deliver_local(event["m"], event["s"], event["t"], compact, event["r"], event["d"])
+
+def _finish_bus_join(session, room, chunks):
+    # A shard worker got a joining client's history: queue it, then let the
+    # client in, unless it left or moved on while waiting.
+    with clients_lock:
+        if clients.get(session.client_id) is not session or session.room != room:
             return
+        for chunk in chunks:
+            session.send(chunk)
+        rooms.setdefault(room, {})[session.client_id] = session
 
-        # Clear the input field immediately
-        input_field.text = ''
+def _shard_worker_main(worker, host, port, bus_path, settings):
+    global shard_bus, message_sink, _client_ids, HISTORY_ENABLED
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is the host's to handle
+    globals().update(settings)
+    HISTORY_ENABLED = False  # The host logs the bus order
+    _client_ids = itertools.count(worker * SHARD_ID_STRIDE + 1)  # Unique across workers
+    root, ext = os.path.splitext(LOG_FILE)
+    setup_logging(f"{root}.shard{worker}{ext}")
+    bus = ShardBusClient(bus_path, worker)
+    shard_bus = bus
+    message_sink = bus.show
+    if not start_server(host, port, SHARD_WORKER_ENGINE, ui=False, reuse_port=True):
+        return
+    bus.ready()
+    bus.run()
+    shard_bus = None  # Farewells below go straight to local clients
+    message_sink = lambda message: debug("%s", message)  # The host already announced the shutdown
+    shutdown_server()
+    time.sleep(1.0)  # Let the loop flush the farewells
 
-        # --- Handle Exit Command ---
-        if user_text.lower() == '/exit':
-            add_message("[System] Initiating shutdown...")
-            if is_server:
-                shutdown_server()
-            else:
-                shutdown_client()
-            return # Prevent further processing of the "exit" command
-        # --- End Exit Command Handling ---
+def start_sharded_server(host, port, ui=True, workers=None):
+    global shard_bus
+    workers = workers or SHARD_WORKERS
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+        report_error("[X] The sharded engine needs SO_REUSEPORT and Unix sockets; use the threaded or async engine.")
+        return False
+    bus_path = os.path.join(tempfile.gettempdir(), f"starchat-bus-{os.getpid()}.sock")
+    try:
+        shard_bus = ShardBus(bus_path)
+    except OSError as e:
+        report_error(f"[X] Failed to start server: {e}")
+        debug("Failed to open shard bus at %s: %s", bus_path, e)
+        return False
+    shard_bus.start()
+    add_message(f"[System] Server attempting to start on {host}:{port} with {workers} workers")
 
-        timestamp = datetime.now().strftime('%H:%M:%S %Y-%m-%d')
-        full_msg = f"[{timestamp}] [{screenName}]: {user_text}"
+    if ui:
+        start_ui()
 
-        if is_server:
-            add_message(full_msg)
-            broadcast(full_msg, sender_conn=None) # Server broadcasts its own message
-        else:
-            add_message(full_msg) # Client adds its own message to its display
-            try:
-                if conn_socket:
-                    conn_socket.sendall(user_text.encode())
-                else:
-                    add_message("[Error] Not connected to a server.")
-            except Exception as e:
-                add_message(f"[Error] Failed to send message: {e}")
-                debug(f"Client send error: {e}")
+    open_message_log()
+    start_metrics_exporters()
 
+    settings = {name: globals()[name] for name in SHARD_INHERITED_SETTINGS}
+    ctx = multiprocessing.get_context("spawn")  # Never fork a process that already runs threads
+    for worker in range(workers):
+        proc = ctx.Process(target=_shard_worker_main, args=(worker, host, port, bus_path, settings), daemon=True)
+        proc.start()
+        shard_processes.append(proc)
+    ready = shard_bus.wait_for_workers(workers, SHARD_START_TIMEOUT)
+    if not ready:
+        report_error(f"[X] Failed to start server: no shard worker is listening on {host}:{port}")
+        shutdown_server()
+        return False
+    add_message(f"[System] Server successfully started and listening on {host}:{port} "
+                f"(sharded engine, {ready}/{workers} workers)")
+    return True
 
-    root_container = HSplit([
-        header,
-        Frame(chat_output, title='StarChat'),
-        Frame(input_field, title='ChatBox'),
-    ])
+def stop_shard_workers(timeout=5.0):
+    shard_bus.stop()
+    deadline = time.monotonic() + timeout
+    for proc in shard_processes:
+        proc.join(max(0.0, deadline - time.monotonic()))
+        if proc.is_alive():
+            proc.terminate()
+    shard_processes.clear()
 
-    layout = Layout(root_container, focused_element=input_field)
+# --- Federation ---
+#
+# Hosts that share FEDERATION_SECRET can link into one room. A trunk is an
+# ordinary connection to the peer's chat port whose auth packet carries a
+# "trunk" option with a fresh nonce. The secret itself never goes on the
+# wire: the accepting host answers with MSG_TRUNK_PROOF carrying its own
+# nonce and an HMAC of both nonces under the secret, and the dialing host
+# only replies with its own proof once that checks out, so neither side
+# sends anything to a peer that hasn't proved it knows the secret. After
+# the welcome both ends exchange MSG_FEDERATION events. Each host stamps what it originates with its origin id and a
+# sequence number. A host keeps the highest sequence seen per origin and
+# drops anything older, forwarding new events to every other trunk. Trunks
+# are FIFO and events are forwarded in the order they were accepted, so
+# everything an origin sent before an event arrives ahead of it on any path.
+# That makes "highest seq wins" enough to suppress both duplicates and loops.
 
-    style = Style.from_dict({
-        'output-field': 'bg:#657d6e #ffffff',
-        'input-field': 'bg:#000000 #ffffff',
-        'frame.label': 'bg:#03A062 #ffffff',
-        'header': 'fg:#000000 bg:#444444 bold'
-    })
+MSG_FEDERATION = 11  # trunk only: JSON event, see Federation.receive()
+MSG_TRUNK_PROOF = 16  # trunk handshake: JSON {"origin", "host", "nonce", "proof"} from the acceptor, {"proof"} back
 
-    app = Application(layout=layout, key_bindings=kb, style=style, full_screen=True)
+def _trunk_proof(role, *parts):
+    # role ("accept" or "dial") keeps one side's proof from being reflected as the other's.
+    return hmac.new(FEDERATION_SECRET.encode(), "|".join((role,) + parts).encode(), "sha256").hexdigest()
 
-def add_message(msg: str):
-    # Thread-safe addition of message to output pane
-    if app and chat_output and app.loop: # Ensure app.loop is available
-        asyncio.run_coroutine_threadsafe(_append_message(msg), app.loop)
-    else:
-        # Fallback for messages before UI is fully set up (e.g., initial system messages)
-        print(msg)
+def _federation_frame(event):
+    return encode_frame(MSG_FEDERATION, json.dumps(event))
 
-async def _append_message(msg: str):
-    chat_output.buffer.insert_text(msg + '\n')
-    chat_output.buffer.cursor_down(count=1000)  # Scroll to bottom
+class Federation:
+    """Trunk links of this host and what it knows about the other hosts."""
 
-# --- Network & Chat logic ---
+    def __init__(self):
+        self.origin = os.urandom(6).hex()
+        self.links = {}  # session -> peer origin
+        self.peers = {}  # origin -> {"host": name, "members": set(), "version": seq, "via": session}
+        self.seen = {}  # origin -> highest sequence number accepted
+        self.sender_ids = {}  # (origin, remote sender id) -> local sender id for compact clients
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
 
-def broadcast(message, sender_conn):
-    with clients_lock:
-        to_remove = []
-        for conn, client_name in clients:
-            if conn != sender_conn:
-                try:
-                    debug(f"Broadcasting to {client_name}: {message}")
-                    conn.sendall(message.encode())
-                except Exception as e:
-                    debug(f"Error broadcasting to {client_name}: {e}")
-                    to_remove.append((conn, client_name))
-        for item in to_remove:
-            clients.remove(item)
-            add_message(f"[System] {item[1]} disconnected due to error during broadcast.")
+    def refusal(self, trunk):
+        # Why a peer's trunk request is refused before the proofs, or None to go on.
+        if not isinstance(trunk, dict) or not all(isinstance(trunk.get(key), str) for key in ("origin", "nonce")):
+            return "Malformed trunk request."
+        if trunk.get("origin") == self.origin:
+            return "Cannot link a host to itself."
+        with self._lock:
+            if trunk.get("origin") in self.links.values():
+                return "Already linked to that host."
+        return None
 
-def handle_client(conn, addr):
-    clientScreenName = "Unknown" # Initialize for finally block
-    try:
-        conn.sendall(b"Mayday")
-        data = conn.recv(1024).decode()
-        infoPack = json.loads(data)
-        tempauth = int(infoPack[0])
-        clientScreenName = infoPack[1]
+    def credentials(self, nonce):
+        return {"origin": self.origin, "host": screenName, "nonce": nonce}
 
-        if tempauth != auth:
-            conn.sendall(b"[X] Auth Failed.")
-            conn.close()
-            add_message(f"[System] Connection rejected from {addr}, invalid auth.")
-            debug(f"Auth failed for {addr}. Expected: {auth}, Received: {tempauth}")
-            return
+    def challenge(self, trunk):
+        # Accepting side: prove we know the secret, bound to the dialer's
+        # nonce. Returns (frame to send, the proof expected back).
+        nonce = os.urandom(16).hex()
+        frame = encode_frame(MSG_TRUNK_PROOF, json.dumps({
+            "origin": self.origin, "host": screenName, "nonce": nonce,
+            "proof": _trunk_proof("accept", trunk["nonce"], nonce, self.origin)}))
+        return frame, _trunk_proof("dial", nonce, trunk["nonce"], trunk["origin"])
+
+    def proof_refusal(self, frames, expected):
+        # Accepting side: why the dialer's proof is refused, or None.
+        if not frames or frames[0][0] != MSG_TRUNK_PROOF:
+            return "Expected a federation proof."
+        proof = json.loads(frames[0][1]).get("proof")
+        if not isinstance(proof, str) or not hmac.compare_digest(proof.encode(), expected.encode()):
+            return "Federation secret mismatch."
+        return None
+
+    def answer(self, nonce, payload):
+        # Dialing side: check the acceptor's proof and return ours, or raise ProtocolError.
+        reply = json.loads(payload)
+        expected = _trunk_proof("accept", nonce, str(reply.get("nonce")), str(reply.get("origin")))
+        if not hmac.compare_digest(str(reply.get("proof", "")).encode(), expected.encode()):
+            raise ProtocolError("peer could not prove it knows the federation secret")
+        return encode_frame(MSG_TRUNK_PROOF, json.dumps({"proof": _trunk_proof("dial", reply["nonce"], nonce, self.origin)}))
+
+    def attach(self, session, peer_origin, peer_host, welcome=False):
+        # Start exchanging events with a peer once its handshake is done.
+        session.outbound.maxsize = FEDERATION_QUEUE_SIZE
+        session.outbound.policy = "disconnect"
+        session.start()
+        if welcome:
+            session.send(encode_frame(MSG_WELCOME, json.dumps({"origin": self.origin, "host": screenName})))
+        with self._lock:
+            self.links[session] = peer_origin
+            # Tell the new peer everything we know about membership.
+            session.send(_federation_frame(self._own_roster()))
+            for origin, peer in self.peers.items():
+                session.send(_federation_frame(self._roster_event(origin, peer)))
+        add_message(f"[System] Federation link up with {peer_host} ({session.addr}).")
+
+    def detach(self, session):
+        with self._lock:
+            peer_origin = self.links.pop(session, None)
+            lost = [origin for origin, peer in self.peers.items() if peer["via"] is session]
+            for origin in lost:
+                peer = self.peers.pop(origin)
+                add_message(f"[System] {peer['host']} left the federation ({len(peer['members'])} members).")
+        session.close()
+        if peer_origin is not None and not server_shutdown_event.is_set():
+            add_message(f"[System] Federation link to {session.name} ({session.addr}) closed.")
+
+    def publish(self, message, msg_type=MSG_CHAT, compact=None, room=DEFAULT_ROOM, to=None):
+        # A broadcast that originated here; sent to every trunk.
+        with self._lock:
+            if not self.links:
+                return
+            frame = _federation_frame({"k": "msg", "o": self.origin, "q": next(self._seq),
+                                       "t": msg_type, "m": message, "c": compact, "r": room, "d": to})
+            self._send_all(frame, None)
+
+    def member_changed(self, name, joined):
+        # A local client joined or left.
+        with self._lock:
+            if self.links:
+                self._send_all(_federation_frame({"k": "member", "o": self.origin, "q": next(self._seq),
+                                                  "h": screenName, "n": name, "j": joined}), None)
+
+    def receive(self, session, frames):
+        # Handle frames from a trunk. Returns False once the peer disconnects.
+        for msg_type, payload in frames:
+            if msg_type == MSG_DISCONNECT:
+                return False
+            if msg_type != MSG_FEDERATION:
+                debug("Ignoring frame type %s from trunk %s", msg_type, session.name)
+                continue
+            metrics.inc("federation_in")
+            event = json.loads(payload)
+            with self._lock:
+                if event["k"] == "roster":
+                    if self._apply_roster(session, event):
+                        self._send_all(_federation_frame(event), session)
+                    continue
+                origin, seq = event["o"], event["q"]
+                if origin == self.origin or seq <= self.seen.get(origin, 0):
+                    continue  # Looped back or already arrived via another trunk
+                room = event.get("r", DEFAULT_ROOM)
+                if event["k"] == "msg" and not (isinstance(room, str) and ROOM_NAME.fullmatch(room)):
+                    debug("Dropping event for invalid room %r from trunk %s", room, session.name)
+                    continue  # Room names become history directories
+                self.seen[origin] = seq
+                self._send_all(encode_frame(MSG_FEDERATION, payload), session)
+                if event["k"] == "member":
+                    self._apply_member(session, event)
+                elif event["k"] == "msg":
+                    self._deliver(event)
+        return True
+
+    def _deliver(self, event):
+        compact = event.get("c")
+        if compact:
+            key = (event["o"], compact[0])
+            if key not in self.sender_ids:
+                self.sender_ids[key] = next(_client_ids)
+            compact = (self.sender_ids[key], compact[1], compact[2], compact[3])
+        room, to = event.get("r", DEFAULT_ROOM), event.get("d")
+        if to is None:
+            add_message(_room_tag(room) + event["m"])
+        elif to == screenName:
+            add_message(event["m"])  # A direct message for the host
+        broadcast(event["m"], None, event["t"], compact, federate=False, room=room, to=to)
+
+    def _peer(self, session, origin, host):
+        peer = self.peers.get(origin)
+        if peer is None:
+            peer = self.peers[origin] = {"host": host, "members": set(), "version": 0, "via": session}
+        peer["via"] = session
+        return peer
+
+    def _apply_member(self, session, event):
+        peer = self._peer(session, event["o"], event["h"])
+        if event["q"] > peer["version"]:
+            peer["version"] = event["q"]
+            (peer["members"].add if event["j"] else peer["members"].discard)(event["n"])
 
+    def _apply_roster(self, session, event):
+        # Returns True if the snapshot was news (and should be passed on).
+        if event["o"] == self.origin:
+            return False
+        peer = self.peers.get(event["o"])
+        if peer and (event["q"] < peer["version"] or
+                     (event["q"] == peer["version"] and peer["members"] == set(event["members"]))):
+            return False
+        peer = self._peer(session, event["o"], event["h"])
+        peer["version"] = event["q"]
+        peer["members"] = set(event["members"])
+        return True
+
+    def _own_roster(self):
         with clients_lock:
-            clients.append((conn, clientScreenName))
-            debug(f"Client {clientScreenName} ({addr}) connected. Current clients: {len(clients)}")
+            members = [client.name for client in clients.values()]
+        # Stamped with the next sequence number, so it outranks every earlier member event.
+        return {"k": "roster", "o": self.origin, "q": next(self._seq), "h": screenName, "members": members}
+
+    def _roster_event(self, origin, peer):
+        return {"k": "roster", "o": origin, "q": peer["version"], "h": peer["host"], "members": sorted(peer["members"])}
 
+    def _send_all(self, frame, source):
+        for link in self.links:
+            if link is not source:
+                if link.send(frame):
+                    metrics.inc("federation_out")
+                else:
+                    debug("Federation link %s fell behind, disconnecting.", link.name)
+                    link.abort()
 
-        welcome_info = json.dumps({
-            "message": f"[System] Welcome to {screenName}'s Server, {clientScreenName}!",
-            "hostScreenName": screenName,
-            "clientScreenName": clientScreenName
-        })
-        conn.sendall(welcome_info.encode())
-        add_message(f"[System] {clientScreenName} connected from {addr}")
-        broadcast(f"[System] {clientScreenName} has joined the chat.", sender_conn=conn)
+    def knows(self, name):
+        # Whether a client by this name is connected to some linked host.
+        with self._lock:
+            return any(name in peer["members"] for peer in self.peers.values())
 
-        while True:
-            msg = conn.recv(1024).decode()
-            if not msg or msg == "[DISCONNECT]":
+    def close(self):
+        with self._lock:
+            links = list(self.links)
+        for link in links:
+            link.send(encode_frame(MSG_DISCONNECT, b""))
+            link.close()
+
+    def describe(self):
+        # Lines for the /links command.
+        with self._lock:
+            lines = [f"[System] Federation origin {self.origin}, {len(self.links)} trunk(s)."]
+            for origin, peer in self.peers.items():
+                lines.append(f"[System]   {peer['host']} ({origin}) via {peer['via'].name}: "
+                             f"{len(peer['members'])} members {', '.join(sorted(peer['members']))}")
+        return lines
+
+def link_peer(host, port, peer_auth):
+    # Open a trunk to another host and serve it until it closes (blocking).
+    addr = (host, port)
+    try:
+        sock = socket.create_connection(addr, timeout=10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        decoder = FrameDecoder()
+        frames = recv_frames(sock, decoder)
+        if not frames or frames[0][0] != MSG_HELLO:
+            raise ProtocolError("peer did not greet with MSG_HELLO")
+        nonce = os.urandom(16).hex()
+        sock.sendall(encode_frame(MSG_AUTH, json.dumps([peer_auth, screenName, {"trunk": federation.credentials(nonce)}])))
+        frames = frames[1:]
+        for expected_type in (MSG_TRUNK_PROOF, MSG_WELCOME):
+            while not frames:
+                frames = recv_frames(sock, decoder)
+                if not frames:
+                    raise ConnectionError("peer closed the connection during handshake")
+            msg_type, payload = frames[0]
+            if msg_type != expected_type:
+                raise ProtocolError(_decode_text(payload) if msg_type == MSG_ERROR else f"unexpected frame type {msg_type}")
+            if msg_type == MSG_TRUNK_PROOF:
+                sock.sendall(federation.answer(nonce, payload))  # Nothing is sent before the peer's proof checks out
+                frames = frames[1:]
+        sock.settimeout(None)
+    except (OSError, ValueError, ProtocolError, ConnectionError) as e:
+        add_message(f"[Error] Could not link to {host}:{port}: {e}")
+        debug("Federation link to %s:%s failed: %s", host, port, e)
+        return
+    welcome = json.loads(payload)
+    trunk = ClientSession(sock, welcome["host"], addr)
+    federation.attach(trunk, welcome["origin"], welcome["host"])
+    try:
+        frames = frames[1:]
+        while federation.receive(trunk, frames):
+            frames = recv_frames(sock, decoder)
+            if not frames:
                 break
-            timestamp = datetime.now().strftime('%H:%M:%S %Y-%m-%d')
-            full_msg = f"[{timestamp}] [{clientScreenName}]: {msg}"
-            add_message(full_msg)
-            broadcast(full_msg, sender_conn=conn)
     except Exception as e:
-        add_message(f"[Error] Connection with client {clientScreenName} ({addr}) lost: {e}")
-        debug(f"Error in handle_client for {clientScreenName} ({addr}): {e}")
+        debug("Federation link to %s:%s lost: %s", host, port, e)
     finally:
-        with clients_lock:
-            clients[:] = [(c, n) for c, n in clients if c != conn]
-            debug(f"Client {clientScreenName} ({addr}) removed. Remaining clients: {len(clients)}")
+        federation.detach(trunk)
 
-        conn.close()
-        add_message(f"[System] {clientScreenName} disconnected.")
-        # Only broadcast if it's not during a server shutdown (to avoid race conditions)
-        # This part assumes normal client disconnect, not server initiated shutdown
-        broadcast(f"[System] {clientScreenName} has left the chat.", sender_conn=None)
+def link_command(text):
+    # /link <host:port> <auth> opens a trunk; /links shows the federation.
+    if not federation:
+        add_message("[Error] Federation is off; set FEDERATION_SECRET (not available with the sharded engine).")
+        return
+    parts = text.split()
+    if parts[0].lower() == "/links":
+        for line in federation.describe():
+            add_message(line)
+        return
+    try:
+        host, port = parts[1].rsplit(":", 1)
+        args = (host, int(port), int(parts[2]))
+    except (IndexError, ValueError):
+        add_message("[Error] Usage: /link <host:port> <auth>")
+        return
+    add_message(f"[System] Linking to {host}:{port}...")
+    threading.Thread(target=link_peer, args=args, daemon=True).start()
+
+def start_federation():
+    global federation
+    if not FEDERATION_SECRET:
+        return
+    federation = Federation()
+    for peer in FEDERATION_PEERS:
+        host, port, peer_auth = peer.rsplit(":", 2)
+        threading.Thread(target=link_peer, args=(host, int(port), int(peer_auth)), daemon=True).start()
 
 # Global flag to signal server shutdown
 server_shutdown_event = threading.Event()
 
-def start_server(host, port):
+def start_server(host, port, engine=None, ui=True, reuse_port=False):
+    # Returns True once the server is listening. With ui=False no prompt_toolkit
+    # app is started (benchmarks, headless hosting). reuse_port lets several
+    # shard workers listen on the same port.
     global is_server
     is_server = True
+    engine = engine or SERVER_ENGINE
+    if engine == "sharded":
+        return start_sharded_server(host, port, ui)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     try:
         server_socket.bind((host, port))
         server_socket.listen()
-        print(f"[System] Server attempting to start on {host}:{port}")
-        debug(f"Server listening on {host}:{port}")
+        add_message(f"[System] Server attempting to start on {host}:{port}")
+        debug("Server listening on %s:%s", host, port)
 
-        # Start the prompt_toolkit application in a separate thread.
-        threading.Thread(target=app.run, daemon=True).start()
-        time.sleep(0.5) # Give the UI a bit more time to fully initialize its loop
+        if ui:
+            start_ui()
 
     except Exception as e:
-        print(f"[X] Failed to start server: {e}")
-        debug(f"Failed to bind server socket: {e}")
-        return
+        report_error(f"[X] Failed to start server: {e}")
+        debug("Failed to bind server socket: %s", e)
+        return False
+
+    open_message_log()
+    start_metrics_exporters()
+    start_federation()
+
+    if engine == "async":
+        threading.Thread(target=run_async_server, args=(server_socket, host, port), daemon=True).start()
+        return True
 
     def accept_loop():
         add_message(f"[System] Server successfully started and listening on {host}:{port}")
@@ -227,44 +3271,78 @@ def start_server(host, port):
                 server_socket.settimeout(1.0) # Set a timeout to allow checking the shutdown flag
                 conn, addr = server_socket.accept()
                 server_socket.settimeout(None) # Reset timeout
-                debug(f"Accepted connection from {addr}")
+                if not handshake_gate.admit(conn, addr):
+                    continue
+                debug("Accepted connection from %s", addr)
                 threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
             except socket.timeout:
                 # Timeout occurred, check shutdown flag again
                 continue
             except OSError as e:
                 if server_shutdown_event.is_set():
-                    debug(f"Server accept loop exiting due to shutdown: {e}")
+                    debug("Server accept loop exiting due to shutdown: %s", e)
                 else:
-                    debug(f"Server accept loop error: {e}")
+                    debug("Server accept loop error: %s", e)
                 break
             except Exception as e:
-                debug(f"Unexpected error in server accept loop: {e}")
+                debug("Unexpected error in server accept loop: %s", e)
                 break
         debug("Server accept loop finished.")
         server_socket.close() # Close the server socket when the loop ends
 
     # Now start the server's accept loop in a separate thread
     threading.Thread(target=accept_loop, daemon=True).start()
+    return True
+
+def open_message_log():
+    # Open the history log and show the host what was said before the restart.
+    global message_log
+    if not HISTORY_ENABLED:
+        return
+    try:
+        message_log = MessageLog()
+    except OSError as e:
+        add_message(f"[Error] Message history disabled, could not open {HISTORY_DIR}: {e}")
+        debug("Failed to open message log: %s", e)
+        return
+    decoder = FrameDecoder()
+    for chunk in message_log.replay_chunks({}, message_log.last_seq):
+        for msg_type, payload in decoder.feed(chunk):
+            add_message(_decode_text(payload))
 
 def shutdown_server():
     debug("Initiating server shutdown process.")
     add_message("[System] Server is shutting down...")
-    broadcast("[System] Server is shutting down. Disconnecting...", sender_conn=None) # Inform clients
 
     # Signal the accept loop to stop
     server_shutdown_event.set()
 
-    # Close all client connections
+    # Inform clients and close their connections; notice and disconnect go out in one write
+    farewell = encode_frames([
+        (MSG_SYSTEM, "[System] Server is shutting down. Disconnecting..."),
+        (MSG_DISCONNECT, b""),
+    ])
     with clients_lock:
-        for conn, client_name in clients:
-            try:
-                conn.sendall(b"[DISCONNECT]")
-                conn.close()
-                add_message(f"[System] Disconnected client {client_name}.")
-            except Exception as e:
-                debug(f"Error closing connection to {client_name}: {e}")
-        clients.clear() # Clear the list
+        departing = list(clients.values())
+        clients.clear()
+        rooms.clear()
+        names.clear()
+        resumable.clear()
+    for client in departing:
+        client.send(farewell)
+        client.close()  # Writer flushes the farewell, then closes the socket
+        add_message(f"[System] Disconnected client {client.name}.")
+
+    if shard_processes:
+        stop_shard_workers()
+
+    if federation:
+        federation.close()
+
+    if message_log:
+        message_log.close()
+    for log in room_logs.values():
+        log.close()
 
     # Exit the prompt_toolkit application
     if app:
@@ -273,90 +3351,210 @@ def shutdown_server():
     # Consider sys.exit() if app.exit() doesn't terminate the program
     # sys.exit(0) # This will force exit, use with caution if other cleanup is needed
 
+def client_send(data):
+    # Send encoded frames to the server, compressed if "zlib" was negotiated.
+    with client_send_lock:
+        if client_deflater:
+            data = client_deflater.wrap(data)
+        conn_socket.sendall(data)
+    metrics.inc("messages_out")
+    metrics.inc("bytes_out", len(data))
+
+def _client_handshake(host, port, resume=None):
+    # Connect and authenticate. Returns (socket, decoder, welcome data, frames
+    # that followed the welcome); raises ConnectionError with a reason on failure.
+    global client_deflater, client_inflater
+    client_deflater = None
+    client_inflater = FrameInflater()
+    sock = socket.create_connection((host, port), timeout=10)
+    set_nodelay(sock, SEND_MODE == "latency")
+    try:
+        decoder = FrameDecoder()
+        frames = recv_frames(sock, decoder)
+        if not frames or frames[0] != (MSG_HELLO, b"Mayday"):
+            debug("Unexpected server greeting: %s", frames[:1])
+            raise ConnectionError("Server did not send expected greeting.")
+
+        options = {"caps": list(WIRE_CAPS)}
+        if resume:
+            options["resume"] = resume
+        sock.sendall(encode_frame(MSG_AUTH, json.dumps([auth, screenName, options])))
+        frames = client_inflater.expand(frames[1:] or recv_frames(sock, decoder))
+        if not frames:
+            raise ConnectionError("Server closed the connection during handshake.")
+        msg_type, response = frames[0]
+        if msg_type == MSG_ERROR:
+            raise ConnectionError(_decode_text(response))
+        try:
+            welcome_data = json.loads(response)
+        except json.JSONDecodeError:
+            raise ConnectionError(f"Failed to parse welcome message from server: {response}")
+        if "zlib" in welcome_data.get("caps", []):
+            client_deflater = FrameDeflater()
+        sock.settimeout(None)
+        return sock, decoder, welcome_data, frames[1:]
+    except BaseException:
+        sock.close()
+        raise
+
+def _apply_welcome(welcome_data):
+    global resume_token, client_last_seq
+    add_message(welcome_data['message'])
+    debug("Received welcome message: %s", welcome_data['message'], caps=welcome_data.get("caps"))
+    resume_token = welcome_data.get("resume")
+    if not welcome_data.get("resumed"):
+        client_last_seq = 0
+        member_names.clear()
+        member_names[HOST_CLIENT_ID] = welcome_data.get("hostScreenName", "Host")
+
 def start_client(host, port):
-    global conn_socket, is_server
+    global conn_socket, is_server, server_address
     is_server = False
-    conn_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_address = (host, port)
+    client_closing.clear()
 
     try:
-        print(f"[System] Attempting to connect to {host}:{port}...")
-        conn_socket.connect((host, port))
-        debug(f"Successfully connected to {host}:{port}")
+        rprint(f"[System] Attempting to connect to {host}:{port}...")
+        conn_socket, decoder, welcome_data, frames = _client_handshake(host, port)
+        debug("Successfully connected to %s:%s", host, port)
+    except (OSError, ConnectionError, ProtocolError) as e:
+        rprint(f"[X] Could not connect to server: {e}")
+        debug("Failed to connect to server %s:%s: %s", host, port, e)
+        return
 
-        # Start the prompt_toolkit application in a separate thread.
-        threading.Thread(target=app.run, daemon=True).start()
-        time.sleep(0.5) # Give the UI a bit more time to fully initialize its loop and app.loop
+    start_ui()
 
-    except Exception as e:
-        print(f"[X] Could not connect to server: {e}")
-        debug(f"Failed to connect to server {host}:{port}: {e}")
-        return
+    _apply_welcome(welcome_data)
+    _watch_server(conn_socket, welcome_data)
+    # Frames that arrived in the same read as the welcome are handed to the receive loop.
+    threading.Thread(target=client_receive_loop, args=(conn_socket, decoder, frames), daemon=True).start()
 
+def _handle_server_frames(frames):
+    # Display frames from the server (already inflated). Returns False once the server disconnects us.
+    global client_last_seq
+    for msg_type, payload in frames:
+        if msg_type == MSG_DISCONNECT:
+            return False
+        if msg_type in (MSG_CHAT, MSG_SYSTEM):
+            msg = _decode_text(payload)
+            add_message(msg)
+            debug_sampled("client_receive", "Client received: %s", msg)
+        elif msg_type == MSG_CHAT_BIN:
+            sender_id, timestamp, body = decode_chat_bin(payload)
+            add_message(format_chat_line(member_names.get(sender_id, f"#{sender_id}"), timestamp, body))
+            debug_sampled("client_receive", "Client received from #%s: %s", sender_id, body)
+        elif msg_type == MSG_MEMBER:
+            member_names[MEMBER_HEADER.unpack_from(payload)[0]] = _decode_text(payload[MEMBER_HEADER.size:])
+        elif msg_type == MSG_SEQ:
+            client_last_seq = SEQ_HEADER.unpack(payload)[0]
+        elif msg_type == MSG_PING:
+            client_send(PONG_FRAME)
+        elif msg_type == MSG_PONG:
+            pass
+        else:
+            debug("Ignoring frame type %s from server", msg_type)
+    return True
+
+def _receive_until_closed(conn, decoder, frames):
+    # Returns True if the server ended the session, False if the connection dropped.
+    global client_last_seen
     try:
-        greeting = conn_socket.recv(1024).decode()
-        if greeting != "Mayday":
-            print("[X] Server did not send expected greeting. Disconnecting.")
-            debug(f"Unexpected server greeting: {greeting}")
-            conn_socket.close()
-            return
+        while _handle_server_frames(frames):
+            frames = recv_frames(conn, decoder)
+            if not frames:
+                if not client_closing.is_set():
+                    add_message("[System] Connection to server lost.")
+                return False
+            client_last_seen = time.monotonic()
+            metrics.inc("messages_in", len(frames))
+            metrics.inc("bytes_in", sum(FRAME_HEADER.size + len(payload) for _, payload in frames))
+            frames = client_inflater.expand(frames)
+        add_message("[System] Disconnected from server.")
+        return True
+    except OSError as e:
+        if not client_closing.is_set():
+            add_message(f"[System] Connection to server lost: {e}")
+        debug("Client socket error: %s", e)
+        return False
+    finally:
+        conn.close()
 
-        auth_info = json.dumps([auth, screenName])
-        conn_socket.sendall(auth_info.encode())
-        response = conn_socket.recv(1024).decode()
+def _watch_server(conn, welcome_data):
+    # Start heartbeats on a new connection if the server speaks "ping1".
+    global client_last_seen
+    client_last_seen = time.monotonic()
+    if "ping1" in welcome_data.get("caps", []):
+        timer_wheel.schedule(HEARTBEAT_INTERVAL, _client_heartbeat, conn)
 
+def _client_heartbeat(conn):
+    # Timer wheel callback: ping a quiet server, and cut the connection once it
+    # has been silent for HEARTBEAT_TIMEOUT so the receive loop reconnects.
+    if conn is not conn_socket or client_closing.is_set():
+        return  # Replaced by a reconnect, or quitting
+    idle = time.monotonic() - client_last_seen
+    if idle > HEARTBEAT_TIMEOUT:
+        metrics.inc("heartbeat_timeouts")
+        add_message(f"[System] No reply from the server for {idle:.0f}s.")
+        _shutdown_socket(conn)
+        return
+    if idle >= HEARTBEAT_INTERVAL:
         try:
-            welcome_data = json.loads(response)
-            add_message(welcome_data['message'])
-            debug(f"Received welcome message: {welcome_data['message']}")
-        except json.JSONDecodeError:
-            print(f"[X] Failed to parse welcome message from server: {response}")
-            conn_socket.close()
-            return
-        except Exception as e:
-            print(f"[X] Error processing welcome message: {e}")
-            debug(f"Error processing welcome message: {e}")
-            conn_socket.close()
-            return
+            client_send(PING_FRAME)
+        except OSError as e:
+            debug("Heartbeat send failed: %s", e)  # The receive loop sees the broken connection
+    timer_wheel.schedule(HEARTBEAT_INTERVAL, _client_heartbeat, conn)
 
-        threading.Thread(target=client_receive_loop, args=(conn_socket,), daemon=True).start()
-
-    except Exception as e:
-        print(f"[Error] Initial client setup failed: {e}")
-        debug(f"Initial client setup error: {e}")
-        if conn_socket:
-            conn_socket.close()
+def _reconnect():
+    # Resume the session with exponential backoff. Returns (socket, decoder,
+    # frames) once reconnected, or None after RECONNECT_GIVE_UP seconds.
+    global conn_socket
+    delay = RECONNECT_INITIAL_DELAY
+    deadline = time.monotonic() + RECONNECT_GIVE_UP
+    while time.monotonic() < deadline:
+        add_message(f"[System] Reconnecting in {delay:g}s...")
+        if client_closing.wait(delay):
+            return None
+        try:
+            sock, decoder, welcome_data, frames = _client_handshake(
+                *server_address, resume={"token": resume_token, "seq": client_last_seq})
+        except (OSError, ConnectionError, ProtocolError) as e:
+            debug("Reconnect to %s:%s failed: %s", *server_address, e)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            continue
+        conn_socket = sock
+        if not welcome_data.get("resumed"):
+            add_message("[System] The session had expired; joined again.")
+        _apply_welcome(welcome_data)
+        _watch_server(sock, welcome_data)
+        return sock, decoder, frames
+    add_message("[System] Could not reconnect to the server.")
+    return None
 
-def client_receive_loop(conn):
+def client_receive_loop(conn, decoder, frames):
     try:
-        while True:
-            msg = conn.recv(1024).decode()
-            if not msg or msg == "[DISCONNECT]":
-                add_message("[System] Disconnected from server.")
+        while not _receive_until_closed(conn, decoder, frames) and resume_token and not client_closing.is_set():
+            reconnected = _reconnect()
+            if not reconnected:
                 break
-            add_message(msg)
-            debug(f"Client received: {msg}")
-    except OSError as e:
-        add_message(f"[System] Connection to server lost: {e}")
-        debug(f"Client socket error: {e}")
+            conn, decoder, frames = reconnected
     except Exception as e:
         add_message(f"[Error] Unexpected error in client receive loop: {e}")
-        debug(f"Client receive loop general error: {e}")
+        debug("Client receive loop general error: %s", e)
     finally:
-        if conn:
-            conn.close()
         # If client receive loop ends, it means we're disconnected, so shut down the client app
-        if app and not is_server: # Only auto-exit if it's a client
+        if app and not is_server and not client_closing.is_set(): # Only auto-exit if it's a client
             app.exit()
 
 def shutdown_client():
     debug("Initiating client shutdown process.")
     add_message("[System] Disconnecting from server...")
+    client_closing.set()  # No reconnecting from here on
     try:
         if conn_socket:
-            conn_socket.sendall(b"[DISCONNECT]")
+            client_send(encode_frame(MSG_DISCONNECT))
             conn_socket.close()
     except Exception as e:
-        debug(f"Error sending disconnect message or closing client socket: {e}")
+        debug("Error sending disconnect message or closing client socket: %s", e)
     finally:
         if app:
             app.exit()
@@ -366,14 +3564,14 @@ def shutdown_client():
 # --- Your original helper functions (like prepInit) ---
 
 def introScreen(version_str, screen_name_str, auth_code_str):
-    print("""
+    rprint("""
 .▄▄ · ▄▄▄▄▄ ▄▄▄· ▄▄▄   ▄▄·  ▄ .▄ ▄▄▄· ▄▄▄▄▄
 ▐█ ▀. •██  ▐█ ▀█ ▀▄ █·▐█ ▌▪██▪▐█▐█ ▀█ •██
 ▄▀▀▀█▄ ▐█.▪▄█▀▀█ ▐▀▀▄ ██ ▄▄██▀▐█▄█▀▀█  ▐█.▪
 ▐█▄▪▐█ ▐█▌·▐█ ▪▐▌▐█•█▌▐███▌██▌▐▀▐█ ▪▐▌ ▐█▌·
  ▀▀▀▀  ▀▀▀  ▀  ▀ .▀  ▀·▀▀▀ ▀▀▀ · ▀  ▀  ▀▀▀
 """)
-    print(f"""
+    rprint(f"""
 ============---------
 Version[{version_str}] - Screen Name [{screen_name_str}] - Auth Code [{auth_code_str}]
 ============---------
@@ -382,32 +3580,590 @@ Version[{version_str}] - Screen Name [{screen_name_str}] - Auth Code [{auth_code
 def prepInit(current_auth, current_screen_name, current_version):
     if current_auth is None:
         current_auth = random.randint(1000, 9999)
-        debug(f"Generated random auth code: {current_auth}")
+        debug("Generated random auth code: %s", current_auth)
 
     if current_screen_name is None or current_screen_name.strip() == "":
         while True:
             name_input = input("# Setup [ScreenName]: ").strip()
             if name_input:
                 current_screen_name = name_input
-                debug(f"User input screenName: {current_screen_name}")
+                debug("User input screenName: %s", current_screen_name)
                 break
             else:
-                print("[X] Screen Name cannot be empty. Please try again.")
+                rprint("[X] Screen Name cannot be empty. Please try again.")
 
     introScreen(current_version, current_screen_name, current_auth)
     return current_auth, current_screen_name
 
+# --- ngrok tunnel ---
+#
+# A public host's tunnel is opened on a background thread while the server
+# binds and the UI starts. An ngrok agent that is already running (e.g. one
+# left up between runs with `ngrok start --none`) is asked over its local API
+# first: a tcp tunnel it has for our port is reused, otherwise it opens one.
+# Only when no agent answers is pyngrok imported to start one for this run.
+
+NGROK_API_URL = "http://127.0.0.1:4040/api/tunnels"  # Local API of a running ngrok agent
+NGROK_API_TIMEOUT = 10.0  # Seconds; opening a tunnel includes a round trip to ngrok's servers
+
+def _ngrok_agent(method="GET", body=None, timeout=NGROK_API_TIMEOUT):
+    import urllib.request
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(NGROK_API_URL, data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+def open_tunnel(local_port):
+    # Returns the public tcp:// URL that forwards to local_port.
+    try:
+        tunnels = _ngrok_agent(timeout=1.0)["tunnels"]
+    except (OSError, ValueError, KeyError):
+        tunnels = None  # No agent running
+    if tunnels is not None:
+        for tunnel in tunnels:
+            addr = str(tunnel.get("config", {}).get("addr", ""))
+            if tunnel.get("proto") == "tcp" and addr.rsplit(":", 1)[-1] == str(local_port):
+                debug("Reusing ngrok tunnel %s", tunnel["public_url"])
+                return tunnel["public_url"]
+        created = _ngrok_agent("POST", {"name": f"starchat-{local_port}", "proto": "tcp", "addr": str(local_port)})
+        debug("ngrok agent opened %s", created["public_url"])
+        return created["public_url"]
+    from pyngrok import ngrok
+    atexit.register(ngrok.kill)
+    return ngrok.connect(local_port, "tcp").public_url
+
+def start_tunnel(local_port):
+    # Runs open_tunnel() on its own thread; the returned Future holds the URL.
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(open_tunnel(local_port))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="ngrok-tunnel", daemon=True).start()
+    return future
+
+# --- Benchmark ---
+#
+# `python starchat_cli-LAUNCHPAD.py --bench [options]` starts a headless server
+# in this process and drives it with synthetic clients that do the real
+# handshake. The clients run in a child process so their CPU time and memory
+# don't count against the server. Results are printed (or written) as JSON.
+
+def _rss_bytes(pid="self"):
+    # Current resident set size of a process (this one by default), or None if unknown.
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        if pid != "self":
+            return None
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return None
+
+def _raise_fd_limit():
+    # Thousands of sockets need more than the default 1024 descriptors on most systems.
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError) as e:
+        debug("Could not raise file descriptor limit: %s", e)
+
+def _percentiles(samples):
+    if not samples:
+        return {"p50": None, "p99": None, "max": None}
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+    return {"p50": pick(0.50), "p99": pick(0.99), "max": round(samples[-1] * 1000, 3)}
+
+class BenchStats:
+    def __init__(self):
+        self.connect_latencies = []
+        self.broadcast_latencies = []
+        self.sent = 0
+        self.received = 0
+        self.bytes_received = 0
+        self.errors = 0
+
+async def _bench_client(idx, params, stats, connected, start_sending, stop_sending, connect_slots):
+    # One synthetic client: handshake, then send at a fixed rate while reading everything.
+    decoder = FrameDecoder()
+    inflater = FrameInflater()
+    deflater = None
+    try:
+        async with connect_slots:
+            started = time.perf_counter()
+            reader, writer = await asyncio.open_connection(params["host"], params["port"])
+            frames = await recv_frames_async(reader, decoder)
+            if not frames or frames[0] != (MSG_HELLO, b"Mayday"):
+                raise ProtocolError("no Mayday greeting")
+            options = {"history": 0, "caps": params["caps"]}
+            writer.write(encode_frame(MSG_AUTH, json.dumps([params["auth"], f"bench{idx}", options])))
+            frames = inflater.expand(frames[1:] or await recv_frames_async(reader, decoder))
+            if not frames or frames[0][0] != MSG_WELCOME:
+                raise ProtocolError(f"handshake rejected: {frames[:1]}")
+            if "zlib" in json.loads(frames[0][1]).get("caps", []):
+                deflater = FrameDeflater()
+            stats.connect_latencies.append(time.perf_counter() - started)
+    except (OSError, ProtocolError) as e:
+        stats.errors += 1
+        debug("Bench client %s failed to connect: %s", idx, e)
+        connected()
+        return
+    connected()
+
+    async def read_loop():
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                return
+            stats.bytes_received += len(data)
+            now = time.perf_counter()
+            for msg_type, payload in inflater.expand(decoder.feed(data)):
+                if msg_type == MSG_CHAT:
+                    # Text chat lines arrive as "[time] [name]: bench <perf_counter at send> <padding>"
+                    body = payload.split(b"]: ", 1)[-1]
+                elif msg_type == MSG_CHAT_BIN:
+                    body = payload[CHAT_BIN_HEADER.size:]
+                else:
+                    continue
+                if body.startswith(b"bench "):
+                    stats.received += 1
+                    stats.broadcast_latencies.append(now - float(body.split(b" ", 2)[1]))
+
+    reader_task = asyncio.ensure_future(read_loop())
+    await start_sending.wait()
+    interval = 1.0 / params["rate"] if params["rate"] > 0 else None
+    padding = "x" * max(0, params["size"] - 26)
+    # Spread the clients' send times across one interval instead of sending in lockstep.
+    next_send = time.perf_counter() + (interval or 0) * (idx / max(1, params["clients"]))
+    try:
+        while interval and not stop_sending.is_set():
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            data = encode_frame(MSG_CHAT, f"bench {time.perf_counter():.6f} {padding}")
+            writer.write(deflater.wrap(data) if deflater else data)
+            stats.sent += 1
+            next_send += interval
+            await writer.drain()
+        await asyncio.sleep(params["drain"])  # Let in-flight broadcasts arrive
+        writer.write(encode_frame(MSG_DISCONNECT))
+        await writer.drain()
+    except OSError as e:
+        stats.errors += 1
+        debug("Bench client %s send error: %s", idx, e)
+    reader_task.cancel()
+    writer.close()
+
+async def _bench_clients(params, pipe):
+    stats = BenchStats()
+    start_sending = asyncio.Event()
+    stop_sending = asyncio.Event()
+    connect_slots = asyncio.Semaphore(params["connect_concurrency"])
+    pending = [params["clients"]]
+    all_connected = asyncio.Event()
+
+    def connected():
+        pending[0] -= 1
+        if pending[0] == 0:
+            all_connected.set()
+
+    tasks = [asyncio.ensure_future(_bench_client(i, params, stats, connected, start_sending,
+                                                 stop_sending, connect_slots))
+             for i in range(params["clients"])]
+    connect_started = time.perf_counter()
+    await all_connected.wait()
+    connect_phase = time.perf_counter() - connect_started
+    pipe.send("connected")  # Lets the parent sample server RSS with every client idle
+
+    start_sending.set()
+    send_started = time.perf_counter()
+    await asyncio.sleep(params["duration"])
+    stop_sending.set()
+    elapsed = time.perf_counter() - send_started
+    # An overloaded server may never catch up; don't let that hang the report.
+    _, stuck = await asyncio.wait(tasks, timeout=params["drain"] + 10)
+    for task in stuck:
+        task.cancel()
+        stats.errors += 1
+
+    return {
+        "connected": len(stats.connect_latencies),
+        "client_errors": stats.errors,
+        "connect_phase_s": round(connect_phase, 3),
+        "connect_latency_ms": _percentiles(stats.connect_latencies),
+        "broadcast_latency_ms": _percentiles(stats.broadcast_latencies),
+        "messages_sent": stats.sent,
+        "messages_delivered": stats.received,
+        "sent_per_sec": round(stats.sent / elapsed, 1),
+        "delivered_per_sec": round(stats.received / elapsed, 1),
+        "bytes_received": stats.bytes_received,
+        "bytes_per_delivered_message": round(stats.bytes_received / stats.received, 1) if stats.received else None,
+    }
+
+def _bench_clients_process(pipe, params):
+    _raise_fd_limit()
+    try:
+        pipe.send(asyncio.run(_bench_clients(params, pipe)))
+    except Exception as e:
+        pipe.send({"error": repr(e)})
+
+def _server_rss_bytes():
+    # RSS of the server: this process plus any shard workers.
+    total = _rss_bytes()
+    for proc in shard_processes:
+        rss = _rss_bytes(proc.pid)
+        if total is not None and rss is not None:
+            total += rss
+    return total
+
+def run_benchmark(args):
+    global auth, screenName, message_sink, HISTORY_ENABLED, SHARD_WORKERS, HANDSHAKE_RATE
+    _raise_fd_limit()
+    auth = random.randint(1000, 9999)
+    screenName = "bench-host"
+    message_sink = lambda msg: None  # Keep the server quiet; only the JSON report is printed
+    HISTORY_ENABLED = args.history
+    HANDSHAKE_RATE = None  # Every synthetic client comes from 127.0.0.1
+    apply_send_options(args)
+    if args.workers:
+        SHARD_WORKERS = args.workers
+    args.engine = args.engine or SERVER_ENGINE
+    args.port = args.port or 7099
+
+    params = {
+        "host": "127.0.0.1", "port": args.port, "auth": auth, "clients": args.clients,
+        "rate": args.rate, "size": args.size, "duration": args.duration, "drain": 1.0,
+        "connect_concurrency": 200, "caps": [cap for cap in args.caps.split(",") if cap],
+    }
+    # Spawn (not fork) the client process: forking after server threads start is unsafe.
+    ctx = multiprocessing.get_context("spawn")
+    parent_pipe, child_pipe = ctx.Pipe()
+    if not start_server(params["host"], args.port, args.engine, ui=False):
+        return 1
+    rss_start = _server_rss_bytes()
+    proc = ctx.Process(target=_bench_clients_process, args=(child_pipe, params), daemon=True)
+    proc.start()
+
+    rss_idle = rss_peak = None
+    result = None
+    while result is None:
+        if parent_pipe.poll(0.25):
+            msg = parent_pipe.recv()
+            if msg == "connected":
+                rss_idle = _server_rss_bytes()
+            else:
+                result = msg
+        elif not proc.is_alive():
+            result = {"error": "client process exited without a result"}
+        rss = _server_rss_bytes()
+        if rss is not None:
+            rss_peak = max(rss_peak or 0, rss)
+    proc.join(5)
+    server_metrics = metrics.snapshot(per_client=False)
+    shutdown_server()
+
+    report = {
+        "version": version,
+        "engine": args.engine,
+        "workers": SHARD_WORKERS if args.engine == "sharded" else None,
+        "clients": args.clients,
+        "rate_per_client": args.rate,
+        "message_size": args.size,
+        "duration_s": args.duration,
+        "history": args.history,
+        "caps": params["caps"],
+        "send_mode": SEND_MODE,
+        "coalesce_window_ms": SEND_COALESCE_WINDOW * 1000 if SEND_MODE == "throughput" else None,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "server_rss_bytes": {"start": rss_start, "all_connected": rss_idle, "peak": rss_peak},
+    }
+    report.update(result)
+    writes = server_metrics["counters"]["socket_writes"]
+    if writes and result.get("messages_delivered"):  # Not for sharded runs: workers keep their own counters
+        report["server_writes_per_delivered_message"] = round(writes / result["messages_delivered"], 3)
+    report["server_metrics"] = server_metrics
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    sys.stdout.write(output + "\n")
+    return 0 if "error" not in result else 1
+
+# `--startup-bench` times how long a public host takes to come up, each run in
+# a fresh interpreter: a `--daemon --public` host is started against a local
+# stand-in for the ngrok agent API that takes --tunnel-delay seconds to open
+# a tunnel, and the times until the host reports listening and reports its
+# tunnel are recorded. The first run has the stand-in open the tunnel; later
+# runs find it and reuse it, as they would with a real agent left running.
+
+class FakeNgrokAgent(http.server.BaseHTTPRequestHandler):
+    tunnels = []
+    delay = 0.0
+
+    def do_GET(self):
+        self._reply(200, {"tunnels": self.tunnels})
+
+    def do_POST(self):
+        spec = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(self.delay)  # Stands in for the round trip to ngrok's servers
+        tunnel = {"name": spec.get("name"), "proto": "tcp", "public_url": f"tcp://127.0.0.1:{spec['addr']}",
+                  "config": {"addr": f"localhost:{spec['addr']}"}}
+        self.tunnels.append(tunnel)
+        self._reply(201, tunnel)
+
+    def _reply(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def _time_process(argv, markers, timeout=30.0):
+    # Starts a fresh interpreter with argv and returns, for each marker, the
+    # seconds until a line containing it appeared on its stdout.
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, *argv], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    times = {}
+    try:
+        for line in proc.stdout:
+            for key, marker in markers.items():
+                if key not in times and marker in line:
+                    times[key] = round(time.perf_counter() - started, 4)
+            if len(times) == len(markers):
+                break
+    finally:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return times
+
+def run_startup_benchmark(args):
+    script = os.path.abspath(__file__)
+    FakeNgrokAgent.delay = args.tunnel_delay
+    agent = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeNgrokAgent)
+    threading.Thread(target=agent.serve_forever, daemon=True).start()
+    args.engine = args.engine or SERVER_ENGINE
+    args.port = args.port or 7099
+
+    with tempfile.TemporaryDirectory() as workdir:
+        config_path = os.path.join(workdir, "startup-bench.json")
+        with open(config_path, "w") as f:
+            json.dump({"settings": {"NGROK_API_URL": f"http://127.0.0.1:{agent.server_port}/api/tunnels",
+                                    "HISTORY_ENABLED": False,
+                                    "LOG_FILE": os.path.join(workdir, "starchat-debug.log")}}, f)
+        deferred = ("rich", "prompt_toolkit.application", "pyngrok.ngrok")
+        report = {
+            "version": version,
+            "engine": args.engine,
+            "tunnel_delay_s": args.tunnel_delay,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python_startup_s": _time_process(["-c", "print('up')"], {"up": "up"}).get("up"),
+            "module_import_s": _time_process(
+                ["-c", f"import runpy; runpy.run_path({script!r}); print('imported')"],
+                {"imported": "imported"}).get("imported"),
+            # What importing the UI and tunnel libraries up front would add (missing ones are skipped).
+            "deferred_imports_s": _time_process(
+                ["-c", "import importlib\nfor name in %r:\n    try: importlib.import_module(name)\n"
+                       "    except ImportError: pass\nprint('imported')" % (deferred,)],
+                {"imported": "imported"}).get("imported"),
+            "runs": [],
+        }
+        for run in range(args.runs):
+            reused = bool(FakeNgrokAgent.tunnels)
+            times = _time_process([script, "--daemon", "--public", "--config", config_path, "--port", str(args.port),
+                                   "--engine", args.engine, "--auth", "1234"],
+                                  {"listening_s": "Hosting as", "tunnel_s": "Public ngrok tunnel"})
+            report["runs"].append(dict(times, tunnel="reused" if reused else "opened"))
+    agent.shutdown()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    sys.stdout.write(output + "\n")
+    return 0 if all("tunnel_s" in run for run in report["runs"]) else 1
+
+def apply_send_options(args):
+    global SEND_MODE, SEND_COALESCE_WINDOW
+    if args.send_mode:
+        SEND_MODE = args.send_mode
+    if args.coalesce_ms is not None:
+        SEND_COALESCE_WINDOW = args.coalesce_ms / 1000
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="StarChat CLI. Run without options for the interactive chat.")
+    server = parser.add_argument_group("server (--daemon and --bench)")
+    server.add_argument("--engine", choices=SERVER_ENGINES, help=f"server engine (default {SERVER_ENGINE})")
+    server.add_argument("--workers", type=int, help=f"worker processes for the sharded engine (default {SHARD_WORKERS})")
+    server.add_argument("--port", type=int, help=f"port to listen on (default {port}, or 7099 for --bench)")
+    server.add_argument("--send-mode", choices=["latency", "throughput"],
+                        help=f"write each frame at once with TCP_NODELAY, or coalesce writes (default {SEND_MODE})")
+    server.add_argument("--coalesce-ms", type=float,
+                        help=f"throughput mode: how long a writer collects frames (default {SEND_COALESCE_WINDOW * 1000:g})")
+    daemon = parser.add_argument_group("headless host")
+    daemon.add_argument("--daemon", action="store_true", help="host without the UI or prompts until SIGTERM/SIGINT")
+    daemon.add_argument("--config", help="JSON file with daemon options (command-line flags take precedence)")
+    daemon.add_argument("--auth", type=int, help="access code clients must present (default: random)")
+    daemon.add_argument("--name", help="host screen name")
+    daemon.add_argument("--bind", help="address to listen on (default 0.0.0.0)")
+    daemon.add_argument("--public", action="store_true", help="also open an ngrok TCP tunnel")
+    daemon.add_argument("--events", choices=DAEMON_EVENTS, help="where chat events go (default stdout)")
+    bench = parser.add_argument_group("benchmark")
+    bench.add_argument("--bench", action="store_true", help="run the headless server load benchmark")
+    bench.add_argument("--clients", type=int, default=50, help="number of synthetic clients")
+    bench.add_argument("--rate", type=float, default=1.0, help="messages per second sent by each client")
+    bench.add_argument("--size", type=int, default=64, help="approximate chat message size in bytes")
+    bench.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    bench.add_argument("--history", action="store_true", help="keep the on-disk message log enabled")
+    bench.add_argument("--caps", default="", help="comma-separated wire capabilities the clients negotiate, e.g. bin1,zlib")
+    bench.add_argument("--output", help="also write the JSON report to this file")
+    bench.add_argument("--startup-bench", action="store_true",
+                       help="time a public host's startup against a local stand-in for the ngrok agent")
+    bench.add_argument("--runs", type=int, default=3, help="host startups to time for --startup-bench")
+    bench.add_argument("--tunnel-delay", type=float, default=0.5,
+                       help="seconds the stand-in agent takes to open a tunnel (--startup-bench)")
+    return parser.parse_args(argv)
+
+# --- Headless host ---
+#
+# `python starchat_cli-LAUNCHPAD.py --daemon [--config starchat.json] [options]`
+# hosts without the prompt_toolkit UI or any prompts, for always-on servers.
+# What the chat pane would show goes to stdout (or the log) instead, and
+# SIGTERM/SIGINT disconnect everyone through shutdown_server().
+#
+# The config file is a JSON object with any of the DAEMON_DEFAULTS keys;
+# "settings" overrides module settings, e.g.
+#   {"port": 7001, "auth": 4321, "name": "Lobby", "public": false,
+#    "settings": {"HISTORY_DIR": "/var/lib/starchat", "FEDERATION_SECRET": "..."}}
+
+DAEMON_DEFAULTS = {
+    "port": port, "auth": None, "name": "StarChat", "bind": "0.0.0.0", "public": False,
+    "engine": SERVER_ENGINE, "workers": None, "events": "stdout", "settings": {},
+}
+DAEMON_EVENTS = ("stdout", "log")
+
+def _check_daemon_config(config):
+    # Raises ValueError naming the first bad value, the way argparse would for a flag.
+    def is_int(value):
+        return isinstance(value, int) and not isinstance(value, bool)
+    if not is_int(config["port"]) or not 1024 <= config["port"] <= 65535:
+        raise ValueError(f"port must be a number between 1024 and 65535, not {config['port']!r}")
+    if config["auth"] is not None and (not is_int(config["auth"]) or config["auth"] < 0):
+        raise ValueError(f"auth must be a number, not {config['auth']!r}")
+    if config["workers"] is not None and (not is_int(config["workers"]) or config["workers"] < 1):
+        raise ValueError(f"workers must be a positive number, not {config['workers']!r}")
+    if config["engine"] not in SERVER_ENGINES:
+        raise ValueError(f"unknown engine {config['engine']!r} (choose from {', '.join(SERVER_ENGINES)})")
+    if config["events"] not in DAEMON_EVENTS:
+        raise ValueError(f"unknown events {config['events']!r} (choose from {', '.join(DAEMON_EVENTS)})")
+    if not isinstance(config["public"], bool):
+        raise ValueError(f"public must be true or false, not {config['public']!r}")
+    for key in ("name", "bind"):
+        if not isinstance(config[key], str) or not config[key]:
+            raise ValueError(f"{key} must be a non-empty string, not {config[key]!r}")
+    if not isinstance(config["settings"], dict):
+        raise ValueError("settings must be a JSON object")
+
+def load_daemon_config(args):
+    config = dict(DAEMON_DEFAULTS)
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            loaded = json.load(f)
+        if not isinstance(loaded, dict):
+            raise ValueError("the config file must hold a JSON object")
+        unknown = set(loaded) - set(config)
+        if unknown:
+            raise ValueError(f"unknown config keys: {', '.join(sorted(unknown))}")
+        config.update(loaded)
+    for key in ("port", "auth", "name", "bind", "engine", "workers", "events"):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    if args.public:
+        config["public"] = True
+    _check_daemon_config(config)
+    for name in config["settings"]:
+        if not name.isupper() or name not in globals():
+            raise ValueError(f"unknown setting {name}")
+    return config
+
+def _stdout_events(msg):
+    sys.stdout.write(f"{datetime.now().isoformat(timespec='seconds')} {msg}\n")
+    sys.stdout.flush()
+
+def _log_events(msg):
+    logger.info("%s", msg, extra={"fields": {"event": "chat"}})
+
+def run_daemon(args):
+    global auth, screenName, message_sink, SHARD_WORKERS
+    try:
+        config = load_daemon_config(args)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"[X] Bad daemon configuration: {e}\n")
+        return 2
+    globals().update(config["settings"])
+    apply_send_options(args)  # Flags win over the config file here too
+    setup_logging()
+    auth = int(config["auth"]) if config["auth"] is not None else random.randint(1000, 9999)
+    screenName = config["name"]
+    if config["workers"]:
+        SHARD_WORKERS = config["workers"]
+    message_sink = _stdout_events if config["events"] == "stdout" else _log_events
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    tunnel = start_tunnel(config["port"]) if config["public"] else None  # Comes up while the server binds
+    if not start_server(config["bind"], config["port"], config["engine"], ui=False):
+        return 1
+    add_message(f"[System] Hosting as {screenName} on {config['bind']}:{config['port']} | Auth Code: {auth}")
+    if tunnel:
+        try:
+            public_url = tunnel.result()
+        except Exception as e:
+            add_message(f"[Error] Failed to start ngrok tunnel: {e}")
+            shutdown_server()
+            return 1
+        add_message(f"[System] Public ngrok tunnel: {public_url}")
+
+    while not stop.wait(1.0):  # Short waits so signals are handled promptly everywhere
+        pass
+    add_message("[System] Shutdown signal received.")
+    shutdown_server()
+    time.sleep(0.5)  # Let writers flush the farewell to every client
+    return 0
+
 # --- Main entrypoint ---
 
 def main():
     global auth, screenName, header_text
 
     auth, screenName = prepInit(auth, screenName, version)
-    debug(f"Initialized with screenName={screenName}, auth={auth}")
+    debug("Initialized with screenName=%s, auth=%s", screenName, auth)
 
     setup_ui() # Call setup_ui before prompting for choice
 
-    print(f"""
+    rprint(f"""
 //////////////////////
 NetHandler P2P Edition -=- {version}
 
@@ -421,18 +4177,23 @@ NetHandler P2P Edition -=- {version}
 
     if choice == '1':
         mode = input("# Net [Mode] - Choose Mode [1] LAN or [2] Public: ").strip()
+        engine_input = input("# Net [Engine] - Choose Engine [1] Threaded, [2] Async or [3] Sharded |Default=1|: ").strip()
+        engine = {"2": "async", "3": "sharded"}.get(engine_input, SERVER_ENGINE)
+        if engine == "sharded":
+            rprint("[yellow]Note:[/yellow] with the sharded engine, reconnecting clients get the recent history "
+                   "replay instead of resuming exactly where they left off.")
+
+        port_input = input("# Net [Host Port] - Pick a Local Port to Listen |Default=7001|: ").strip()
+        port_to_use = int(port_input) if port_input.isdigit() else port # Validate port input
+        if not (1024 <= port_to_use <= 65535):
+            rprint("[X] Port must be between 1024 and 65535.")
+            return
 
         if mode == "1":
             host_ip = "0.0.0.0" # Listen on all available interfaces
-            port_input = input("# Net [Host Port] - Pick a Local Port to Listen |Default=7001|: ").strip()
-            port_to_use = int(port_input) if port_input.isdigit() else port # Validate port input
-            if not (1024 <= port_to_use <= 65535):
-                print("[X] Port must be between 1024 and 65535.")
-                return
-            
             header.text = f"🌐 Connected via LAN | Auth Code: {auth} | {screenName} | Public IP: {host_ip}:{port_to_use}"
             
-            start_server(host_ip, port_to_use)
+            start_server(host_ip, port_to_use, engine)
 
             try:
                 while app.is_running: # Keep main thread alive as long as app is running
@@ -441,7 +4202,7 @@ NetHandler P2P Edition -=- {version}
                 add_message("[System] Server shutting down (Ctrl+C detected)...")
                 shutdown_server() # Call shutdown function on Ctrl+C
             except Exception as e:
-                debug(f"Main thread unexpected error: {e}")
+                debug("Main thread unexpected error: %s", e)
             finally:
                 if app.is_running: # If app is still running for some reason, ensure exit
                     app.exit()
@@ -449,49 +4210,51 @@ NetHandler P2P Edition -=- {version}
 
 
         elif mode == "2":
-            print("[System] Starting ngrok tunnel...")
+            # The tunnel comes up while the server binds and the UI starts.
+            tunnel = start_tunnel(port_to_use)
+            header.text = f"🌐 Connecting via ngrok | Auth Code: {auth} | {screenName} | Public IP: waiting for tunnel..."
 
-            # Start ngrok tunnel
+            if not start_server("0.0.0.0", port_to_use, engine):  # Bind locally, ngrok forwards traffic here
+                return
+            add_message("[System] Starting ngrok tunnel...")
             try:
-                public_tunnel = ngrok.connect(port, "tcp")  # 'tcp' because you're using raw sockets
-                public_url = public_tunnel.public_url  # e.g., tcp://0.tcp.ngrok.io:12345
-                host_port = public_url.split("tcp://")[1]
-                host, public_port = host_port.split(":")
-                public_port = int(public_port)
-
-                print(f"[✔] Public ngrok tunnel established!")
-                print(f"[INFO] Share this IP with clients: {host}")
-                print(f"[INFO] Share this Port with clients: {public_port}")
-                print(f"[INFO] Auth Code: {auth}")
-                print(f"[INFO] Screen Name: {screenName}")
-                debug(f"ngrok public URL: {public_url}")
-                
-                header.text = f"🌐 Connected via ngrok | Auth Code: {auth} | {screenName} | Public IP: {public_url}:{public_port}"
-                
-                start_server("0.0.0.0", port)  # Bind locally, ngrok forwards traffic here
-
+                public_url = tunnel.result()  # e.g., tcp://0.tcp.ngrok.io:12345
+            except Exception as e:
+                debug("ngrok error: %s", e)
+                shutdown_server()
                 while app.is_running:
-                    time.sleep(1)
+                    time.sleep(0.1)
+                rprint(f"[X] Failed to start ngrok tunnel: {e}")
+                return
+            host, public_port = public_url.split("tcp://")[1].rsplit(":", 1)
+            debug("ngrok public URL: %s", public_url)
 
-            except Exception as e:
-                print(f"[X] Failed to start ngrok tunnel: {e}")
-                debug(f"ngrok error: {e}")
+            add_message("[✔] Public ngrok tunnel established!")
+            add_message(f"[INFO] Share this IP with clients: {host}")
+            add_message(f"[INFO] Share this Port with clients: {public_port}")
+            add_message(f"[INFO] Auth Code: {auth}")
+            add_message(f"[INFO] Screen Name: {screenName}")
+            header.text = f"🌐 Connected via ngrok | Auth Code: {auth} | {screenName} | Public IP: {host}:{public_port}"
+            app.invalidate()
+
+            while app.is_running:
+                time.sleep(1)
 
 
     elif choice == '2':
         host = input("# Net [Host IP] - Insert Host IP: ").strip()
         while not host:
-            print("[X] Host IP cannot be empty.")
+            rprint("[X] Host IP cannot be empty.")
             host = input("# Net [Host IP] - Insert Host IP: ").strip()
 
         try:
             port_to_use = int(input("# Net [Host Port]: ").strip())
             if not (1024 <= port_to_use <= 65535):
-                print("[X] Port must be between 1024 and 65535.")
+                rprint("[X] Port must be between 1024 and 65535.")
                 return
             hostauth = int(input("# Net [Host Auth]: ").strip())
         except ValueError:
-            print("[X] Port and Auth must be numbers.")
+            rprint("[X] Port and Auth must be numbers.")
             return
 
         auth = hostauth # Client uses the host's auth code
@@ -505,15 +4268,23 @@ NetHandler P2P Edition -=- {version}
             add_message("[System] Client shutting down (Ctrl+C detected)...")
             shutdown_client() # Call shutdown function on Ctrl+C
         except Exception as e:
-            debug(f"Main thread unexpected error: {e}")
+            debug("Main thread unexpected error: %s", e)
         finally:
             if app.is_running: # If app is still running for some reason, ensure exit
                 app.exit()
             debug("Main thread exiting for client.")
 
     else:
-        print("[X] Invalid choice.")
+        rprint("[X] Invalid choice.")
 
 if __name__ == "__main__":
-    atexit.register(ngrok.kill)
+    args = parse_args()
+    if args.daemon:
+        sys.exit(run_daemon(args))  # Sets up logging once its config is applied
+    setup_logging()
+    if args.bench:
+        sys.exit(run_benchmark(args))
+    if args.startup_bench:
+        sys.exit(run_startup_benchmark(args))
+    apply_send_options(args)
     main()
\ No newline at end of file
@@ -0,0 +1,17 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "starchat_cli-LAUNCHPAD.py")
+
+
+@pytest.fixture(scope="session")
+def starchat():
+    # The script's name isn't importable, so load it by path.
+    spec = importlib.util.spec_from_file_location("starchat", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["starchat"] = module
+    spec.loader.exec_module(module)
+    return module
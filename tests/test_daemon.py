@@ -0,0 +1,56 @@
+import argparse
+import json
+
+import pytest
+
+
+def daemon_args(config_path, **overrides):
+    fields = dict(config=str(config_path), port=None, auth=None, name=None, bind=None, engine=None,
+                  workers=None, events=None, public=False)
+    fields.update(overrides)
+    return argparse.Namespace(**fields)
+
+
+def test_config_engine_typo_is_rejected(starchat, tmp_path):
+    path = tmp_path / "daemon.json"
+    path.write_text(json.dumps({"engine": "asyncc"}))
+    with pytest.raises(ValueError, match="unknown engine"):
+        starchat.load_daemon_config(daemon_args(path))
+
+
+def test_config_engine_is_accepted(starchat, tmp_path):
+    path = tmp_path / "daemon.json"
+    path.write_text(json.dumps({"engine": "async"}))
+    assert starchat.load_daemon_config(daemon_args(path))["engine"] == "async"
+
+
+@pytest.mark.parametrize("loaded, message", [
+    ({"auth": "12ab"}, "auth must be a number"),
+    ({"port": "7398"}, "port must be a number"),
+    ({"port": 80}, "between 1024 and 65535"),
+    ({"port": 70000}, "between 1024 and 65535"),
+    ({"workers": 0}, "workers must be a positive number"),
+    ({"events": "file"}, "unknown events"),
+    ({"public": "yes"}, "public must be true or false"),
+    ({"settings": []}, "settings must be a JSON object"),
+])
+def test_config_bad_values_are_rejected(starchat, tmp_path, loaded, message):
+    path = tmp_path / "daemon.json"
+    path.write_text(json.dumps(loaded))
+    with pytest.raises(ValueError, match=message):
+        starchat.load_daemon_config(daemon_args(path))
+
+
+def test_config_must_be_an_object(starchat, tmp_path):
+    path = tmp_path / "daemon.json"
+    path.write_text(json.dumps([7398]))
+    with pytest.raises(ValueError, match="JSON object"):
+        starchat.load_daemon_config(daemon_args(path))
+
+
+def test_config_values_are_accepted(starchat, tmp_path):
+    path = tmp_path / "daemon.json"
+    path.write_text(json.dumps({"port": 7400, "auth": 1234, "workers": 2, "events": "log", "public": True}))
+    config = starchat.load_daemon_config(daemon_args(path))
+    assert (config["port"], config["auth"], config["workers"], config["events"], config["public"]) == \
+        (7400, 1234, 2, "log", True)
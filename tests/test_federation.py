@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+
+class FakeTrunk:
+    name = "peer"
+
+
+def msg_event(seq, room):
+    return {"k": "msg", "o": "remote", "q": seq, "t": 1, "m": "hi", "c": None, "r": room, "d": None}
+
+
+@pytest.mark.parametrize("room", ["../..", "a/b", "", 7, None])
+def test_trunk_events_for_invalid_rooms_are_dropped(starchat, monkeypatch, room):
+    delivered = []
+    monkeypatch.setattr(starchat, "broadcast", lambda *args, **kwargs: delivered.append(kwargs["room"]))
+    monkeypatch.setattr(starchat, "add_message", lambda line: None)
+    federation = starchat.Federation()
+    frames = [(starchat.MSG_FEDERATION, json.dumps(msg_event(1, room)).encode()),
+              (starchat.MSG_FEDERATION, json.dumps(msg_event(2, "dev")).encode())]
+    assert federation.receive(FakeTrunk(), frames)
+    assert delivered == ["dev"]
+
+
+def trunk_handshake(starchat, monkeypatch, dialer_secret, acceptor_secret):
+    # Runs both sides of the trunk proofs; returns the acceptor's refusal.
+    dialer, acceptor = starchat.Federation(), starchat.Federation()
+    monkeypatch.setattr(starchat, "FEDERATION_SECRET", dialer_secret)
+    nonce = "n1"
+    request = json.loads(json.dumps(dialer.credentials(nonce)))
+    assert dialer_secret not in json.dumps(request)
+    monkeypatch.setattr(starchat, "FEDERATION_SECRET", acceptor_secret)
+    assert acceptor.refusal(request) is None
+    challenge, expected = acceptor.challenge(request)
+    (msg_type, payload), = starchat.FrameDecoder().feed(challenge)
+    assert acceptor_secret not in payload.decode()
+    monkeypatch.setattr(starchat, "FEDERATION_SECRET", dialer_secret)
+    answer = dialer.answer(nonce, payload)
+    monkeypatch.setattr(starchat, "FEDERATION_SECRET", acceptor_secret)
+    return acceptor.proof_refusal(starchat.FrameDecoder().feed(answer), expected)
+
+
+def test_trunk_proofs_with_a_shared_secret(starchat, monkeypatch):
+    assert trunk_handshake(starchat, monkeypatch, "s3cret", "s3cret") is None
+
+
+def test_dialer_refuses_an_acceptor_without_the_secret(starchat, monkeypatch):
+    with pytest.raises(starchat.ProtocolError):
+        trunk_handshake(starchat, monkeypatch, "s3cret", "guess")
+
+
+def test_acceptor_refuses_a_forged_proof(starchat, monkeypatch):
+    monkeypatch.setattr(starchat, "FEDERATION_SECRET", "s3cret")
+    acceptor = starchat.Federation()
+    _, expected = acceptor.challenge({"origin": "remote", "nonce": "n1"})
+    forged = starchat.encode_frame(starchat.MSG_TRUNK_PROOF, json.dumps({"proof": "00" * 32}))
+    assert acceptor.proof_refusal(starchat.FrameDecoder().feed(forged), expected) == "Federation secret mismatch."
@@ -0,0 +1,31 @@
+import pytest
+
+
+def test_frames_split_across_reads_are_reassembled(starchat):
+    data = starchat.encode_frames([(starchat.MSG_CHAT, b"hello"), (starchat.MSG_CHAT, b"world")])
+    decoder = starchat.FrameDecoder()
+    frames = []
+    for i in range(len(data)):  # One byte per read, the worst case
+        frames += decoder.feed(data[i:i + 1])
+    assert frames == [(starchat.MSG_CHAT, b"hello"), (starchat.MSG_CHAT, b"world")]
+
+
+def test_frames_merged_in_one_read_keep_the_partial_tail(starchat):
+    first, second = starchat.encode_frame(starchat.MSG_CHAT, b"one"), starchat.encode_frame(starchat.MSG_PING)
+    third = starchat.encode_frame(starchat.MSG_CHAT, b"three")
+    decoder = starchat.FrameDecoder()
+    assert decoder.feed(first + second + third[:4]) == [(starchat.MSG_CHAT, b"one"), (starchat.MSG_PING, b"")]
+    assert decoder.feed(third[4:]) == [(starchat.MSG_CHAT, b"three")]
+
+
+def test_version_mismatch_is_a_protocol_error(starchat):
+    data = starchat.FRAME_HEADER.pack(starchat.PROTOCOL_VERSION + 1, starchat.MSG_CHAT, 2) + b"hi"
+    with pytest.raises(starchat.ProtocolError, match="unsupported protocol version"):
+        starchat.FrameDecoder().feed(data)
+
+
+def test_oversized_length_is_refused_from_the_header_alone(starchat):
+    # Only the header has arrived: the decoder must not wait for (or buffer) the huge payload.
+    header = starchat.FRAME_HEADER.pack(starchat.PROTOCOL_VERSION, starchat.MSG_CHAT, starchat.MAX_FRAME_SIZE + 1)
+    with pytest.raises(starchat.ProtocolError, match="exceeds limit"):
+        starchat.FrameDecoder().feed(header)
@@ -0,0 +1,20 @@
+import json
+
+import pytest
+
+
+def auth_frames(starchat, options):
+    return [(starchat.MSG_AUTH, json.dumps([starchat.auth or 0, "alice", options]).encode())]
+
+
+@pytest.mark.parametrize("options", [{"history": "lots"}, {"since": "yesterday"}, {"history": None},
+                                     {"history": True}, {"since": [1]}])
+def test_bad_replay_options_are_dropped(starchat, options):
+    _, _, checked = starchat._check_handshake(auth_frames(starchat, options))
+    assert "history" not in checked and "since" not in checked
+
+
+def test_good_replay_options_are_kept(starchat):
+    _, name, checked = starchat._check_handshake(auth_frames(starchat, {"history": 20, "since": 1700000000.5}))
+    assert name == "alice"
+    assert checked["history"] == 20 and checked["since"] == 1700000000.5
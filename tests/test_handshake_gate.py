@@ -0,0 +1,49 @@
+import socket
+
+
+def admit_many(starchat, gate, address, count):
+    admitted = 0
+    for _ in range(count):
+        a, b = socket.socketpair()
+        if gate.admit(a, (address, 40000)):
+            admitted += 1
+            gate.done()
+            a.close()
+        b.close()
+    return admitted
+
+
+def test_remote_addresses_are_rate_limited(starchat, monkeypatch):
+    monkeypatch.setattr(starchat, "HANDSHAKE_BURST", 5)
+    gate = starchat.HandshakeGate()
+    assert admit_many(starchat, gate, "203.0.113.9", 20) == 5
+
+
+def test_loopback_connections_skip_the_per_address_limit(starchat, monkeypatch):
+    monkeypatch.setattr(starchat, "HANDSHAKE_BURST", 5)
+    gate = starchat.HandshakeGate()
+    for address in ("127.0.0.1", "::1", "::ffff:127.0.0.1"):
+        assert admit_many(starchat, gate, address, 20) == 20
+        assert all(gate.check_auth((address, 40000), True) is None for _ in range(20))
+
+
+def test_loopback_guessing_is_slowed_down(starchat, monkeypatch):
+    monkeypatch.setattr(starchat, "HANDSHAKE_BURST", 12)
+    monkeypatch.setattr(starchat, "HANDSHAKE_FAILURE_COST", 5)
+    gate = starchat.HandshakeGate()
+    clock = [1000.0]
+    monkeypatch.setattr(starchat.time, "monotonic", lambda: clock[0])
+    gate._loopback = [12, clock[0]]
+    peer = ("127.0.0.1", 40000)
+    assert gate.check_auth(peer, False) == "[X] Auth Failed."
+    assert gate.check_auth(peer, False) == "[X] Auth Failed."
+    # Out of tokens: nothing from loopback is checked, not even the right code.
+    assert gate.check_auth(peer, False).startswith("[X] Too many failed attempts")
+    assert gate.check_auth(peer, True).startswith("[X] Too many failed attempts")
+    clock[0] += 1 / starchat.HANDSHAKE_RATE
+    assert gate.check_auth(peer, True) is None
+    assert gate.check_auth(("203.0.113.9", 40000), True) is None  # Other addresses are unaffected
+
+
+def test_stats_show_turned_away_handshakes(starchat):
+    assert any("throttled" in line and "shed" in line for line in starchat.format_stats())
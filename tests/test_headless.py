@@ -0,0 +1,13 @@
+import socket
+
+
+def test_headless_bind_failure_goes_to_stderr(starchat, monkeypatch, capsys):
+    monkeypatch.setattr(starchat, "message_sink", lambda msg: None)
+    busy = socket.socket()
+    busy.bind(("127.0.0.1", 0))
+    busy.listen()
+    try:
+        assert not starchat.start_server("127.0.0.1", busy.getsockname()[1], "threaded", ui=False)
+    finally:
+        busy.close()
+    assert "[X] Failed to start server" in capsys.readouterr().err
@@ -0,0 +1,49 @@
+import os
+
+
+def fill(starchat, log, count, size=100):
+    for i in range(count):
+        log.append(starchat.encode_frame(starchat.MSG_CHAT, f"{i:04d}".ljust(size, ".")), timestamp=1000.0 + i)
+
+
+def payloads(starchat, chunks):
+    return [payload[:4].decode() for _, payload in starchat.FrameDecoder().feed(b"".join(chunks))]
+
+
+def test_replay_reads_across_segments(starchat, tmp_path):
+    log = starchat.MessageLog(str(tmp_path), segment_bytes=1000)
+    fill(starchat, log, 30)
+    assert len(log.segments) > 1
+    assert payloads(starchat, log.read_range(5, 25)) == [f"{i:04d}" for i in range(4, 25)]
+    assert log.first_seq_since(1010.0) == 11
+    log.close()
+
+
+def test_replay_is_capped_in_bytes_keeping_the_newest(starchat, tmp_path, monkeypatch):
+    log = starchat.MessageLog(str(tmp_path), segment_bytes=1000)
+    fill(starchat, log, 30)
+    frame_size = starchat.FRAME_HEADER.size + 100
+    monkeypatch.setattr(starchat, "HISTORY_REPLAY_BYTES", 7 * frame_size)
+    replayed = payloads(starchat, log.replay_chunks({"history": 20}, log.last_seq))
+    assert replayed == [f"{i:04d}" for i in range(23, 30)]
+    assert log.first_seq_within(log.last_seq, 10 ** 9) == 1
+    log.close()
+
+
+def test_recover_drops_a_torn_tail(starchat, tmp_path):
+    log = starchat.MessageLog(str(tmp_path))
+    fill(starchat, log, 3)
+    seg = log.segments[-1]
+    log_path, idx_path = seg.log_path, seg.idx_path
+    log.close()
+    with open(log_path, "ab") as f:  # Crash after the data write, before the index write
+        f.write(starchat.encode_frame(starchat.MSG_CHAT, b"torn"))
+    with open(idx_path, "r+b") as f:  # And a frame whose data never fully hit the disk
+        f.seek(0, os.SEEK_END)
+        f.write(starchat.INDEX_ENTRY.pack(4, 1003.0, os.path.getsize(log_path)))
+    log = starchat.MessageLog(str(tmp_path))
+    assert log.last_seq == 3
+    assert os.path.getsize(log_path) == 3 * (starchat.FRAME_HEADER.size + 100)
+    assert log.append(starchat.encode_frame(starchat.MSG_CHAT, b"next")) == 4
+    assert payloads(starchat, log.read_range(3, 4)) == ["0002", "next"]
+    log.close()
@@ -0,0 +1,31 @@
+import threading
+
+
+def test_counters_add_up_across_threads(starchat):
+    metrics = starchat.Metrics()
+    metrics.inc("messages_in")
+
+    def bump():
+        for _ in range(1000):
+            metrics.inc("messages_in")
+            metrics.inc("bytes_in", 10)
+
+    workers = [threading.Thread(target=bump) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    counters = metrics.counters
+    assert counters["messages_in"] == 4001
+    assert counters["bytes_in"] == 40000
+
+
+def test_exited_threads_keep_their_counts(starchat):
+    metrics = starchat.Metrics()
+    worker = threading.Thread(target=metrics.inc, args=("broadcasts", 3))
+    worker.start()
+    worker.join()
+    assert metrics.counters["broadcasts"] == 3
+    assert metrics._threads == []
+    metrics.inc("broadcasts")
+    assert metrics.counters["broadcasts"] == 4
@@ -0,0 +1,23 @@
+def sent_seqs(starchat, data):
+    frames = starchat.FrameDecoder().feed(data)
+    return [(payload, starchat.SEQ_HEADER.unpack(marker)[0])
+            for (_, payload), (_, marker) in zip(frames[::2], frames[1::2])]
+
+
+def test_since_replays_everything_after_the_acked_seq(starchat):
+    window = starchat.ResumeWindow()
+    for text in (b"a", b"b", b"c"):
+        window.stamp(starchat.encode_frame(starchat.MSG_CHAT, text))
+    assert window.since(3) == b""
+    assert sent_seqs(starchat, window.since(1)) == [(b"b", 2), (b"c", 3)]
+    assert sent_seqs(starchat, window.since(0)) == [(b"a", 1), (b"b", 2), (b"c", 3)]
+
+
+def test_since_refuses_gaps_and_unknown_seqs(starchat, monkeypatch):
+    monkeypatch.setattr(starchat, "RESUME_WINDOW_FRAMES", 2)
+    window = starchat.ResumeWindow()
+    for text in (b"a", b"b", b"c"):
+        window.stamp(starchat.encode_frame(starchat.MSG_CHAT, text))
+    assert window.since(0) is None  # Frame 1 already fell out of the window
+    assert sent_seqs(starchat, window.since(1)) == [(b"b", 2), (b"c", 3)]
+    assert window.since(4) is None  # The client claims more than was ever sent
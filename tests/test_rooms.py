@@ -0,0 +1,131 @@
+import os
+
+import pytest
+
+
+class FakeSession:
+    window = None
+    addr = ("127.0.0.1", 40000)
+
+    def __init__(self, client_id, name="alice"):
+        self.client_id = client_id
+        self.name = name
+        self.room = None
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+        return True
+
+    def close(self):
+        pass
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+@pytest.fixture
+def hosting(starchat, tmp_path, monkeypatch):
+    monkeypatch.setattr(starchat, "message_log", starchat.MessageLog(str(tmp_path)))
+    monkeypatch.setattr(starchat, "rooms", {})
+    monkeypatch.setattr(starchat, "room_logs", type(starchat.room_logs)())
+    monkeypatch.setattr(starchat, "message_sink", lambda msg: None)
+    yield starchat
+    starchat.message_log.close()
+
+
+def test_room_logs_are_closed_when_rooms_empty(starchat, tmp_path, monkeypatch):
+    monkeypatch.setattr(starchat, "message_log", starchat.MessageLog(str(tmp_path)))
+    monkeypatch.setattr(starchat, "rooms", {})
+    monkeypatch.setattr(starchat, "room_logs", type(starchat.room_logs)())
+    session = FakeSession(1)
+    before = open_fds()
+    for i in range(200):
+        with starchat.clients_lock:
+            if session.room:
+                starchat._leave_room(session)
+        starchat._join_room(session, f"r{i}")
+    assert list(starchat.room_logs) == ["r199"]
+    assert open_fds() - before <= 2
+    assert not starchat.room_joins
+    starchat.message_log.close()
+
+
+def test_idle_room_logs_are_capped(starchat, tmp_path, monkeypatch):
+    monkeypatch.setattr(starchat, "message_log", starchat.MessageLog(str(tmp_path)))
+    monkeypatch.setattr(starchat, "rooms", {})
+    monkeypatch.setattr(starchat, "room_logs", type(starchat.room_logs)())
+    monkeypatch.setattr(starchat, "ROOM_LOGS_OPEN", 4)
+    for i in range(10):
+        starchat.deliver_local("hello", None, room=f"r{i}")
+    assert list(starchat.room_logs) == ["r6", "r7", "r8", "r9"]
+    starchat.deliver_local("again", None, room="r0")  # Reopened from disk
+    assert starchat.room_logs["r0"].last_seq == 2
+    starchat.message_log.close()
+
+
+def test_moving_rooms_closes_the_emptied_room_log(hosting):
+    session = FakeSession(1)
+    hosting._join_room(session, hosting.DEFAULT_ROOM)
+    hosting._move_to_room(session, "dev")
+    hosting._move_to_room(session, hosting.DEFAULT_ROOM)
+    assert list(hosting.rooms) == [hosting.DEFAULT_ROOM]
+    assert list(hosting.room_logs) == []
+
+
+def test_leaving_the_chat_closes_the_emptied_room_log(hosting):
+    session = FakeSession(1)
+    hosting._join_room(session, "dev")
+    hosting._unregister_client(session)
+    assert hosting.rooms == {}
+    assert list(hosting.room_logs) == []
+
+
+def test_failed_join_leaves_no_trace(hosting):
+    class BrokenSession(FakeSession):
+        def send(self, data):
+            raise OSError("gone")
+
+    hosting.deliver_local("earlier", None, room="dev")
+    session = BrokenSession(2)
+    with pytest.raises(OSError):
+        hosting._join_room(session, "dev")
+    assert not hosting.room_joins
+    assert list(hosting.room_logs) == []
+    hosting._unregister_client(session)  # Never in a room: nothing to announce
+
+
+def test_async_join_reads_history_off_the_event_loop(hosting, monkeypatch):
+    import asyncio
+    import threading
+
+    for i in range(3):
+        hosting.deliver_local(f"earlier {i}", None, room="dev")
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(hosting, "server_loop", loop)
+    reader_threads = []
+    replay_chunks = hosting.MessageLog.replay_chunks
+    monkeypatch.setattr(hosting.MessageLog, "replay_chunks",
+                        lambda self, *args: reader_threads.append(threading.get_ident()) or replay_chunks(self, *args))
+    session = FakeSession(1)
+    monkeypatch.setitem(hosting.clients, session.client_id, session)
+    joined = threading.Event()
+    loop.call_soon_threadsafe(lambda: (hosting._join_room(session, "dev"), joined.set()))
+    try:
+        assert joined.wait(2)
+        for _ in range(200):
+            if session.client_id in hosting.rooms.get("dev", {}):
+                break
+            threading.Event().wait(0.01)
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result(2)  # Let the join callback finish
+        assert reader_threads and reader_threads[0] != thread.ident
+        assert [p for _, p in hosting.FrameDecoder().feed(b"".join(session.sent))] == [
+            b"earlier 0", b"earlier 1", b"earlier 2"]
+        assert not hosting.room_joins
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(2)
+        loop.close()
@@ -0,0 +1,21 @@
+import time
+
+
+def search_lines(starchat, arg):
+    return starchat.search_command(arg, ["lobby"])
+
+
+def test_unindexable_words_match_nothing(starchat, monkeypatch):
+    index = starchat.SearchIndex()
+    monkeypatch.setattr(starchat, "search_index", index)
+    index.add("lobby", "alice", time.time(), "a quick note")
+    index.add("lobby", "bob", time.time(), "another one")
+    assert index.search(["a"]) == []
+    assert index.search(["a"], sender="alice") == []
+    assert search_lines(starchat, "a")[0].startswith("[System] No matches for 'a'")
+    assert len(index.search(["quick"])) == 1
+    assert len(index.search([], sender="bob")) == 1
+
+
+def test_empty_query_shows_usage(starchat):
+    assert search_lines(starchat, "")[0].startswith("[System] Usage: /search")
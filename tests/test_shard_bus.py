@@ -0,0 +1,68 @@
+import json
+import time
+
+
+class RecordingLink:
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame):
+        self.frames.append(frame)
+
+
+def test_host_publish_relays_and_indexes(starchat, tmp_path, monkeypatch):
+    monkeypatch.setattr(starchat, "search_index", starchat.SearchIndex())
+    monkeypatch.setattr(starchat, "message_log", None)
+    bus = starchat.ShardBus(str(tmp_path / "bus.sock"))
+    try:
+        link = RecordingLink()
+        bus.links[0] = link
+        compact = (starchat.HOST_CLIENT_ID, "host", time.time(), "deploy finished")
+        bus.publish("host: deploy finished", starchat.HOST_CLIENT_ID, compact=compact)
+
+        (msg_type, payload), = starchat.FrameDecoder().feed(link.frames[0])
+        assert msg_type == starchat.MSG_BUS_EVENT
+        assert json.loads(payload)["m"] == "host: deploy finished"
+        assert len(starchat.search_index.search(["deploy"])) == 1
+    finally:
+        bus.sock.close()
+
+
+def test_host_direct_message_is_not_indexed(starchat, tmp_path, monkeypatch):
+    monkeypatch.setattr(starchat, "search_index", starchat.SearchIndex())
+    monkeypatch.setattr(starchat, "message_log", None)
+    bus = starchat.ShardBus(str(tmp_path / "bus.sock"))
+    try:
+        link = RecordingLink()
+        bus.links[0] = link
+        compact = (starchat.HOST_CLIENT_ID, "host", time.time(), "secret plans")
+        bus.publish("host -> bob: secret plans", starchat.HOST_CLIENT_ID, compact=compact, to=7)
+        assert len(link.frames) == 1
+        assert starchat.search_index.search(["secret"]) == []
+    finally:
+        bus.sock.close()
+
+
+def test_replay_request_is_answered_with_the_room_history(starchat, tmp_path, monkeypatch):
+    log = starchat.MessageLog(str(tmp_path / "history"))
+    monkeypatch.setattr(starchat, "message_log", log)
+    bus = starchat.ShardBus(str(tmp_path / "bus.sock"))
+    try:
+        link = RecordingLink()
+        bus.links[0] = link
+        for i in range(5):
+            bus.publish(f"msg {i}", starchat.HOST_CLIENT_ID)
+        link.frames.clear()
+        bus._replay(link, {"id": 7, "r": starchat.DEFAULT_ROOM, "o": {"history": 2}})
+
+        decoder = starchat.FrameDecoder()
+        frames = [frame for data in link.frames for frame in decoder.feed(data)]
+        assert frames[0][0] == starchat.MSG_BUS_REPLAY
+        header = json.loads(frames[0][1])
+        assert header["id"] == 7 and header["chunks"] == len(frames) - 1
+        replayed = starchat.FrameDecoder().feed(b"".join(payload for _, payload in frames[1:]))
+        assert [payload for _, payload in replayed] == [b"msg 3", b"msg 4"]
+        assert not starchat.room_joins
+    finally:
+        bus.sock.close()
+        log.close()
@@ -0,0 +1,33 @@
+import threading
+import time
+
+
+def test_timers_fire_in_deadline_order_across_turns(starchat):
+    wheel = starchat.TimerWheel(tick=0.01, slots=4)
+    fired, done = [], threading.Event()
+    start = time.monotonic()
+
+    def record(name):
+        fired.append((name, time.monotonic() - start))
+        if len(fired) == 3:
+            done.set()
+
+    wheel.schedule(0.15, record, "late")  # Several turns of a four-slot wheel
+    wheel.schedule(0.02, record, "early")
+    wheel.schedule(0.06, record, "middle")
+    assert done.wait(2)
+    assert [name for name, _ in fired] == ["early", "middle", "late"]
+    # Deadlines round up to the next tick, so nothing fires more than a tick early.
+    assert fired[-1][1] >= 0.15 - wheel.tick
+    assert len(wheel) == 0
+
+
+def test_cancelled_timers_never_fire(starchat):
+    wheel = starchat.TimerWheel(tick=0.01, slots=4)
+    fired, done = [], threading.Event()
+    timer = wheel.schedule(0.03, fired.append, "cancelled")
+    wheel.schedule(0.08, done.set)
+    wheel.cancel(timer)
+    wheel.cancel(None)  # Nothing armed: a no-op
+    assert done.wait(2)
+    assert fired == []
@@ -0,0 +1,50 @@
+import types
+
+
+class FakeBuffer:
+    document = None
+
+    def set_document(self, document, bypass_readonly=False):
+        self.document = document
+
+
+def test_scrollback_appends_and_trims_oldest(starchat, monkeypatch):
+    buffer = FakeBuffer()
+    monkeypatch.setattr(starchat, "chat_output", types.SimpleNamespace(buffer=buffer))
+    monkeypatch.setattr(starchat, "app", types.SimpleNamespace(invalidate=lambda: None))
+    monkeypatch.setattr(starchat, "_scrollback", type(starchat._scrollback)())
+    monkeypatch.setattr(starchat, "_scrollback_text", "")
+    monkeypatch.setattr(starchat, "_scrollback_lines", 0)
+    monkeypatch.setattr(starchat, "SCROLLBACK_LINES", 5)
+    sent = [f"line {i}" for i in range(12)]
+    for start in range(0, len(sent), 3):
+        starchat._pending_messages.extend(sent[start:start + 3])
+        starchat._flush_messages()
+        shown = sent[:start + 3][-5:]
+        assert buffer.document.text == "\n".join(shown)
+        assert buffer.document.cursor_position == len(buffer.document.text)
+
+
+def test_scrollback_caps_lines_not_messages(starchat, monkeypatch):
+    buffer = FakeBuffer()
+    monkeypatch.setattr(starchat, "chat_output", types.SimpleNamespace(buffer=buffer))
+    monkeypatch.setattr(starchat, "app", types.SimpleNamespace(invalidate=lambda: None))
+    monkeypatch.setattr(starchat, "_scrollback", type(starchat._scrollback)())
+    monkeypatch.setattr(starchat, "_scrollback_text", "")
+    monkeypatch.setattr(starchat, "_scrollback_lines", 0)
+    monkeypatch.setattr(starchat, "SCROLLBACK_LINES", 5)
+    starchat._pending_messages.extend(["one", "two\nrows", "", "three\nmore\nrows"])
+    starchat._flush_messages()
+    # Seven lines in four messages: "one" and then "two\nrows" go to get back to five or fewer.
+    assert buffer.document.text == "\nthree\nmore\nrows"
+    # A message longer than the cap still shows, on its own.
+    starchat._pending_messages.append("a\nb\nc\nd\ne\nf\ng")
+    starchat._flush_messages()
+    assert buffer.document.text == "a\nb\nc\nd\ne\nf\ng"
+
+
+def test_client_stats_describe_the_client_connection(starchat, monkeypatch):
+    monkeypatch.setattr(starchat, "server_address", ("chat.example", 4242))
+    lines = starchat.format_client_stats()
+    assert "connected to chat.example:4242" in lines[0]
+    assert not any("clients" in line or "accepted" in line for line in lines)